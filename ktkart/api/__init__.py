@@ -0,0 +1 @@
+default_app_config = 'ktkart.api.apps.ApiConfig'
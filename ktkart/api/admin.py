@@ -1,6 +1,238 @@
+from collections import defaultdict
+from datetime import datetime
+
 from django.contrib import admin
-from .models import Kart, Balance, Booking
+from django.contrib.admin.options import IncorrectLookupParameters, csrf_protect_m
+from django.contrib.auth.models import User
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from . import sharding
+from .ledger import booking_payments, post_entries
+from .models import Kart, Balance, Booking, ArchivedBooking, LedgerEntry, KartDailyUsage
+
+
+def estimated_count(alias, table):
+    """
+    Number of rows of the table from the database statistics, without scanning it.
+    None when the database does not keep such statistics.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'mysql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            [table]
+        )
+        row = cursor.fetchone()
+    return None if row is None or row[0] is None else int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of the changelists. Without filters the page count comes from the estimated
+    number of rows instead of a COUNT(*) of the whole table. Filtered changelists and small
+    tables, where the estimate is the least accurate, are counted.
+    The estimate is replaced by the real count when a page shows it is wrong: a short page
+    is the last one, and the pages past an estimate too low are counted.
+    """
+    exact_below = 10000
+    estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.db, queryset.model._meta.db_table)
+            if estimate is not None and estimate >= self.exact_below:
+                self.estimated = True
+                return estimate
+        return super().count
+
+    def exact_count(self, count=None):
+        """
+        Replace the estimate by the given number of rows, counted when None
+        """
+        self.estimated = False
+        self.__dict__['count'] = self.object_list.count() if count is None else count
+        self.__dict__.pop('num_pages', None)
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if not self.estimated:
+                raise
+        self.exact_count()
+        return super().validate_number(number)
+
+    def page(self, number):
+        page = super().page(number)
+        if not self.estimated or len(page) == self.per_page:
+            return page
+        if len(page) or page.number == 1:
+            self.exact_count((page.number - 1) * self.per_page + len(page))
+            return page
+        # past the last row, the last page is shown instead of an error
+        self.exact_count()
+        return self.page(self.num_pages)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Admin of the tables growing with the bookings: estimated page count, no count of the whole
+    table next to the filtered one, and raw id widgets instead of a select of all users or karts
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    With sharded bookings, the changelist shows the bookings of one shard at a time, the first one by default
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.booking_shards()]
+
+    def value(self):
+        return super().value() or sharding.booking_shards()[0]
+
+    def choices(self, changelist):
+        # no "All" choice, the shards are not listed together
+        return list(super().choices(changelist))[1:]
+
+    def queryset(self, request, queryset):
+        if self.value() not in sharding.booking_shards():
+            raise IncorrectLookupParameters
+        return queryset.using(self.value())
+
+
+@admin.register(Booking)
+class BookingAdmin(LargeTableAdmin):
+    list_display = ('id', 'start_time', 'end_time', 'user', 'kart', 'version')
+    list_select_related = ('user', 'kart')
+    raw_id_fields = ('user', 'kart')
+    date_hierarchy = 'start_time'
+    actions = ['cancel_and_refund']
+
+    def get_list_display(self, request):
+        # the users and karts are not on the shards, they cannot be joined
+        if sharding.is_sharded():
+            return ('id', 'start_time', 'end_time', 'user_id', 'kart_id', 'version')
+        return self.list_display
+
+    def get_list_select_related(self, request):
+        return self.list_select_related if not sharding.is_sharded() else False
+
+    def get_list_filter(self, request):
+        return [ShardFilter] if sharding.is_sharded() else []
+
+    @csrf_protect_m
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        if not sharding.is_sharded():
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        # the admin opens its transaction on the database of the model, here the one of the booking is not known yet
+        with sharding.atomic(*sharding.booking_shards()):
+            return self._changeform_view(request, object_id, form_url, extra_context)
+
+    @csrf_protect_m
+    def delete_view(self, request, object_id, extra_context=None):
+        if not sharding.is_sharded():
+            return super().delete_view(request, object_id, extra_context)
+        with sharding.atomic(*sharding.booking_shards()):
+            return self._delete_view(request, object_id, extra_context)
+
+    def get_deleted_objects(self, objs, request):
+        if not sharding.is_sharded():
+            return super().get_deleted_objects(objs, request)
+        # nothing depends on a booking, the objects deleted are the bookings themselves
+        objs = list(objs)
+        opts = self.model._meta
+        perms_needed = set() if self.has_delete_permission(request) else {opts.verbose_name}
+        return [str(obj) for obj in objs], {opts.verbose_name_plural: len(objs)}, perms_needed, []
+
+    def get_object(self, request, object_id, from_field=None):
+        if not sharding.is_sharded():
+            return super().get_object(request, object_id, from_field)
+        try:
+            return sharding.find_booking(int(object_id))
+        except ValueError:
+            return None
+
+    def cancel_and_refund(self, request, queryset):
+        """
+        Delete the selected upcoming bookings and refund their users, in one transaction
+        with one balance update per user. Bookings already started are kept.
+        With sharded bookings the selection is looked up on every shard.
+        """
+        now = datetime.now()
+        refunds = defaultdict(list)
+        shards = sharding.booking_shards()
+        with sharding.atomic(*shards):
+            rows = {
+                alias: list(queryset.using(alias).select_for_update().filter(start_time__gt=now).values_list('id', 'user_id'))
+                for alias in shards
+            }
+            booking_ids = [booking_id for alias in shards for booking_id, user_id in rows[alias]]
+            if booking_ids:
+                # each booking is refunded what was paid for it
+                payments = booking_payments(booking_ids)
+                for alias in shards:
+                    for booking_id, user_id in rows[alias]:
+                        refunds[user_id].append((payments.get(booking_id, 0), LedgerEntry.REFUND, booking_id))
+                users = User.objects.in_bulk(list(refunds))
+                for user_id, entries in refunds.items():
+                    post_entries(users[user_id], entries)
+                for alias in shards:
+                    sharding.bookings_on(alias).filter(id__in=[booking_id for booking_id, user_id in rows[alias]]).delete()
+        refunded = round(sum(amount for entries in refunds.values() for amount, reason, booking_ref in entries), 2)
+        kept = sum(queryset.using(alias).count() for alias in shards)
+        message = "{} bookings cancelled, ${} refunded.".format(len(booking_ids), refunded)
+        if kept:
+            message += " {} bookings already started were kept.".format(kept)
+        self.message_user(request, message)
+    cancel_and_refund.short_description = "Cancel and refund the selected upcoming bookings"
+
+
+@admin.register(ArchivedBooking)
+class ArchivedBookingAdmin(LargeTableAdmin):
+    list_display = ('id', 'booking_id', 'start_time', 'end_time', 'user', 'kart')
+    list_select_related = ('user', 'kart')
+    raw_id_fields = ('user', 'kart')
+    date_hierarchy = 'end_time'
+
+
+@admin.register(Balance)
+class BalanceAdmin(LargeTableAdmin):
+    list_display = ('user', 'balance', 'version')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    # a balance is the sum of the ledger entries, it changes through the API (balance/update/), which posts them
+    readonly_fields = ('balance', 'version')
+    # usernames are the emails, exact match on the unique index
+    search_fields = ('=user__username',)
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'amount', 'reason', 'booking_ref', 'created_at')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    list_filter = ('reason',)
+    date_hierarchy = 'created_at'
+
+
+@admin.register(KartDailyUsage)
+class KartDailyUsageAdmin(LargeTableAdmin):
+    list_display = ('kart', 'day', 'booked_hours', 'revenue')
+    list_select_related = ('kart',)
+    raw_id_fields = ('kart',)
+    date_hierarchy = 'day'
+
 
 admin.site.register(Kart)
-admin.site.register(Balance)
-admin.site.register(Booking)
@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 
 class ApiConfig(AppConfig):
-    name = 'api'
+    name = 'ktkart.api'
+    label = 'api'
+
+    def ready(self):
+        # connect signal receivers
+        from . import signals
@@ -0,0 +1,59 @@
+from time import sleep
+
+from django.db import connections
+
+from . import sharding
+from .cache import bump_versions, invalidate_availability
+from .models import Booking, ArchivedBooking
+from .sharding import booking_shards, bookings_on
+
+
+def delete_bookings(alias, booking_ids):
+    """
+    Plain DELETE of the bookings, without the per booking delete signals: the bookings are
+    archived, not cancelled, so their rollups stay and one version bump replaces the invalidations.
+    """
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM {} WHERE {} IN ({})".format(
+                connection.ops.quote_name(Booking._meta.db_table),
+                connection.ops.quote_name(Booking._meta.pk.column),
+                ', '.join(['%s'] * len(booking_ids))
+            ),
+            booking_ids
+        )
+
+
+def archive_finished_bookings(before, batch_size=1000, pause=0):
+    """
+    Move bookings that ended before `before` into the ArchivedBooking table.
+    Each batch is copied and deleted in its own short transaction, so locks on
+    the Booking table are only held for one batch at a time. Shards are archived one after the other.
+    Return the number of archived bookings.
+    """
+    archived = 0
+    for alias in booking_shards():
+        while True:
+            with sharding.atomic(alias):
+                rows = list(
+                    bookings_on(alias).select_for_update()
+                    .filter(end_time__lt=before)
+                    .order_by('end_time')
+                    .values('id', 'start_time', 'end_time', 'user_id', 'kart_id')[:batch_size]
+                )
+                if not rows:
+                    break
+                booking_ids = [row.pop('id') for row in rows]
+                ArchivedBooking.objects.bulk_create([
+                    ArchivedBooking(booking_id=booking_id, **row) for booking_id, row in zip(booking_ids, rows)
+                ])
+                delete_bookings(alias, booking_ids)
+            bump_versions('bookings')
+            invalidate_availability()
+            archived += len(rows)
+            if len(rows) < batch_size:
+                break
+            if pause:
+                sleep(pause)
+    return archived
@@ -0,0 +1,123 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+
+from .models import Kart
+from .sharding import bookings_on, group_by_shard, scatter
+
+# shortest booking, a shorter free period does not count as free
+MIN_BOOKING = timedelta(hours=1)
+
+
+def busy_periods(kart_ids, start, end):
+    """
+    Return the bookings of the karts overlapping [start, end] with a single query per shard,
+    as a dict of kart id -> list of [start, end, booking id]
+    """
+    shards = group_by_shard(kart_ids)
+
+    def read(alias):
+        bookings = bookings_on(alias).filter(kart_id__in=shards[alias], end_time__gte=start, start_time__lte=end)
+        return list(bookings.values_list('id', 'kart_id', 'start_time', 'end_time'))
+    periods = defaultdict(list)
+    for rows in scatter(read, shards):
+        for booking_id, kart_id, booking_start, booking_end in rows:
+            periods[kart_id].append([booking_start, booking_end, booking_id])
+    return periods
+
+
+def is_free(periods, start, end, ignore=None):
+    """
+    True if none of the periods overlaps [start, end], apart from the booking `ignore`.
+    Bounds are inclusive, as in the booking views.
+    """
+    return not any(
+        period_end >= start and period_start <= end and booking_id != ignore
+        for period_start, period_end, booking_id in periods
+    )
+
+
+def sweep_conflicts(periods, candidates):
+    """
+    Sweep the sorted, non overlapping busy periods of a kart and sorted candidate periods
+    together, return the candidates overlapping a busy period
+    """
+    periods = sorted(periods)
+    conflicts, i = [], 0
+    for candidate in candidates:
+        start, end = candidate[0], candidate[1]
+        while i < len(periods) and periods[i][1] < start:
+            i += 1
+        if i < len(periods) and periods[i][0] <= end:
+            conflicts.append(candidate)
+    return conflicts
+
+
+def merge_periods(periods):
+    """
+    Union of periods, as sorted non overlapping periods
+    """
+    merged = []
+    for start, end in sorted(periods):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def free_karts_by_window(kart_ids, windows):
+    """
+    Return, for each (start, end) window, the ids of the karts free during it.
+    The bookings overlapping the union of the windows are read with one query per shard,
+    then the bookings of each kart are swept against the sorted windows.
+    """
+    union = Q()
+    for start, end in merge_periods(windows):
+        union |= Q(end_time__gte=start, start_time__lte=end)
+    periods = defaultdict(list)
+    for rows in scatter(lambda alias: list(bookings_on(alias).filter(union).values_list('id', 'kart_id', 'start_time', 'end_time'))):
+        for booking_id, kart_id, booking_start, booking_end in rows:
+            periods[kart_id].append([booking_start, booking_end, booking_id])
+    candidates = sorted((start, end, index) for index, (start, end) in enumerate(windows))
+    busy = [set() for window in windows]
+    for kart_id, kart_periods in periods.items():
+        for start, end, index in sweep_conflicts(kart_periods, candidates):
+            busy[index].add(kart_id)
+    return [[kart_id for kart_id in kart_ids if kart_id not in busy_karts] for busy_karts in busy]
+
+
+def next_free(periods, now, min_length=MIN_BOOKING):
+    """
+    First free period of at least `min_length` after `now`, given the sorted busy (start, end)
+    periods of a kart ending after now. Works on datetimes or on numbers of seconds.
+    Return (free_at, free_until), free_until is None when no booking follows.
+    """
+    free_at = now
+    for start, end in periods:
+        if start - free_at > min_length:
+            return free_at, start
+        free_at = max(free_at, end)
+    return free_at, None
+
+
+def refresh_next_free(kart_ids, now=None):
+    """
+    Store the next free period of the karts in their next_free_at and free_until fields,
+    with one query per shard for their upcoming bookings. Called on each booking write and, for the karts
+    whose free period started to go by, by the refresh_next_free command.
+    """
+    now = now or datetime.now()
+    shards = group_by_shard(kart_ids)
+
+    def read(alias):
+        bookings = bookings_on(alias).filter(kart_id__in=shards[alias], end_time__gte=now).order_by('start_time')
+        return list(bookings.values_list('kart_id', 'start_time', 'end_time'))
+    periods = defaultdict(list)
+    for rows in scatter(read, shards):
+        for kart_id, start, end in rows:
+            periods[kart_id].append((start, end))
+    for kart_id in kart_ids:
+        free_at, free_until = next_free(periods[kart_id], now)
+        Kart.objects.filter(id=kart_id).update(next_free_at=free_at, free_until=free_until)
@@ -0,0 +1,200 @@
+from datetime import datetime
+
+from . import sharding
+from .availability import busy_periods, is_free
+from .bookings import lock_karts
+from .ledger import booking_payments, post_entries
+from .models import Kart, Balance, Booking, LedgerEntry
+from .pricing import ONE_HOUR, booking_price
+from .serializers import BookingSerializer
+from .sharding import booking_shards, bookings_on, scatter, shard_for_kart
+from .utils import parse_datetime
+
+BATCH_MODES = ('atomic', 'partial')
+OPERATIONS = ('create', 'update', 'delete')
+
+
+class OperationError(Exception):
+    pass
+
+
+class Batch:
+    """
+    Create, update and delete many bookings of a user at once.
+    All operations are checked in one pass, against the bookings loaded with one query
+    and the previous operations of the batch, with the same rules as the booking/ routes.
+    Valid operations are then written in one transaction with one balance update.
+    In atomic mode, nothing is written if one operation fails. If a booking of the batch
+    changed since it was loaded, write() raises StaleVersion and nothing is written.
+    """
+
+    def __init__(self, user, operations, mode='atomic'):
+        self.user = user
+        self.operations = operations
+        self.mode = mode
+        self.now = datetime.now()
+        self.results = [None] * len(operations)
+        # operations to write, as (index, operation, booking, amount)
+        self.valid = []
+
+    def run(self):
+        parsed = []
+        for index, operation in enumerate(self.operations):
+            try:
+                parsed.append((index, self.parse(operation)))
+            except OperationError as error:
+                self.fail(index, error)
+        # the karts stay locked from the availability checks to the writes
+        with sharding.atomic(*booking_shards()):
+            self.load(parsed)
+            for index, operation in parsed:
+                try:
+                    self.valid.append(getattr(self, 'check_' + operation['op'])(index, operation))
+                except OperationError as error:
+                    self.fail(index, error)
+            if self.mode == 'atomic' and len(self.valid) < len(self.operations):
+                return False
+            self.write()
+        return True
+
+    def fail(self, index, error):
+        self.results[index] = {"status": "error", "error": str(error)}
+
+    def parse(self, operation):
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            raise OperationError("Operation must be create, update or delete.")
+        parsed = {"op": operation["op"]}
+        try:
+            if operation["op"] != 'create':
+                parsed["booking_id"] = int(operation.get("booking_id"))
+            else:
+                parsed["kart_id"] = int(operation.get("kart_id"))
+            if operation["op"] != 'delete':
+                parsed["start"] = parse_datetime(operation.get("start"))
+                parsed["end"] = parse_datetime(operation.get("end"))
+        except (TypeError, ValueError):
+            raise OperationError("Ids must be integers and datetimes must be formatted %Y-%m-%d %H:%M:%S.%f")
+        return parsed
+
+    def load(self, parsed):
+        booking_ids = [operation["booking_id"] for index, operation in parsed if "booking_id" in operation]
+        self.bookings = {}
+        if booking_ids:
+            # bookings are on the shards of their karts, the karts on the default database
+            for bookings in scatter(lambda alias: bookings_on(alias).filter(user=self.user).in_bulk(booking_ids)):
+                self.bookings.update(bookings)
+        # updates pay the difference with what was paid for the booking, deletes refund it
+        self.payments = booking_payments(booking_ids) if booking_ids else {}
+        kart_ids = {operation["kart_id"] for index, operation in parsed if "kart_id" in operation}
+        kart_ids.update(booking.kart_id for booking in self.bookings.values())
+        self.karts = Kart.objects.in_bulk(kart_ids) if kart_ids else {}
+        for booking in self.bookings.values():
+            booking.kart = self.karts[booking.kart_id]
+
+        # one range query over all the periods of the batch, with the karts locked as by the booking/ routes
+        periods = [(operation["start"], operation["end"]) for index, operation in parsed if "start" in operation]
+        if periods:
+            lock_karts(self.karts)
+            self.periods = busy_periods(list(self.karts), min(start for start, end in periods), max(end for start, end in periods))
+        else:
+            self.periods = {}
+        self.balance = Balance.objects.get(user=self.user).get_balance()
+
+    def get_booking(self, operation):
+        booking = self.bookings.get(operation["booking_id"])
+        if booking is None:
+            raise OperationError("Booking was not found.")
+        return booking
+
+    def reserve(self, kart_id, start, end, booking_id):
+        periods = self.periods.setdefault(kart_id, [])
+        periods[:] = [period for period in periods if period[2] != booking_id]
+        if start is not None:
+            periods.append([start, end, booking_id])
+
+    def pay(self, to_pay, message):
+        to_pay = round(to_pay, 2)
+        if self.balance < to_pay:
+            raise OperationError(message)
+        self.balance -= to_pay
+        return to_pay
+
+    def check_create(self, index, operation):
+        start, end = operation["start"], operation["end"]
+        if start < self.now:
+            raise OperationError("Booking before present time is not possible.")
+        if (end - start).total_seconds()/3600 < 1:
+            raise OperationError("Booking must be 1hr minimum.")
+        kart = self.karts.get(operation["kart_id"])
+        if kart is None:
+            raise OperationError("No such kart id")
+        if not is_free(self.periods.get(kart.id, []), start, end):
+            raise OperationError("This kart is not available during this period.")
+        to_pay = self.pay(booking_price(kart.get_cost(), start, end), "Not enough balance to book.")
+        booking = Booking(start_time=start, end_time=end, kart=kart, user=self.user)
+        self.reserve(kart.id, start, end, ('new', index))
+        return index, operation, booking, to_pay
+
+    def check_update(self, index, operation):
+        booking = self.get_booking(operation)
+        new_start, new_end = operation["start"], operation["end"]
+        if self.now > booking.end_time:
+            raise OperationError("Cannot update a booking from the past.")
+        if self.now < booking.start_time:
+            if new_start < self.now:
+                raise OperationError("New start date is past, update impossible.")
+            new_length = (new_end - new_start).total_seconds()/3600
+            if new_length < 1:
+                raise OperationError("Booking must be at least 1hr.")
+            charged_end = new_end
+        else:
+            # the booking has started, only its end can change and the first hour is not refunded
+            if new_end < self.now:
+                raise OperationError("End date not valid for update, date is past.")
+            new_start = booking.start_time
+            charged_end = max(new_end, new_start + ONE_HOUR)
+        if not is_free(self.periods.get(booking.kart_id, []), new_start, new_end, ignore=booking.id):
+            raise OperationError("The kart is not available during this new period.")
+        hour_cost = booking.kart.get_cost()
+        to_pay = booking_price(hour_cost, new_start, charged_end) - self.payments.get(booking.id, 0)
+        to_pay = self.pay(to_pay, "Balance is not sufficient for this new booking.")
+        # a later delete of the booking in the batch refunds this payment too
+        self.payments[booking.id] = round(self.payments.get(booking.id, 0) + to_pay, 2)
+        booking.start_time, booking.end_time = new_start, new_end
+        self.reserve(booking.kart_id, new_start, new_end, booking.id)
+        return index, operation, booking, to_pay
+
+    def check_delete(self, index, operation):
+        booking = self.get_booking(operation)
+        if self.now > booking.start_time:
+            raise OperationError("Can only delete upcoming bookings.")
+        refund = self.payments.get(booking.id, 0)
+        self.balance += refund
+        del self.bookings[booking.id]
+        self.reserve(booking.kart_id, None, None, booking.id)
+        return index, operation, booking, -refund
+
+    def write(self):
+        entries, deleted = [], {}
+        with sharding.atomic(*{shard_for_kart(booking.kart_id) for index, operation, booking, amount in self.valid}):
+            for index, operation, booking, amount in self.valid:
+                if operation["op"] == 'delete':
+                    # the refund is the payment of the booking as read
+                    booking.claim()
+                    entries.append((-amount, LedgerEntry.REFUND, booking.id))
+                    deleted.setdefault(booking._state.db, []).append(booking.id)
+                    self.results[index] = {"status": "ok", "refund": '$'+str(-amount)}
+                    continue
+                if operation["op"] == 'create':
+                    booking.save()
+                    entries.append((-amount, LedgerEntry.BOOKING, booking.id))
+                else:
+                    booking.save(update_fields=['start_time', 'end_time'])
+                    entries.append((-amount, LedgerEntry.BOOKING_UPDATE, booking.id))
+                self.results[index] = {"status": "ok", "reservation": BookingSerializer(booking).data, "payment": '$'+str(amount)}
+            for alias, booking_ids in deleted.items():
+                bookings_on(alias).filter(id__in=booking_ids).delete()
+            # a single balance update for the whole batch
+            if entries:
+                self.balance = post_entries(self.user, entries, check_balance=True).get_balance()
+        self.payment = round(-sum(amount for amount, reason, booking_ref in entries), 2)
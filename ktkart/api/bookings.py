@@ -0,0 +1,55 @@
+from . import sharding
+from .ledger import post_entries
+from .models import Kart, Booking, LedgerEntry
+from .pricing import booking_price
+from .sharding import busy_kart_ids, shard_for_kart
+
+
+class KartsNotAvailable(Exception):
+    def __init__(self, kart_ids):
+        super().__init__(kart_ids)
+        self.kart_ids = set(kart_ids)
+
+
+def kart_price(kart, start, end):
+    """
+    Price of a booking of the kart, as charged by the booking routes
+    """
+    return round(booking_price(kart.get_cost(), start, end), 2)
+
+
+def lock_karts(kart_ids):
+    """
+    Lock the rows of the karts until the end of the transaction. Every route writing bookings takes
+    this lock before checking that the karts are free, so that two requests cannot book the same period.
+    Karts are locked in id order, requests booking overlapping groups of karts do not deadlock.
+    """
+    list(Kart.objects.select_for_update().filter(id__in=list(kart_ids)).order_by('id').values_list('id', flat=True))
+
+
+def book_karts(user, karts, start, end):
+    """
+    Book the karts for the period and debit the user's balance once for all of them.
+    Raise KartsNotAvailable if some karts are booked during the period, InsufficientBalance
+    if the balance is not enough, and book nothing.
+    Return the new bookings, the total price and the updated Balance.
+    """
+    bookings, entries = [], []
+    karts = list(karts)
+    with sharding.atomic(*[shard_for_kart(kart.id) for kart in karts]):
+        lock_karts(kart.id for kart in karts)
+        taken = set(busy_kart_ids(start, end, [kart.id for kart in karts]))
+        if taken:
+            raise KartsNotAvailable(taken)
+        for kart in karts:
+            new_booking = Booking.objects.create(
+                start_time = start,
+                end_time = end,
+                kart = kart,
+                user = user
+            )
+            bookings.append(new_booking)
+            entries.append((-kart_price(kart, start, end), LedgerEntry.BOOKING, new_booking.id))
+        balance = post_entries(user, entries, check_balance=True)
+    to_pay = round(-sum(amount for amount, reason, booking_ref in entries), 2)
+    return bookings, to_pay, balance
@@ -0,0 +1,188 @@
+import csv
+import io
+import math
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Case, When, Value, F, FloatField
+from validate_email import validate_email
+
+from .models import Balance, LedgerEntry
+from .utils import chunks
+
+BALANCE_UPDATE_MODES = ('set', 'increment')
+# balance of the users created without one, as on registration
+SIGNUP_BALANCE = 5
+
+
+# row of a CSV file which is not valid UTF-8
+UNDECODABLE_ROW = object()
+
+
+def read_csv(stream, header):
+    """
+    Yield the rows of a CSV file object (text or bytes), skipping the header line if there is one.
+    Bytes are decoded as UTF-8 line by line, a row which cannot be decoded is yielded as UNDECODABLE_ROW.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = (line.decode('utf-8', 'surrogateescape') for line in stream)
+    for i, row in enumerate(csv.reader(stream)):
+        if not row or i == 0 and [value.strip().lower() for value in row] == list(header):
+            continue
+        try:
+            for value in row:
+                value.encode('utf-8')
+        except UnicodeEncodeError:
+            # the bytes which could not be decoded were kept as surrogates
+            yield UNDECODABLE_ROW
+            continue
+        yield row
+
+
+def update_balances(rows, mode='set', chunk_size=1000):
+    """
+    Set or increment the balance of many users. `rows` is an iterable of (email, amount).
+    Each chunk of rows is applied with one UPDATE in its own transaction, along with its ledger entries.
+    Return the number of updated balances and the rows that failed, with their line number.
+    """
+    if mode not in BALANCE_UPDATE_MODES:
+        raise ValueError("Mode must be one of {}.".format(", ".join(BALANCE_UPDATE_MODES)))
+    updated, failures = 0, []
+    for chunk in chunks(enumerate(rows, 1), chunk_size):
+        amounts, lines = {}, {}
+        for line, row in chunk:
+            if row is UNDECODABLE_ROW:
+                failures.append({"line": line, "email": None, "error": "Row is not valid UTF-8."})
+                continue
+            try:
+                email, amount = row
+                amount = float(amount)
+                if not isinstance(email, str):
+                    raise ValueError()
+            except (TypeError, ValueError):
+                failures.append({"line": line, "email": None, "error": "Row must be an email and an amount."})
+                continue
+            if not (math.isfinite(amount) and amount >= 0):
+                failures.append({"line": line, "email": email, "error": "Amount must be positive."})
+                continue
+            # the same email twice: the last value is kept, increments add up
+            amounts[email] = amounts.get(email, 0) + amount if mode == 'increment' else amount
+            lines.setdefault(email, []).append(line)
+        with transaction.atomic():
+            balances = Balance.objects.filter(user__email__in=amounts).values_list('user__email', 'id', 'user_id', 'balance')
+            if mode == 'set':
+                # the ledger gets the difference, balances must not change before the update
+                balances = balances.select_for_update()
+            balances = {email: (balance_id, user_id, balance) for email, balance_id, user_id, balance in balances}
+            for email in amounts:
+                if email not in balances:
+                    failures.extend({"line": line, "email": email, "error": "User with provided email not found."} for line in lines[email])
+            if not balances:
+                continue
+            new_values = Case(
+                *[When(id=balance_id, then=Value(amounts[email])) for email, (balance_id, user_id, balance) in balances.items()],
+                output_field=FloatField()
+            )
+            if mode == 'increment':
+                new_values = F('balance') + new_values
+            updated += Balance.objects.filter(id__in=[balance_id for balance_id, user_id, balance in balances.values()]).update(balance=new_values, version=F('version') + 1)
+            LedgerEntry.objects.bulk_create([
+                LedgerEntry(user_id=user_id, amount=amounts[email] - balance if mode == 'set' else amounts[email], reason=LedgerEntry.ADMIN)
+                for email, (balance_id, user_id, balance) in balances.items()
+            ])
+    failures.sort(key=lambda failure: failure["line"])
+    return updated, failures
+
+
+def hash_passwords(passwords, executor=None):
+    """
+    Hashes of the passwords, computed by the processes of `executor` if there is one.
+    Empty passwords give unusable passwords, the user has to reset it.
+    """
+    passwords = [password or None for password in passwords]
+    if executor is None:
+        return [make_password(password) for password in passwords]
+    # a hash takes far longer than sending a password to a process
+    return list(executor.map(make_password, passwords, chunksize=16))
+
+
+def import_users(rows, chunk_size=1000, executor=None):
+    """
+    Create users and their balances from an iterable of (email, password) or (email, password, balance) rows.
+    Emails already used, invalid or repeated are reported, not imported. Each chunk of rows is checked
+    against the existing users with one query and written with a few bulk inserts in its own transaction.
+    Passwords are hashed by the processes of `executor` (see the import_users command), in the calling process without one.
+    Return the number of created users and the rows that failed, with their line number.
+    """
+    created, failures, seen = 0, [], set()
+    for chunk in chunks(enumerate(rows, 1), chunk_size):
+        accounts = {}
+        for line, row in chunk:
+            if row is UNDECODABLE_ROW:
+                failures.append({"line": line, "email": None, "error": "Row is not valid UTF-8."})
+                continue
+            try:
+                email, password, amount = parse_account(row)
+            except (TypeError, ValueError):
+                failures.append({"line": line, "email": None, "error": "Row must be an email, a password and an optional balance."})
+                continue
+            if not validate_email(email):
+                failures.append({"line": line, "email": email, "error": "This email is not a valid one."})
+            elif not (math.isfinite(amount) and amount >= 0):
+                failures.append({"line": line, "email": email, "error": "Balance must be positive."})
+            elif email in seen:
+                failures.append({"line": line, "email": email, "error": "This email is repeated in the file."})
+            else:
+                seen.add(email)
+                accounts[email] = (line, password, amount)
+        if not accounts:
+            continue
+        hashes = dict(zip(accounts, hash_passwords([password for line, password, amount in accounts.values()], executor)))
+        try:
+            created += create_users(accounts, hashes, failures)
+        except IntegrityError:
+            # some of the emails were registered in the meantime, they are now found by the query
+            try:
+                created += create_users(accounts, hashes, failures)
+            except IntegrityError:
+                # registered again between the query and the insert, the rows are reported instead of failing the import
+                failures.extend(
+                    {"line": line, "email": email, "error": "This email was registered during the import, try again."}
+                    for email, (line, password, amount) in accounts.items()
+                )
+    failures.sort(key=lambda failure: failure["line"])
+    return created, failures
+
+
+def parse_account(row):
+    """
+    (email, password, balance) of an import row, raise ValueError if it is not well formed
+    """
+    if not isinstance(row, (list, tuple)) or len(row) not in (2, 3):
+        raise ValueError()
+    email, password = row[0], row[1]
+    if not isinstance(email, str) or not isinstance(password, str):
+        raise ValueError()
+    amount = float(row[2]) if len(row) == 3 and row[2] != '' else SIGNUP_BALANCE
+    return email.strip(), password, amount
+
+
+def create_users(accounts, hashes, failures):
+    """
+    Insert the users of a dict email -> (line, password, balance) which are not registered yet,
+    with their balance and the matching ledger entry
+    """
+    with transaction.atomic():
+        # usernames are the emails, they have a unique index
+        existing = set(User.objects.filter(username__in=accounts).values_list('username', flat=True))
+        new = [email for email in accounts if email not in existing]
+        User.objects.bulk_create([User(username=email, email=email, password=hashes[email]) for email in new])
+        # bulk_create does not give the ids back on every database
+        user_ids = dict(User.objects.filter(username__in=new).values_list('username', 'id'))
+        Balance.objects.bulk_create([Balance(user_id=user_ids[email], balance=accounts[email][2]) for email in new])
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(user_id=user_ids[email], amount=accounts[email][2], reason=LedgerEntry.SIGNUP) for email in new
+        ])
+    failures.extend({"line": accounts[email][0], "email": email, "error": "This email is already used by someone."} for email in existing)
+    return len(new)
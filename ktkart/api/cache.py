@@ -0,0 +1,161 @@
+from datetime import datetime
+from hashlib import md5
+from time import sleep, time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+
+from . import metrics
+
+VERSION_KEY = 'ktkart:version:{}'
+BUCKET_KEY = 'ktkart:availability:bucket:{}'
+AVAILABILITY_KEY = 'ktkart:availability:{}'
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_counters(backend, keys):
+    counters = backend.get_many(keys)
+    for key in keys:
+        if key not in counters:
+            # a counter that was never set or was evicted starts from the current time,
+            # so that it never goes back to a value that was already used
+            backend.add(key, int(time() * 1000), None)
+            counters[key] = backend.get(key)
+    return [counters[key] for key in keys]
+
+
+def bump_counters(backend, keys):
+    for key in keys:
+        try:
+            backend.incr(key)
+        except ValueError:
+            backend.add(key, int(time() * 1000), None)
+
+
+def acquire_lock(backend, key, token, timeout, wait=0, poll_interval=0.001):
+    """
+    Take the lock `key` of the cache backend, holding `token`, for at most `timeout` seconds.
+    Wait up to `wait` seconds for it if it is taken. Return True if the lock was taken.
+    """
+    deadline = time() + wait
+    while not backend.add(key, token, timeout):
+        if time() >= deadline:
+            return False
+        sleep(poll_interval)
+    return True
+
+
+def release_lock(backend, key, token):
+    """
+    Delete the lock if it still holds the token: a holder which ran longer than the lock timeout
+    must not release the lock taken since by someone else. The check and the delete are two cache calls,
+    the lock can only be lost in between if it expires there.
+    """
+    if backend.get(key) == token:
+        backend.delete(key)
+
+
+def get_versions(*names):
+    """
+    Return the current version of each named counter ('bookings', 'karts', 'positions').
+    Counters live in the default cache, which must be shared between workers in production.
+    """
+    return get_counters(cache, [VERSION_KEY.format(name) for name in names])
+
+
+def bump_versions(*names):
+    bump_counters(cache, [VERSION_KEY.format(name) for name in names])
+
+
+def bump_versions_on_commit(*names):
+    """
+    Bump now, and again once the transaction is committed: a reader that got
+    the new version before the commit may have cached data that was not written yet.
+    """
+    bump_versions(*names)
+    transaction.on_commit(lambda: bump_versions(*names))
+
+
+def make_etag(*parts):
+    return quote_etag(md5(repr(parts).encode('utf-8')).hexdigest())
+
+
+def etag_matches(request, etag):
+    """
+    True if the If-None-Match header of the request contains the etag
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return etag in etags or 'W/' + etag in etags or '*' in etags
+
+
+def availability_cache():
+    return caches[getattr(settings, 'KTKART_AVAILABILITY_CACHE', 'availability')]
+
+
+def window_buckets(start, end):
+    """
+    Return the numbers of the time buckets (one hour by default) a period spans,
+    or None if it spans more buckets than we keep track of
+    """
+    size = getattr(settings, 'KTKART_AVAILABILITY_BUCKET_SECONDS', 3600)
+    first = int((start - EPOCH).total_seconds() // size)
+    last = int((end - EPOCH).total_seconds() // size)
+    if last - first >= getattr(settings, 'KTKART_AVAILABILITY_MAX_BUCKETS', 48):
+        return None
+    return range(first, last + 1)
+
+
+def invalidate_availability(start=None, end=None):
+    """
+    Drop the cached availabilities of the windows overlapping the period,
+    or of all windows if no period is given. Each bucket has a generation counter
+    which is part of the cache key of the windows spanning it.
+    """
+    buckets = window_buckets(start, end) if start and end else None
+    if buckets is None:
+        keys = [BUCKET_KEY.format('all')]
+    else:
+        keys = [BUCKET_KEY.format(bucket) for bucket in buckets]
+    bump_counters(availability_cache(), keys)
+
+
+def invalidate_availability_on_commit(start=None, end=None):
+    invalidate_availability(start, end)
+    transaction.on_commit(lambda: invalidate_availability(start, end))
+
+
+def availability_generations(start, end):
+    """
+    Generations of the buckets the window spans, only the one of all windows
+    for windows too long to be cached
+    """
+    keys = [BUCKET_KEY.format('all')] + [BUCKET_KEY.format(bucket) for bucket in window_buckets(start, end) or ()]
+    return get_counters(availability_cache(), keys)
+
+
+def cached_availability(start, end, compute, variant=(), generations=None):
+    """
+    Return the availability of the karts during the window, from the cache if possible.
+    `compute` is called on a miss, or for windows too long to be cached.
+    `variant` tells apart the results of the same window, filtered differently.
+    `generations` are the ones of availability_generations, when the caller already read them.
+    """
+    if window_buckets(start, end) is None:
+        return compute()
+    backend = availability_cache()
+    if generations is None:
+        generations = availability_generations(start, end)
+    key = AVAILABILITY_KEY.format(md5(repr((start, end, variant, get_versions('karts', 'positions'), generations)).encode('utf-8')).hexdigest())
+    data = backend.get(key)
+    if data is not None:
+        metrics.incr('availability_cache_hits')
+        return data
+    metrics.incr('availability_cache_misses')
+    data = compute()
+    backend.set(key, data, getattr(settings, 'KTKART_AVAILABILITY_TIMEOUT', 300))
+    return data
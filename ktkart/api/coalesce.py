@@ -0,0 +1,90 @@
+import threading
+from hashlib import md5
+from time import sleep
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+RESULT_KEY = 'ktkart:singleflight:result:{}'
+LOCK_KEY = 'ktkart:singleflight:lock:{}'
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Run a function once for concurrent calls with the same key: the first caller
+    computes the result, the others wait for it and get the same result.
+    With `shared`, callers of other workers waiting on the same key get it through the cache.
+    The key must include the versions of the data the result is computed from, so that
+    a call made after a write never gets a result computed before it.
+    """
+
+    def __init__(self, shared=False, cache_alias='default', timeout=10, poll_interval=0.01):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = shared
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            metrics.incr('coalesced_requests')
+            if call.done.wait(self.timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # the first call takes too long, do not wait for it any more
+            return func()
+        try:
+            call.result = self.do_shared(key, func) if self.shared else func()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def do_shared(self, key, func):
+        backend = caches[self.cache_alias]
+        digest = md5(repr(key).encode('utf-8')).hexdigest()
+        lock_key, result_key = LOCK_KEY.format(digest), RESULT_KEY.format(digest)
+        waited = 0
+        while not backend.add(lock_key, 1, self.timeout):
+            # another worker is computing it
+            result = backend.get(result_key)
+            if result is not None:
+                metrics.incr('coalesced_requests')
+                return result
+            if waited >= self.timeout:
+                return func()
+            sleep(self.poll_interval)
+            waited += self.poll_interval
+        try:
+            result = func()
+            # only kept for the workers already waiting
+            backend.set(result_key, result, 1)
+            return result
+        finally:
+            backend.delete(lock_key)
+
+
+single_flight = SingleFlight(
+    shared=getattr(settings, 'KTKART_SINGLE_FLIGHT_SHARED', False),
+    cache_alias=getattr(settings, 'KTKART_SINGLE_FLIGHT_CACHE', 'default'),
+)
@@ -0,0 +1,168 @@
+import json
+import queue
+import threading
+from time import time, sleep
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# sent to a subscriber which missed events, it must fetch the availabilities again
+RESET = {"reset": True}
+
+SEQUENCE_KEY = 'ktkart:events:sequence'
+EVENT_KEY = 'ktkart:events:{}'
+
+
+def availability_event(kart_id, old=None, new=None):
+    """
+    Availability change of a kart after a booking write: `old` is freed and `new` is busy,
+    both are (start, end) periods or None
+    """
+    return {
+        "kart": kart_id,
+        "free": [old[0].isoformat(), old[1].isoformat()] if old else None,
+        "busy": [new[0].isoformat(), new[1].isoformat()] if new else None,
+    }
+
+
+class Subscription:
+    def __init__(self, hub, size):
+        self.hub = hub
+        self.events = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        Return the next event, None if there was none during `timeout` seconds,
+        or RESET if events were lost because the subscriber was too slow
+        """
+        if self.overflowed:
+            return RESET
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class LocalHub:
+    """
+    Fan out of the published events to the subscribers of this worker.
+    With several workers, use a hub shared by all of them (CacheHub or one backed by a message broker).
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = Subscription(self, self.queue_size)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+class CacheHub(LocalHub):
+    """
+    Hub shared by the workers through the cache: published events are numbered and stored
+    for `ttl` seconds, a thread of each worker polls them and fans them out locally
+    """
+
+    def __init__(self, queue_size=1000, cache_alias='default', ttl=60, poll_interval=0.2):
+        super().__init__(queue_size)
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.poller = None
+
+    def subscribe(self):
+        with self.lock:
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+        return super().subscribe()
+
+    def publish(self, event):
+        self.cache.add(SEQUENCE_KEY, 0, None)
+        sequence = self.cache.incr(SEQUENCE_KEY)
+        self.cache.set(EVENT_KEY.format(sequence), event, self.ttl)
+
+    def poll(self):
+        last = self.cache.get(SEQUENCE_KEY, 0)
+        while True:
+            sleep(self.poll_interval)
+            current = self.cache.get(SEQUENCE_KEY, 0)
+            if current <= last:
+                continue
+            events = self.cache.get_many([EVENT_KEY.format(sequence) for sequence in range(last + 1, current + 1)])
+            for sequence in range(last + 1, current + 1):
+                # an expired or evicted event is lost for everyone
+                super().publish(events.get(EVENT_KEY.format(sequence), RESET))
+            last = current
+
+
+_hub = None
+_lock = threading.Lock()
+
+
+def get_hub():
+    """
+    The hub of the KTKART_EVENT_HUB setting, a (dotted path, keyword arguments) pair
+    """
+    global _hub
+    if _hub is None:
+        with _lock:
+            if _hub is None:
+                path, kwargs = getattr(settings, 'KTKART_EVENT_HUB', ('ktkart.api.events.LocalHub', {}))
+                _hub = import_string(path)(**kwargs)
+    return _hub
+
+
+def publish_on_commit(event):
+    transaction.on_commit(lambda: get_hub().publish(event))
+
+
+def stream(hub, matches, keepalive=15, max_duration=300):
+    """
+    Server-sent events of the hub, for the events `matches` accepts.
+    A comment is sent every `keepalive` seconds without events. The stream ends after
+    `max_duration` seconds or after a reset, clients reconnect and fetch the availabilities again.
+    """
+    # subscribed once the response is sent: a client gone before that never subscribes,
+    # the subscription of a client gone later is closed with the generator
+    subscription = hub.subscribe()
+    deadline = time() + max_duration
+    try:
+        yield 'retry: 1000\n\n'
+        while time() < deadline:
+            event = subscription.get(min(keepalive, max(deadline - time(), 0)))
+            if event is None:
+                yield ': keepalive\n\n'
+            elif event == RESET:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            elif matches(event):
+                yield 'event: availability\ndata: {}\n\n'.format(json.dumps(event, separators=(',', ':')))
+    finally:
+        subscription.close()
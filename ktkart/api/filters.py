@@ -0,0 +1,36 @@
+from .serializers import KartValuesSerializer
+
+KART_FILTERS = ('type', 'min_cost', 'max_cost', 'bbox', 'ordering', 'fields')
+KART_ORDERINGS = ('id', '-id', 'hourly_cost', '-hourly_cost', 'type', '-type')
+
+
+class InvalidFilter(Exception):
+    pass
+
+
+def kart_filters(params):
+    """
+    Read the kart filters of a request: `type`, `min_cost` and `max_cost`, `bbox` (min_lat,min_lng,max_lat,max_lng),
+    `ordering` and `fields` (comma separated). `params` maps the names to their value or None.
+    Return the queryset filter arguments, the ordering and the fields, raise InvalidFilter if a value is not valid.
+    """
+    filters = {}
+    if params.get('type'):
+        filters['type'] = str(params['type'])
+    try:
+        if params.get('min_cost') not in (None, ''):
+            filters['hourly_cost__gte'] = float(params['min_cost'])
+        if params.get('max_cost') not in (None, ''):
+            filters['hourly_cost__lte'] = float(params['max_cost'])
+        if params.get('bbox'):
+            min_lat, min_lng, max_lat, max_lng = [float(value) for value in str(params['bbox']).split(',')]
+            filters.update(latitude__gte=min_lat, latitude__lte=max_lat, longitude__gte=min_lng, longitude__lte=max_lng)
+    except (TypeError, ValueError):
+        raise InvalidFilter("Costs must be numbers and bbox must be min_lat,min_lng,max_lat,max_lng.")
+    ordering = params.get('ordering') or 'id'
+    if ordering not in KART_ORDERINGS:
+        raise InvalidFilter("Ordering must be one of {}.".format(", ".join(KART_ORDERINGS)))
+    fields = tuple(str(params['fields']).split(',')) if params.get('fields') else KartValuesSerializer.fields
+    if not set(fields) <= set(KartValuesSerializer.fields):
+        raise InvalidFilter("Fields must be among {}.".format(", ".join(KartValuesSerializer.fields)))
+    return filters, ordering, fields
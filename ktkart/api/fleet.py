@@ -0,0 +1,53 @@
+import threading
+
+from .cache import get_versions
+from .models import Kart
+
+FIELDS = ('id', 'type', 'hourly_cost', 'latitude', 'longitude')
+
+
+class Fleet:
+    """
+    In memory copy of the kart table, for the routes that only need kart costs and positions
+    """
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.karts = {row[0]: row for row in rows}
+        # cheapest hourly cost of each kart type
+        self.type_costs = {}
+        for kart_id, kart_type, hourly_cost, latitude, longitude in rows:
+            if kart_type not in self.type_costs or hourly_cost < self.type_costs[kart_type]:
+                self.type_costs[kart_type] = hourly_cost
+
+    def cost(self, kart_id):
+        return self.karts[kart_id][2]
+
+    def move(self, positions):
+        """
+        Update the positions of karts, a dict kart_id -> (lat, lng)
+        """
+        for kart_id, (lat, lng) in positions.items():
+            row = self.karts.get(kart_id)
+            if row is not None:
+                self.karts[kart_id] = row[:3] + (lat, lng)
+
+
+_fleet = None
+_lock = threading.Lock()
+
+
+def get_fleet():
+    """
+    Return the fleet, reloaded from the database only when a kart was written
+    or moved by another worker since the last load
+    """
+    global _fleet
+    version = tuple(get_versions('karts', 'positions'))
+    fleet = _fleet
+    if fleet is None or fleet.version != version:
+        with _lock:
+            if _fleet is None or _fleet.version != version:
+                _fleet = Fleet(version, list(Kart.objects.values_list(*FIELDS)))
+            fleet = _fleet
+    return fleet
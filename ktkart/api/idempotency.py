@@ -0,0 +1,64 @@
+import json
+from functools import wraps
+from hashlib import md5
+from time import time, sleep
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.response import Response
+from rest_framework.views import status
+
+from .cache import release_lock
+
+RESPONSE_KEY = 'ktkart:idempotency:response:{}'
+LOCK_KEY = 'ktkart:idempotency:lock:{}'
+
+
+def idempotent(method):
+    """
+    Decorator of the APIView methods clients retry with an Idempotency-Key header.
+    The first response to a key is stored for KTKART_IDEMPOTENCY_TTL seconds and replayed
+    to the retries sending the same body, a retry arriving while the first request runs waits for it.
+    Keys are scoped to the user and the route.
+    """
+    @wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not idempotency_key:
+            return method(view, request, *args, **kwargs)
+        backend = caches[getattr(settings, 'KTKART_IDEMPOTENCY_CACHE', 'default')]
+        lock_timeout = getattr(settings, 'KTKART_IDEMPOTENCY_LOCK_TIMEOUT', 30)
+        key = md5(repr((request.user.pk, request.path, request.method, idempotency_key)).encode('utf-8')).hexdigest()
+        fingerprint = md5(json.dumps(request.data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        # the lock holds a token of this request, so that it only releases its own lock
+        token = uuid4().hex
+        deadline = time() + lock_timeout
+        while True:
+            stored = backend.get(RESPONSE_KEY.format(key))
+            if stored is not None:
+                return replay(stored, fingerprint)
+            if backend.add(LOCK_KEY.format(key), token, lock_timeout):
+                break
+            # the first request with this key is still running
+            if time() > deadline:
+                return Response(data="A request with this Idempotency-Key is in progress, please retry.", status=status.HTTP_409_CONFLICT)
+            sleep(0.05)
+
+        try:
+            response = method(view, request, *args, **kwargs)
+            # server errors are not stored, the request can be retried
+            if response.status_code < 500:
+                backend.set(RESPONSE_KEY.format(key), (fingerprint, response.status_code, response.data), getattr(settings, 'KTKART_IDEMPOTENCY_TTL', 86400))
+            return response
+        finally:
+            release_lock(backend, LOCK_KEY.format(key), token)
+    return wrapper
+
+
+def replay(stored, fingerprint):
+    stored_fingerprint, status_code, data = stored
+    if stored_fingerprint != fingerprint:
+        return Response(data="This Idempotency-Key was already used with another request.", status=status.HTTP_401_UNAUTHORIZED)
+    return Response(data=data, status=status_code, headers={'Idempotent-Replayed': 'true'})
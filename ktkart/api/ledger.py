@@ -0,0 +1,101 @@
+from django.db import transaction
+from django.db.models import F, Sum
+from django.dispatch import Signal
+
+from .models import Balance, LedgerEntry
+from .utils import chunks
+
+# balances and ledger sums closer than this are considered equal
+TOLERANCE = 0.005
+
+# sent by post_entries with the entries, in the transaction they are written in
+entries_posted = Signal(providing_args=['user', 'entries'])
+
+
+class InsufficientBalance(Exception):
+    pass
+
+
+def open_balance(user, amount, reason=LedgerEntry.SIGNUP):
+    with transaction.atomic():
+        balance = Balance.objects.create(balance=amount, user=user)
+        LedgerEntry.objects.create(user=user, amount=amount, reason=reason)
+    return balance
+
+
+def post_entries(user, entries, check_balance=False):
+    """
+    Append (amount, reason, booking_ref) entries to the user's ledger and add their sum
+    to the materialized balance with a single UPDATE, in the caller's transaction.
+    With check_balance, raise InsufficientBalance instead of making the balance negative.
+    Return the updated Balance.
+    """
+    total = round(sum(amount for amount, reason, booking_ref in entries), 2)
+    with transaction.atomic():
+        balances = Balance.objects.filter(user=user)
+        if check_balance and total < 0:
+            balances = balances.filter(balance__gte=-total)
+        if not balances.update(balance=F('balance') + total, version=F('version') + 1):
+            raise InsufficientBalance()
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(user=user, amount=amount, reason=reason, booking_ref=booking_ref)
+            for amount, reason, booking_ref in entries
+        ])
+        entries_posted.send(sender=LedgerEntry, user=user, entries=entries)
+    return Balance.objects.get(user=user)
+
+
+def post_entry(user, amount, reason, booking_ref=None, check_balance=False):
+    return post_entries(user, [(amount, reason, booking_ref)], check_balance)
+
+
+def booking_payments(booking_ids):
+    """
+    Amount paid for each of the bookings, the sum of its entries (booking, updates and refunds),
+    as a dict booking id -> amount. This is what a cancellation refunds, whatever the current prices.
+    """
+    payments = (
+        LedgerEntry.objects.filter(booking_ref__in=list(booking_ids))
+        .values('booking_ref').annotate(total=Sum('amount')).values_list('booking_ref', 'total')
+    )
+    return {booking_ref: round(-total, 2) for booking_ref, total in payments}
+
+
+def set_balance(user, new_balance, reason=LedgerEntry.ADMIN):
+    """
+    Set the balance to a given value, the ledger gets the difference.
+    Raise StaleVersion if the balance changed between the read and the update.
+    """
+    balance = Balance.objects.get(user=user)
+    with transaction.atomic():
+        amount = new_balance - balance.balance
+        balance.balance = new_balance
+        balance.save(update_fields=['balance'])
+        LedgerEntry.objects.create(user=user, amount=amount, reason=reason)
+    return balance
+
+
+def reconcile(fix=False, chunk_size=1000):
+    """
+    Compare each materialized balance with the sum of the user's ledger entries.
+    Both are read in one transaction, which is a consistent snapshot without locks
+    on MySQL (repeatable read). With fix, wrong balances are set to the ledger sum,
+    unless they changed since they were read.
+    Return the list of (user_id, balance, ledger_sum) that did not match.
+    """
+    mismatches = []
+    with transaction.atomic():
+        user_ids = list(Balance.objects.order_by('user_id').values_list('user_id', flat=True))
+        for chunk in chunks(user_ids, chunk_size):
+            sums = dict(
+                LedgerEntry.objects.filter(user_id__in=chunk)
+                .values('user_id').annotate(total=Sum('amount')).values_list('user_id', 'total')
+            )
+            for user_id, balance in Balance.objects.filter(user_id__in=chunk).values_list('user_id', 'balance'):
+                total = round(sums.get(user_id) or 0, 2)
+                if abs(balance - total) > TOLERANCE:
+                    mismatches.append((user_id, balance, total))
+    if fix:
+        for user_id, balance, total in mismatches:
+            Balance.objects.filter(user_id=user_id, balance=balance).update(balance=total, version=F('version') + 1)
+    return mismatches
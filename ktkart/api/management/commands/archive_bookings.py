@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ktkart.api.archive import archive_finished_bookings
+
+
+class Command(BaseCommand):
+    help = "Move finished bookings to the archive table, in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', default="",
+                            help="Archive bookings ended before this date (%%Y-%%m-%%d %%H:%%M:%%S.%%f), default is now")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0,
+                            help="Seconds to wait between two batches")
+
+    def handle(self, *args, **options):
+        before = datetime.now()
+        if options['before']:
+            try:
+                before = datetime.strptime(options['before'], '%Y-%m-%d %H:%M:%S.%f')
+            except ValueError:
+                raise CommandError("Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f")
+        archived = archive_finished_bookings(before, options['batch_size'], options['pause'])
+        self.stdout.write("Archived {} bookings.".format(archived))
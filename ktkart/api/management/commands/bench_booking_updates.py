@@ -0,0 +1,92 @@
+import threading
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections, transaction
+
+from ktkart.api.models import Kart, Balance, Booking, StaleVersion
+from ktkart.api.sharding import bookings_on, shard_for_kart
+
+
+class Command(BaseCommand):
+    help = ("Compare the throughput of concurrent booking updates with compare and swap saves "
+            "and with select_for_update, on the shard of the bench kart. The rows written are deleted at the end.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--updates', type=int, default=200, help="Updates per thread")
+        parser.add_argument('--bookings', type=int, default=4, help="Bookings updated, fewer means more conflicts")
+
+    def handle(self, *args, **options):
+        self.threads = options['threads']
+        self.updates = options['updates']
+        user = User.objects.create_user(username='bench-booking-updates', email='bench-booking-updates')
+        Balance.objects.create(user=user)
+        kart = Kart.objects.create(type="Bench", hourly_cost=10)
+        # the bookings are on the shard of the kart
+        self.shard = shard_for_kart(kart.id)
+        start = datetime.now() + timedelta(days=365)
+        try:
+            self.booking_ids = [
+                Booking.objects.create(start_time=start + timedelta(hours=2*i), end_time=start + timedelta(hours=2*i+1), user=user, kart=kart).id
+                for i in range(options['bookings'])
+            ]
+            self.stdout.write("{} threads, {} updates each, {} bookings".format(self.threads, self.updates, len(self.booking_ids)))
+            self.measure("compare and swap", self.update_optimistic)
+            self.measure("select_for_update", self.update_locking)
+        finally:
+            bookings_on(self.shard).filter(kart=kart).delete()
+            kart.delete()
+            user.delete()
+
+    def update_optimistic(self, booking_id, minutes):
+        """
+        Read, change and save, from the read again on conflict. Return the number of conflicts.
+        """
+        conflicts = 0
+        while True:
+            booking = bookings_on(self.shard).get(id=booking_id)
+            booking.end_time = booking.start_time + timedelta(minutes=minutes)
+            try:
+                booking.save(update_fields=['end_time'])
+                return conflicts
+            except StaleVersion:
+                conflicts += 1
+
+    def update_locking(self, booking_id, minutes):
+        with transaction.atomic(using=self.shard):
+            booking = bookings_on(self.shard).select_for_update().get(id=booking_id)
+            booking.end_time = booking.start_time + timedelta(minutes=minutes)
+            booking.save(update_fields=['end_time'])
+        return 0
+
+    def measure(self, name, update):
+        conflicts, errors = [], []
+
+        def run(seed):
+            random = Random(seed)
+            total, failed = 0, 0
+            try:
+                for i in range(self.updates):
+                    try:
+                        total += update(random.choice(self.booking_ids), random.randint(60, 119))
+                    except DatabaseError:
+                        # lock wait timeouts and deadlocks, SQLite fails here instead of waiting
+                        failed += 1
+            finally:
+                # the booking shard and the default database (rollups of the saves)
+                connections.close_all()
+            conflicts.append(total)
+            errors.append(failed)
+        threads = [threading.Thread(target=run, args=(seed,)) for seed in range(self.threads)]
+        begin = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - begin
+        done = self.threads * self.updates - sum(errors)
+        self.stdout.write("{:<20}{:>10.0f} updates/s{:>8} conflicts{:>8} errors".format(name, done / elapsed, sum(conflicts), sum(errors)))
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from ktkart.api.models import Kart, Booking
+from ktkart.api.renderers import FastJSONRenderer, ColumnarJSONRenderer, MessagePackRenderer, orjson, msgpack
+from ktkart.api.serializers import KartSerializer, BookingSerializer, KartValuesSerializer, BookingValuesSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare the per row cost of the model serializers, the values serializers and the JSON renderers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        self.repeat = options['repeat']
+        start = datetime(2019, 2, 27, 10, 0, 0, 123456)
+
+        # in memory rows, the database is not part of the measure
+        karts = [Kart(id=i, type="Standard", hourly_cost=10, latitude=48.5+i/rows, longitude=2.5-i/rows) for i in range(rows)]
+        kart_tuples = [(k.id, k.type, k.hourly_cost, k.latitude, k.longitude) for k in karts]
+        bookings = [Booking(id=i, start_time=start+timedelta(hours=i), end_time=start+timedelta(hours=i+1), user_id=1, kart_id=i) for i in range(rows)]
+        booking_tuples = [(b.id, b.start_time, b.end_time, b.user_id, b.kart_id) for b in bookings]
+
+        self.stdout.write("{} rows, best of {}, in microseconds per row".format(rows, self.repeat))
+        kart_data = self.measure("KartSerializer", rows, lambda: KartSerializer(karts, many=True).data)
+        self.measure("KartValuesSerializer", rows, lambda: KartValuesSerializer(kart_tuples).data)
+        booking_data = self.measure("BookingSerializer", rows, lambda: BookingSerializer(bookings, many=True).data)
+        self.measure("BookingValuesSerializer", rows, lambda: BookingValuesSerializer(booking_tuples).data)
+
+        if orjson is None:
+            self.stdout.write("orjson is not installed, FastJSONRenderer falls back to JSONRenderer")
+        for name, data in (("karts", kart_data), ("bookings", booking_data)):
+            self.measure("JSONRenderer ({})".format(name), rows, lambda: JSONRenderer().render(data))
+            self.measure("FastJSONRenderer ({})".format(name), rows, lambda: FastJSONRenderer().render(data))
+            self.measure("ColumnarJSONRenderer ({})".format(name), rows, lambda: ColumnarJSONRenderer().render(data))
+            if msgpack is not None:
+                self.measure("MessagePackRenderer ({})".format(name), rows, lambda: MessagePackRenderer().render(data))
+        # bytes sent per row by each format
+        for renderer in (FastJSONRenderer(), ColumnarJSONRenderer()) + ((MessagePackRenderer(),) if msgpack is not None else ()):
+            self.stdout.write("{:<32}{:>10.1f} bytes per kart".format(type(renderer).__name__, len(renderer.render(kart_data)) / rows))
+
+    def measure(self, name, rows, func):
+        best = None
+        for i in range(self.repeat):
+            begin = perf_counter()
+            result = func()
+            elapsed = perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        self.stdout.write("{:<32}{:>10.3f}".format(name, best * 1e6 / rows))
+        return result
@@ -0,0 +1,42 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ktkart.api.bulk import import_users, read_csv
+
+
+class Command(BaseCommand):
+    help = "Create users and their balances from a CSV file of email,password[,balance] lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="CSV file, - to read from the standard input")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of lines written in each transaction")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Processes hashing the passwords, one per CPU by default, 0 for none")
+
+    def handle(self, *args, **options):
+        if options['file'] == '-':
+            created, failures = self.load(sys.stdin.buffer, options)
+        else:
+            try:
+                with open(options['file'], 'rb') as stream:
+                    created, failures = self.load(stream, options)
+            except OSError as error:
+                raise CommandError(error)
+        for failure in failures:
+            self.stderr.write("Line {}: {} {}".format(failure["line"], failure["email"] or "", failure["error"]))
+        self.stdout.write("Created {} users, {} lines failed.".format(created, len(failures)))
+
+    def load(self, stream, options):
+        rows = read_csv(stream, ('email', 'password', 'balance'))
+        processes = options['processes']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 0:
+            return import_users(rows, options['chunk_size'])
+        # one pool for the whole file, the passwords of each chunk are hashed in parallel
+        with ProcessPoolExecutor(processes) as executor:
+            return import_users(rows, options['chunk_size'], executor)
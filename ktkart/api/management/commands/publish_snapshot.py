@@ -0,0 +1,26 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from ktkart.api.cache import get_versions
+from ktkart.api.snapshot import VERSIONS, publish_snapshot
+
+
+class Command(BaseCommand):
+    help = "Publish the shared memory snapshot of the karts and their bookings, read by all workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and publish a new snapshot when the data changed, checking every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        published = None
+        while True:
+            versions = get_versions(*VERSIONS)
+            if versions != published:
+                karts, intervals = publish_snapshot()
+                published = versions
+                self.stdout.write("Published {} karts and {} busy intervals.".format(karts, intervals))
+            if not options['interval']:
+                return
+            sleep(options['interval'])
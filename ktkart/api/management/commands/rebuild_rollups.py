@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ktkart.api.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the per kart and per day usage rollups from the bookings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default="",
+                            help="Only recompute the days from this one (%%Y-%%m-%%d), default is all days")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("Date format not respected. Must be %Y-%m-%d")
+        rows = rebuild_rollups(since, options['chunk_size'])
+        self.stdout.write("Wrote {} rollups.".format(rows))
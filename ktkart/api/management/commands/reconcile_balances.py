@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ktkart.api.ledger import reconcile
+
+
+class Command(BaseCommand):
+    help = "Check that each balance is the sum of the user's ledger entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help="Set wrong balances to the sum of the ledger entries")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        mismatches = reconcile(options['fix'], options['chunk_size'])
+        for user_id, balance, total in mismatches:
+            self.stdout.write("User {}: balance {} but ledger sum {}".format(user_id, balance, total))
+        self.stdout.write("{} balances {}.".format(len(mismatches), "fixed" if options['fix'] else "do not match"))
@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from ktkart.api.availability import MIN_BOOKING, refresh_next_free
+from ktkart.api.models import Kart
+from ktkart.api.utils import chunks
+
+
+class Command(BaseCommand):
+    help = "Update the next free period of the karts whose free period is about to become too short to book"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Update all karts, for instance after migrating")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        now = datetime.now()
+        karts = Kart.objects.order_by('id')
+        if not options['all']:
+            # less than a booking left before the end of the free period
+            karts = karts.filter(free_until__lte=now + MIN_BOOKING)
+        kart_ids = list(karts.values_list('id', flat=True))
+        for chunk in chunks(kart_ids, options['chunk_size']):
+            refresh_next_free(chunk, now)
+        self.stdout.write("Updated {} karts.".format(len(kart_ids)))
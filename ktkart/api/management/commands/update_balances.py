@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ktkart.api.bulk import BALANCE_UPDATE_MODES, read_csv, update_balances
+
+
+class Command(BaseCommand):
+    help = "Set or increment balances from a CSV file of email,amount lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="CSV file, - to read from the standard input")
+        parser.add_argument('--mode', choices=BALANCE_UPDATE_MODES, default='set')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of lines applied in each transaction")
+
+    def handle(self, *args, **options):
+        if options['file'] == '-':
+            updated, failures = self.update(sys.stdin.buffer, options)
+        else:
+            try:
+                with open(options['file'], 'rb') as stream:
+                    updated, failures = self.update(stream, options)
+            except OSError as error:
+                raise CommandError(error)
+        for failure in failures:
+            self.stderr.write("Line {}: {} {}".format(failure["line"], failure["email"] or "", failure["error"]))
+        self.stdout.write("Updated {} balances, {} lines failed.".format(updated, len(failures)))
+
+    def update(self, stream, options):
+        return update_balances(read_csv(stream, ('email', 'amount')), options['mode'], options['chunk_size'])
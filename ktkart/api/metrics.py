@@ -0,0 +1,65 @@
+from time import time
+
+from django.core.cache import cache
+from rest_framework.settings import api_settings
+
+METRIC_KEY = 'ktkart:metrics:{}'
+RATE_KEY = 'ktkart:metrics:{}:{}'
+
+# counters reported by the metrics/ route
+COUNTERS = [
+    'availability_cache_hits',
+    'availability_cache_misses',
+    'coalesced_requests',
+    'telemetry_reports',
+    'telemetry_writes',
+    'throttled_requests',
+]
+
+# per second rates reported by the metrics/ route, as (name, counter), over the last full minute
+RATES = [
+    ('telemetry_reports_per_second', 'telemetry_reports'),
+]
+
+# ratios reported by the metrics/ route, as (name, numerator, other counters of the total)
+RATIOS = [
+    ('availability_cache_hit_ratio', 'availability_cache_hits', ['availability_cache_misses']),
+]
+
+
+def incr(name, delta=1):
+    """
+    Increment a counter, counters live in the default cache so that all workers share them
+    """
+    key = METRIC_KEY.format(name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+def incr_rate(name, delta=1):
+    """
+    Increment the counter of the current minute of a rate
+    """
+    key = RATE_KEY.format(name, int(time() // 60))
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, 120):
+            cache.incr(key, delta)
+
+
+def get_metrics():
+    # throttle rejections are also counted by scope
+    counters = COUNTERS + ['throttled_{}'.format(scope) for scope in sorted(api_settings.DEFAULT_THROTTLE_RATES)]
+    values = cache.get_many([METRIC_KEY.format(name) for name in counters])
+    metrics = {name: values.get(METRIC_KEY.format(name), 0) for name in counters}
+    for name, numerator, others in RATIOS:
+        total = metrics[numerator] + sum(metrics[other] for other in others)
+        metrics[name] = round(metrics[numerator] / total, 4) if total else None
+    last_minute = int(time() // 60) - 1
+    for name, counter in RATES:
+        metrics[name] = round(cache.get(RATE_KEY.format(counter, last_minute), 0) / 60, 2)
+    return metrics
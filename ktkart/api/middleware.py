@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def accepted_encodings(header):
+    """
+    Content codings of an Accept-Encoding header, without the ones refused with q=0
+    """
+    encodings = set()
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        try:
+            quality = float(next((param[2:] for param in params if param.startswith('q=')), 1))
+        except ValueError:
+            continue
+        if coding and quality > 0:
+            encodings.add(coding.lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    """
+    Compress the responses larger than KTKART_COMPRESSION_MIN_BYTES, with brotli when
+    it is installed and accepted by the client, with gzip otherwise.
+    Streaming responses (availability events) are sent as they are produced.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < getattr(settings, 'KTKART_COMPRESSION_MIN_BYTES', 1024):
+            return response
+        encodings = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in encodings:
+            content = brotli.compress(response.content, quality=getattr(settings, 'KTKART_BROTLI_QUALITY', 5))
+            encoding = 'br'
+        elif 'gzip' in encodings:
+            content = compress_string(response.content)
+            encoding = 'gzip'
+        else:
+            return response
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        # the compressed bytes differ from the ones the strong ETag was computed for
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
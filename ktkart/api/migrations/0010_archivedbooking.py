@@ -0,0 +1,38 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0009_auto_20190227_1519'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedBooking',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['end_time'], name='api_booking_end_tim_a76e11_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedbooking',
+            name='kart',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.Kart'),
+        ),
+        migrations.AddField(
+            model_name='archivedbooking',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
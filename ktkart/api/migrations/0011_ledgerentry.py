@@ -0,0 +1,40 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ledgers(apps, schema_editor):
+    """
+    Start each user's ledger with the balance they have
+    """
+    Balance = apps.get_model('api', 'Balance')
+    LedgerEntry = apps.get_model('api', 'LedgerEntry')
+    LedgerEntry.objects.bulk_create(
+        [LedgerEntry(user_id=user_id, amount=balance, reason='opening') for user_id, balance in Balance.objects.values_list('user_id', 'balance')],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0010_archivedbooking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField()),
+                ('reason', models.CharField(choices=[('opening', 'Balance before the ledger'), ('signup', 'Sign up credit'), ('booking', 'Booking'), ('booking_update', 'Booking update'), ('refund', 'Booking refund'), ('admin', 'Admin change')], max_length=20)),
+                ('booking_ref', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kart',
+            index=models.Index(fields=['type', 'hourly_cost'], name='api_kart_type_37f657_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kart',
+            index=models.Index(fields=['hourly_cost'], name='api_kart_hourly__dc1906_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kart',
+            index=models.Index(fields=['latitude', 'longitude'], name='api_kart_latitud_731d9b_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_kart_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KartDailyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('booked_hours', models.FloatField(default=0.0)),
+                ('revenue', models.FloatField(default=0.0)),
+                ('kart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.Kart')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='kartdailyusage',
+            index=models.Index(fields=['day'], name='api_kartdai_day_3763bc_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='kartdailyusage',
+            unique_together={('kart', 'day')},
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:56
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+
+# shortest free period, as MIN_BOOKING in availability.py
+MIN_BOOKING = timedelta(hours=1)
+
+
+def backfill_next_free(apps, schema_editor):
+    """
+    Next free period of each kart from its upcoming bookings, as refresh_next_free computes it.
+    Without it every kart would be taken as free until its next booking write.
+    """
+    Kart = apps.get_model('api', 'Kart')
+    Booking = apps.get_model('api', 'Booking')
+    alias = schema_editor.connection.alias
+    now = datetime.now()
+    periods = defaultdict(list)
+    bookings = Booking.objects.using(alias).filter(end_time__gte=now).order_by('start_time')
+    for kart_id, start, end in bookings.values_list('kart_id', 'start_time', 'end_time').iterator():
+        periods[kart_id].append((start, end))
+    for kart_id in Kart.objects.using(alias).values_list('id', flat=True):
+        free_at, free_until = now, None
+        for start, end in periods[kart_id]:
+            if start - free_at > MIN_BOOKING:
+                free_until = start
+                break
+            free_at = max(free_at, end)
+        Kart.objects.using(alias).filter(id=kart_id).update(next_free_at=free_at, free_until=free_until)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_kartdailyusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kart',
+            name='free_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='kart',
+            name='next_free_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_next_free, migrations.RunPython.noop),
+    ]
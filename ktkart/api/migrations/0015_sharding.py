@@ -0,0 +1,31 @@
+# Generated by Django 2.1.7 on 2026-10-19 07:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_kart_next_free'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingId',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='booking',
+            name='kart',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='api.Kart'),
+        ),
+        migrations.AlterField(
+            model_name='booking',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-19 08:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_sharding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balance',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.7 on 2026-10-19 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_versions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedbooking',
+            index=models.Index(fields=['end_time'], name='api_archive_end_tim_8acb67_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['start_time'], name='api_booking_start_t_9a2a28_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['created_at'], name='api_ledgere_created_814172_idx'),
+        ),
+    ]
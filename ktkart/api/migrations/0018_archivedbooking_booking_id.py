@@ -0,0 +1,35 @@
+# Generated by Django 2.1.7 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+def copy_booking_ids(apps, schema_editor):
+    # the rows archived so far kept the id of the booking
+    ArchivedBooking = apps.get_model('api', 'ArchivedBooking')
+    ArchivedBooking.objects.using(schema_editor.connection.alias).update(booking_id=models.F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedbooking',
+            name='booking_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.RunPython(copy_booking_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='archivedbooking',
+            name='booking_id',
+            field=models.IntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedbooking',
+            name='id',
+            field=models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+    ]
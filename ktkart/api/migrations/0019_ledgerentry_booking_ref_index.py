@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2026-10-19 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_archivedbooking_booking_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['booking_ref'], name='api_ledgere_booking_3c4238_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-19 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_ledgerentry_booking_ref_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookingid',
+            name='token',
+            field=models.CharField(db_index=True, default='', max_length=32),
+        ),
+    ]
@@ -1,17 +1,69 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models import F
+
+
+class StaleVersion(Exception):
+    """
+    The row was changed or deleted by another request since it was read
+    """
+
+
+class VersionedModel(models.Model):
+    """
+    Model saved with compare and swap: an update only applies if the row still has the version
+    it was read with, and increments it. Concurrent writers do not lock the row between
+    their read and their write, the late one gets StaleVersion and can retry from the read.
+    """
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if self._state.adding:
+            # a new row with its id already set (sharded bookings), nothing to compare with
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        version_field = self._meta.get_field('version')
+        values = [value for value in values if value[0] is not version_field] + [(version_field, None, self.version + 1)]
+        if not super()._do_update(base_qs.filter(version=self.version), using, pk_val, values, update_fields, forced_update):
+            raise StaleVersion()
+        self.version += 1
+        return True
+
+    def claim(self):
+        """
+        Compare and swap of the version alone, before deleting the row or writing
+        something computed from it, in the same transaction
+        """
+        rows = type(self)._base_manager.using(self._state.db).filter(pk=self.pk, version=self.version)
+        if not rows.update(version=F('version') + 1):
+            raise StaleVersion()
+        self.version += 1
+
 
 class Kart(models.Model):
     type = models.CharField(max_length=50)
     hourly_cost = models.PositiveSmallIntegerField()
     latitude = models.FloatField(default=0.0)
     longitude = models.FloatField(default=0.0)
+    # next free period of at least one hour, kept up to date on booking writes
+    next_free_at = models.DateTimeField(null=True, blank=True)
+    free_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # used by the available_karts/ filters
+        indexes = [
+            models.Index(fields=['type', 'hourly_cost']),
+            models.Index(fields=['hourly_cost']),
+            models.Index(fields=['latitude', 'longitude']),
+        ]
 
     def get_cost(self):
         return self.hourly_cost
 
 
-class Balance(models.Model):
+class Balance(VersionedModel):
     balance = models.FloatField(default=0.0)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
@@ -19,11 +71,109 @@ class Balance(models.Model):
         return self.balance
 
 
-class Booking(models.Model):
+class LedgerEntry(models.Model):
+    """
+    Append only history of the balance changes, the Balance row holds the sum of the user's entries
+    """
+    OPENING = 'opening'
+    SIGNUP = 'signup'
+    BOOKING = 'booking'
+    BOOKING_UPDATE = 'booking_update'
+    REFUND = 'refund'
+    ADMIN = 'admin'
+    REASONS = (
+        (OPENING, 'Balance before the ledger'),
+        (SIGNUP, 'Sign up credit'),
+        (BOOKING, 'Booking'),
+        (BOOKING_UPDATE, 'Booking update'),
+        (REFUND, 'Booking refund'),
+        (ADMIN, 'Admin change'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    amount = models.FloatField()
+    reason = models.CharField(max_length=20, choices=REASONS)
+    # id of the booking, kept when the booking is deleted or archived
+    booking_ref = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # admin date hierarchy, amounts paid for a booking
+        indexes = [models.Index(fields=['created_at']), models.Index(fields=['booking_ref'])]
+
+
+class BookingQuerySet(models.QuerySet):
+
+    def create(self, **kwargs):
+        booking = self.model(**kwargs)
+        # without a database given, the router saves the booking on the shard of its kart
+        booking.save(force_insert=True, using=self._db)
+        return booking
+
+
+class Booking(VersionedModel):
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    # bookings may live on another database than users and karts (KTKART_BOOKING_SHARDS),
+    # the API checks the references instead of the database
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    kart = models.ForeignKey(Kart, on_delete=models.CASCADE, db_constraint=False)
+
+    objects = BookingQuerySet.as_manager()
+
+    class Meta:
+        # used by the archiving job to find finished bookings, and by the admin date hierarchy
+        indexes = [models.Index(fields=['end_time']), models.Index(fields=['start_time'])]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the period as loaded, the caches of the old period are dropped when it is updated
+        instance.loaded_period = (instance.__dict__.get('start_time'), instance.__dict__.get('end_time'))
+        return instance
+
+    def get_lenght(self):
+        return (self.end_time - self.start_time).total_seconds()/3600
+
+
+class ArchivedBooking(models.Model):
+    """
+    Finished bookings moved out of the Booking table by the archive_bookings command.
+    booking_id is the id the booking had in the Booking table, the archive has its own ids
+    since the ids of deleted bookings can be given again to new bookings.
+    """
+    booking_id = models.IntegerField(db_index=True)
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     kart = models.ForeignKey(Kart, on_delete=models.CASCADE)
 
+    class Meta:
+        # admin date hierarchy
+        indexes = [models.Index(fields=['end_time'])]
+
     def get_lenght(self):
         return (self.end_time - self.start_time).total_seconds()/3600
+
+
+class KartDailyUsage(models.Model):
+    """
+    Hours booked and revenue of a kart on a day, kept up to date on each booking write.
+    A booking over several days counts in each of them, its price split by hours.
+    """
+    kart = models.ForeignKey(Kart, on_delete=models.CASCADE)
+    day = models.DateField()
+    booked_hours = models.FloatField(default=0.0)
+    revenue = models.FloatField(default=0.0)
+
+    class Meta:
+        unique_together = ('kart', 'day')
+        indexes = [models.Index(fields=['day'])]
+
+
+class BookingId(models.Model):
+    """
+    Sequence of the booking ids when bookings are sharded, each shard having its own auto increment
+    """
+    # the rows inserted together, to read their ids back
+    token = models.CharField(max_length=32, db_index=True, default='')
@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+ONE_HOUR = timedelta(hours=1)
+
+
+class PricingRule:
+    """
+    Base class of the pricing rules. Rules are applied in order to the prices of
+    many bookings at once, each rule gets the prices computed by the previous ones.
+    """
+
+    def apply(self, prices, costs, starts, ends):
+        return prices
+
+
+class PeakHoursRule(PricingRule):
+    """
+    The part of a booking during peak hours costs `multiplier` times the hourly cost
+    """
+
+    def __init__(self, hours=(18, 19, 20, 21), multiplier=1.5):
+        self.hours = set(hours)
+        self.multiplier = multiplier
+
+    def apply(self, prices, costs, starts, ends):
+        return [
+            price + self.peak_hours(start, end) * cost * (self.multiplier - 1)
+            for price, cost, start, end in zip(prices, costs, starts, ends)
+        ]
+
+    def peak_hours(self, start, end):
+        hours, current = 0, start
+        while current < end:
+            step = min(current.replace(minute=0, second=0, microsecond=0) + ONE_HOUR, end)
+            if current.hour in self.hours:
+                hours += (step - current).total_seconds()/3600
+            current = step
+        return hours
+
+
+class DurationDiscountRule(PricingRule):
+    """
+    Bookings of at least `min_hours` get a `discount` (0.1 is 10%)
+    """
+
+    def __init__(self, min_hours=4, discount=0.1):
+        self.min_hours = min_hours
+        self.discount = discount
+
+    def apply(self, prices, costs, starts, ends):
+        return [
+            price * (1 - self.discount) if (end - start).total_seconds()/3600 >= self.min_hours else price
+            for price, start, end in zip(prices, starts, ends)
+        ]
+
+
+_rules = None
+
+
+def get_rules():
+    """
+    Rules of the KTKART_PRICING_RULES setting, a list of (dotted path, keyword arguments)
+    """
+    global _rules
+    if _rules is None:
+        _rules = [import_string(path)(**kwargs) for path, kwargs in getattr(settings, 'KTKART_PRICING_RULES', [])]
+    return _rules
+
+
+@receiver(setting_changed)
+def reset_rules(setting, **kwargs):
+    global _rules
+    if setting == 'KTKART_PRICING_RULES':
+        _rules = None
+
+
+def booking_prices(costs, starts, ends):
+    """
+    Prices of many bookings from their kart hourly costs and periods, not rounded.
+    Without rules, a booking costs its length in hours times the hourly cost.
+    """
+    prices = [(end - start).total_seconds()/3600 * cost for cost, start, end in zip(costs, starts, ends)]
+    for rule in get_rules():
+        prices = rule.apply(prices, costs, starts, ends)
+    return prices
+
+
+def booking_price(cost, start, end):
+    return booking_prices([cost], [start], [end])[0]
@@ -0,0 +1,132 @@
+import json
+import re
+
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# orjson and json do not write very small and very large floats the same way
+# (1e-05 / 0.00001, 1e+16 / 1e16), we go back to json when the output may contain one.
+# Starting the pattern with a literal keeps the search fast.
+FLOAT_EXPONENT = re.compile(rb'e[-\d]')
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Same output as the DRF JSONRenderer, but uses orjson when it is installed.
+    Falls back to the DRF JSONRenderer for indented output (browsable API),
+    non default JSON settings and data orjson cannot write the same way.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        if orjson is None or not (self.compact and not self.ensure_ascii and self.strict) \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            # datetimes are handed to the DRF encoder, orjson does not truncate microseconds
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except (TypeError, ValueError):
+            # non string keys, integers over 64 bits, ...
+            return super().render(data, accepted_media_type, renderer_context)
+        if b'0.0000' in ret or FLOAT_EXPONENT.search(ret) or b'null' in ret and self._has_nan(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace('\u2028'.encode('utf-8'), b'\\u2028').replace('\u2029'.encode('utf-8'), b'\\u2029')
+
+    def _has_nan(self, data):
+        # orjson writes NaN and Infinity as null where json refuses them
+        if isinstance(data, float):
+            return data != data or data in (float('inf'), float('-inf'))
+        if isinstance(data, dict):
+            return any(self._has_nan(value) for value in data.values())
+        if isinstance(data, (list, tuple)):
+            return any(self._has_nan(value) for value in data)
+        return False
+
+
+def to_columns(data):
+    """
+    Columnar form of the lists of rows: a list of dicts with the same keys becomes a dict of
+    key -> list of values, in the same order. Lists inside a dict are converted too, other values are kept.
+    """
+    if isinstance(data, dict):
+        return {key: to_columns(value) for key, value in data.items()}
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        keys = data[0].keys()
+        if all(isinstance(row, dict) and row.keys() == keys for row in data):
+            return {key: [row[key] for row in data] for key in keys}
+    return data
+
+
+class ColumnarJSONRenderer(FastJSONRenderer):
+    """
+    JSON with the lists of rows in columnar form (see to_columns), the field names are written once
+    instead of once per row. Clients ask for it with `Accept: application/json; format=columns`
+    or the ?format=columns query parameter, plain application/json stays in rows.
+    """
+    media_type = 'application/json; format=columns'
+    format = 'columns'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(to_columns(data), accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack encoding of the same data as the JSON renderers, available when msgpack is installed.
+    Datetimes and decimals are written as the strings of the JSON output.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        return msgpack.packb(data, default=JSONEncoder().default, use_bin_type=True)
+
+
+class InstalledRenderersNegotiation(DefaultContentNegotiation):
+    """
+    Content negotiation leaving out the renderers whose library is not installed,
+    clients accepting only them get a 406 response.
+    Renderers with media type parameters are tried first: application/json would otherwise
+    match an `Accept: application/json; format=columns` header. A format given in the
+    ?format= query parameter is used whatever the Accept header.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        renderers = [renderer for renderer in renderers if getattr(renderer, 'available', True)]
+        format = format_suffix or request.query_params.get(self.settings.URL_FORMAT_OVERRIDE)
+        if format:
+            renderer = self.filter_renderers(renderers, format)[0]
+            return renderer, renderer.media_type
+        renderers.sort(key=lambda renderer: ';' not in renderer.media_type)
+        return super().select_renderer(request, renderers, format_suffix)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets clients accept text/event-stream, the events themselves are written by a streaming response
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        return 'event: error\ndata: {}\n\n'.format(json.dumps(data, separators=(',', ':'))).encode('utf-8')
@@ -0,0 +1,145 @@
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from .ledger import booking_payments
+from .models import ArchivedBooking, KartDailyUsage
+from .sharding import booking_shards, bookings_on, scatter
+from .utils import chunks
+
+
+def daily_hours(start, end):
+    """
+    Split a period by day, return (day, hours) pairs
+    """
+    parts, day = [], start.date()
+    while True:
+        next_day = datetime.combine(day + timedelta(days=1), time.min)
+        part_start = max(start, datetime.combine(day, time.min))
+        parts.append((day, (min(end, next_day) - part_start).total_seconds()/3600))
+        if end <= next_day:
+            return parts
+        day += timedelta(days=1)
+
+
+def add_usage(usage, kart_id, start, end, price, sign=1, hours=True):
+    """
+    Add the hours and price of a booking, split by day, to a dict (kart_id, day) -> [hours, revenue].
+    Without `hours`, only the price is added.
+    """
+    length = (end - start).total_seconds()/3600
+    for day, day_hours in daily_hours(start, end):
+        totals = usage.setdefault((kart_id, day), [0, 0])
+        if hours:
+            totals[0] += sign * day_hours
+        totals[1] += sign * (price * day_hours / length if length else 0)
+
+
+def record_booking(kart_id, old=None, new=None, booking_id=None):
+    """
+    Update the rollups after a booking write, in the caller's transaction.
+    `old` and `new` are the (start, end) periods before and after the write, None when it is created or deleted.
+    The hours move from the old period to the new one, and so does the revenue paid for the booking until now.
+    The payment of the write itself is recorded by record_payments when its ledger entry is posted.
+    """
+    paid = 0
+    if old and booking_id is not None:
+        paid = booking_payments([booking_id]).get(booking_id, 0)
+    usage = {}
+    for period, sign in ((old, -1), (new, 1)):
+        if period:
+            add_usage(usage, kart_id, period[0], period[1], paid, sign)
+    write_usage(usage)
+
+
+def record_payments(entries):
+    """
+    Add the revenue of ledger entries, (amount, reason, booking_ref), to the rollups of the days of
+    their bookings, in the caller's transaction. Entries of bookings already deleted are left out,
+    the revenue of a booking is taken out of the rollups when it is deleted.
+    """
+    amounts = {}
+    for amount, reason, booking_ref in entries:
+        if booking_ref is not None:
+            amounts[booking_ref] = amounts.get(booking_ref, 0) - amount
+    if not amounts:
+        return
+    bookings = sum(scatter(lambda alias: list(
+        bookings_on(alias).filter(id__in=list(amounts)).values_list('id', 'kart_id', 'start_time', 'end_time')
+    )), [])
+    usage = {}
+    for booking_id, kart_id, start, end in bookings:
+        add_usage(usage, kart_id, start, end, amounts[booking_id], hours=False)
+    write_usage(usage)
+
+
+def write_usage(usage):
+    """
+    Add a dict (kart_id, day) -> [hours, revenue] to the rollups
+    """
+    with transaction.atomic():
+        for (kart_id, day), (hours, revenue) in sorted(usage.items()):
+            if abs(hours) < 1e-9 and abs(revenue) < 1e-9:
+                continue
+            rows = KartDailyUsage.objects.filter(kart_id=kart_id, day=day)
+            if rows.update(booked_hours=F('booked_hours') + hours, revenue=F('revenue') + revenue):
+                continue
+            try:
+                with transaction.atomic():
+                    KartDailyUsage.objects.create(kart_id=kart_id, day=day, booked_hours=hours, revenue=revenue)
+            except IntegrityError:
+                # created by a concurrent booking in the meantime
+                rows.update(booked_hours=F('booked_hours') + hours, revenue=F('revenue') + revenue)
+
+
+def rebuild_rollups(since=None, chunk_size=1000):
+    """
+    Recompute the rollups from the current and archived bookings, all of them or from the day `since`.
+    The revenue of each booking is what was paid for it, the sum of its ledger entries.
+    Return the number of rollup rows written.
+    """
+    usage = {}
+    # archived bookings are found in the ledger by the id they had in the Booking table
+    sources = [(ArchivedBooking.objects, 'booking_id')] + [(bookings_on(alias), 'id') for alias in booking_shards()]
+    for source, id_field in sources:
+        bookings = source.order_by(id_field)
+        if since:
+            bookings = bookings.filter(end_time__gt=datetime.combine(since, time.min))
+        for chunk in chunks(bookings.values_list(id_field, 'kart_id', 'start_time', 'end_time').iterator(), chunk_size):
+            payments = booking_payments([booking_id for booking_id, kart_id, start, end in chunk])
+            for booking_id, kart_id, start, end in chunk:
+                add_usage(usage, kart_id, start, end, payments.get(booking_id, 0))
+    rows = [
+        KartDailyUsage(kart_id=kart_id, day=day, booked_hours=hours, revenue=revenue)
+        for (kart_id, day), (hours, revenue) in usage.items() if not since or day >= since
+    ]
+    with transaction.atomic():
+        existing = KartDailyUsage.objects.all()
+        if since:
+            existing = existing.filter(day__gte=since)
+        existing.delete()
+        KartDailyUsage.objects.bulk_create(rows, batch_size=chunk_size)
+    return len(rows)
+
+
+def usage_report(start, end, kart_id=None, by_day=False):
+    """
+    Hours booked and revenue from the day `start` to the day `end` included, read from the rollups only.
+    Totals are by kart, or by kart and day.
+    """
+    rows = KartDailyUsage.objects.filter(day__gte=start, day__lte=end)
+    if kart_id is not None:
+        rows = rows.filter(kart_id=kart_id)
+    group = ('kart_id', 'day') if by_day else ('kart_id',)
+    rows = rows.values(*group).annotate(hours=Sum('booked_hours'), total=Sum('revenue')).order_by(*group)
+    # utilization is the share of the period the kart was booked
+    period_hours = 24 if by_day else 24 * ((end - start).days + 1)
+    report = []
+    for row in rows:
+        item = {"kart": row['kart_id'], "booked_hours": round(row['hours'], 2), "revenue": round(row['total'], 2),
+                "utilization": round(row['hours'] / period_hours, 4)}
+        if by_day:
+            item["day"] = row['day']
+        report.append(item)
+    return report
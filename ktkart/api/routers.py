@@ -0,0 +1,42 @@
+from .models import Kart, Booking
+from .sharding import ShardNotSelected, booking_shards, is_sharded, shard_for_kart
+
+
+class BookingShardRouter:
+    """
+    Bookings live on the shard of their kart (KTKART_BOOKING_SHARDS), the other models on the default database.
+    Querysets of bookings are not routed, apart from create(): they use the shard explicitly (see sharding.py).
+    With several shards a booking query without one raises ShardNotSelected, instead of reading only the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model is Booking:
+            # the hint is the booking itself, or the kart assigned to it
+            instance = hints.get('instance')
+            if isinstance(instance, Booking) and instance.kart_id is not None:
+                return shard_for_kart(instance.kart_id)
+            if isinstance(instance, Kart) and instance.id is not None:
+                return shard_for_kart(instance.id)
+            if is_sharded():
+                raise ShardNotSelected("Booking queries need a shard: use sharding.bookings_on(alias) or sharding.scatter()")
+            return None
+        # without this, the kart or user of a booking would be read on its shard
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        if model is Booking and not isinstance(hints.get('instance'), (Booking, Kart, type(None))):
+            # assigning the user of a booking asks for a database, the save routes it by kart
+            return None
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, Booking) or isinstance(obj2, Booking):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not is_sharded():
+            return None
+        if app_label == 'api' and model_name == 'booking':
+            return db in booking_shards()
+        return db == 'default'
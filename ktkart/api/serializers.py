@@ -1,11 +1,13 @@
-from rest_framework import serializers
-from .models import Kart, Balance, Booking
+from django.conf import settings
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .models import Kart, Balance, Booking, ArchivedBooking
 
 
 class KartSerializer(serializers.ModelSerializer):
     class Meta:
         model = Kart
-        fields = '__all__'
+        fields = ('id', 'type', 'hourly_cost', 'latitude', 'longitude')
 
 
 class BalanceSerializer(serializers.ModelSerializer):
@@ -17,7 +19,86 @@ class BalanceSerializer(serializers.ModelSerializer):
 class BookingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Booking
-        fields = '__all__'
+        fields = ('id', 'start_time', 'end_time', 'user', 'kart')
+
+
+class ArchivedBookingSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedBooking
+        fields = ('id', 'booking_id', 'start_time', 'end_time', 'user', 'kart')
+
+
+class ValuesSerializer:
+    """
+    Read only serializer working on .values_list() tuples instead of model instances,
+    without the DRF field machinery. Output is the same as the matching ModelSerializer
+    with many=True.
+    """
+    fields = ()
+    # columns to read with values_list(), same order as fields
+    columns = ()
+    # functions applied to some of the fields
+    converters = {}
+
+    def __init__(self, rows, fields=None):
+        # rows can be a queryset or an iterable of tuples
+        self.rows = rows
+        if fields is not None:
+            # only some of the fields, read from a queryset
+            if self.columns:
+                self.columns = tuple(self.columns[self.fields.index(field)] for field in fields)
+            self.fields = tuple(fields)
+
+    @property
+    def data(self):
+        rows = self.rows
+        if hasattr(rows, 'values_list'):
+            rows = rows.values_list(*(self.columns or self.fields))
+        fields = self.fields
+        if not self.converters:
+            return [dict(zip(fields, row)) for row in rows]
+        converters = [(i, field, self.converters[field]) for i, field in enumerate(fields) if field in self.converters]
+        data = []
+        for row in rows:
+            item = dict(zip(fields, row))
+            for i, field, convert in converters:
+                if row[i] is not None:
+                    item[field] = convert(row[i])
+            data.append(item)
+        return data
+
+
+datetime_field = serializers.DateTimeField()
+
+
+def datetime_to_representation(value):
+    """
+    Same output as the ModelSerializer datetime fields, naive datetimes
+    (USE_TZ = False) with the default ISO 8601 format take the short path
+    """
+    if value.tzinfo is None and not settings.USE_TZ and api_settings.DATETIME_FORMAT.lower() == ISO_8601:
+        return value.isoformat()
+    return datetime_field.to_representation(value)
+
+
+class KartValuesSerializer(ValuesSerializer):
+    fields = ('id', 'type', 'hourly_cost', 'latitude', 'longitude')
+
+
+class BookingValuesSerializer(ValuesSerializer):
+    fields = ('id', 'start_time', 'end_time', 'user', 'kart')
+    columns = ('id', 'start_time', 'end_time', 'user_id', 'kart_id')
+    converters = {
+        'start_time': datetime_to_representation,
+        'end_time': datetime_to_representation,
+    }
+
+
+class ArchivedBookingValuesSerializer(BookingValuesSerializer):
+    """
+    Archived bookings listed like the current ones, with the id they had in the Booking table
+    """
+    columns = ('booking_id', 'start_time', 'end_time', 'user_id', 'kart_id')
 
 
 class TokenSerializer(serializers.Serializer):
@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import Booking, BookingId
+
+_executor = None
+
+BOOKING_IDS_KEPT = 10000
+
+
+class ShardNotSelected(Exception):
+    pass
+
+
+def booking_shards():
+    """
+    Database aliases holding the bookings, KTKART_BOOKING_SHARDS
+    """
+    return getattr(settings, 'KTKART_BOOKING_SHARDS', ['default'])
+
+
+def is_sharded():
+    return booking_shards() != ['default']
+
+
+def shard_for_kart(kart_id):
+    shards = booking_shards()
+    return shards[int(kart_id) % len(shards)]
+
+
+def group_by_shard(kart_ids):
+    """
+    Split kart ids by shard, as a dict alias -> list of kart ids
+    """
+    groups = {}
+    for kart_id in kart_ids:
+        groups.setdefault(shard_for_kart(kart_id), []).append(kart_id)
+    return groups
+
+
+def bookings_on(alias):
+    return Booking.objects.using(alias)
+
+
+def scatter(func, shards=None):
+    """
+    Call func(alias) for each shard, all of them by default, and return the results in the order of the shards.
+    Shards are queried in parallel, unless one of them is in a transaction: the reads then
+    have to go through the connection of the transaction, one shard after the other.
+    """
+    global _executor
+    shards = list(booking_shards() if shards is None else shards)
+    if len(shards) < 2 or any(connections[alias].in_atomic_block for alias in shards):
+        return [func(alias) for alias in shards]
+
+    def call(alias):
+        # connections are per thread, the pool threads keep theirs between calls
+        connections[alias].close_if_unusable_or_obsolete()
+        return func(alias)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(getattr(settings, 'KTKART_SHARD_THREADS', 8))
+    return list(_executor.map(call, shards))
+
+
+@contextmanager
+def atomic(*aliases):
+    """
+    A transaction on each database, the default one and the shards of the bookings written.
+    They are committed one after the other when the block exits, the shards first: this is not
+    a two phase commit, a failure to commit the default database leaves the shard writes in place.
+    """
+    with ExitStack() as stack:
+        for alias in dict.fromkeys(('default',) + aliases):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def allocate_booking_ids(count):
+    """
+    Ids for new bookings, unique over all shards: each shard has its own auto increment,
+    so ids come from the BookingId table of the default database.
+    The rows are inserted in one statement, tagged with a token to read their ids back.
+    """
+    token = uuid4().hex
+    BookingId.objects.bulk_create([BookingId(token=token) for i in range(count)])
+    ids = list(BookingId.objects.filter(token=token).order_by('id').values_list('id', flat=True))
+    # the rows are only needed to allocate the ids, the old ones are deleted each BOOKING_IDS_KEPT ids.
+    # The last ones are kept: some databases restart the auto increment from the largest id.
+    if ids[-1] // BOOKING_IDS_KEPT > (ids[0] - 1) // BOOKING_IDS_KEPT:
+        BookingId.objects.filter(id__lte=ids[0] - BOOKING_IDS_KEPT).delete()
+    return ids
+
+
+def bulk_create_bookings(bookings):
+    """
+    bulk_create the bookings on the shards of their karts, in the caller's transaction (see atomic).
+    With sharding the ids are allocated first, without it bulk_create does not give them back on every database.
+    """
+    if is_sharded():
+        for booking, booking_id in zip(bookings, allocate_booking_ids(len(bookings))):
+            booking.id = booking_id
+    groups = {}
+    for booking in bookings:
+        groups.setdefault(shard_for_kart(booking.kart_id), []).append(booking)
+    for alias, group in groups.items():
+        bookings_on(alias).bulk_create(group)
+
+
+def find_booking(booking_id, **filters):
+    """
+    The booking with this id on any shard, or None
+    """
+    for booking in scatter(lambda alias: bookings_on(alias).filter(id=booking_id, **filters).first()):
+        if booking is not None:
+            return booking
+    return None
+
+
+def busy_kart_ids(start, end, kart_ids=None):
+    """
+    Ids of the karts with a booking overlapping [start, end], among `kart_ids` or all karts.
+    Without sharding it is a lazy values_list, usable as a subquery, otherwise a set read from the shards in parallel.
+    """
+    if not is_sharded():
+        bookings = Booking.objects.filter(end_time__gte=start, start_time__lte=end)
+        if kart_ids is not None:
+            bookings = bookings.filter(kart_id__in=kart_ids)
+        return bookings.values_list('kart_id', flat=True).distinct()
+    if kart_ids is None:
+        shards = {alias: None for alias in booking_shards()}
+    else:
+        shards = group_by_shard(kart_ids)
+
+    def busy(alias):
+        bookings = bookings_on(alias).filter(end_time__gte=start, start_time__lte=end)
+        if shards[alias] is not None:
+            bookings = bookings.filter(kart_id__in=shards[alias])
+        return set(bookings.values_list('kart_id', flat=True).distinct())
+    return set().union(*scatter(busy, shards))
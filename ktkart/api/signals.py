@@ -0,0 +1,95 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from .cache import bump_versions_on_commit, invalidate_availability_on_commit
+from .events import availability_event, publish_on_commit
+from .models import Kart, Booking
+from .ledger import entries_posted
+from .rollups import add_usage, record_booking, record_payments, write_usage
+from .availability import refresh_next_free
+from .sharding import booking_shards, bookings_on, is_sharded, allocate_booking_ids, shard_for_kart
+
+
+def booking_written(old=None, new=None, kart_id=None, booking_id=None):
+    """
+    Propagate a booking write to the caches, the usage rollups, the next free period
+    of the kart and the availability streams.
+    `old` and `new` are the (start, end) periods of the booking before and after the write,
+    None when it is created or deleted.
+    Bulk updates, which do not send signals, call it for each booking, bulk creations call bookings_created.
+    """
+    bump_versions_on_commit('bookings')
+    for period in {old, new}:
+        if period:
+            invalidate_availability_on_commit(*period)
+    if kart_id is not None and old != new:
+        # the rollups and the next free period are written in the same transaction as the booking
+        record_booking(kart_id, old, new, booking_id)
+        refresh_next_free([kart_id])
+        publish_on_commit(availability_event(kart_id, old, new))
+
+
+def bookings_created(bookings):
+    """
+    booking_written for the new bookings of a bulk insert, in their transaction: the rollups of all of
+    them are written at once and the next free period of each kart is refreshed once.
+    """
+    bump_versions_on_commit('bookings')
+    usage = {}
+    for booking in bookings:
+        period = (booking.start_time, booking.end_time)
+        invalidate_availability_on_commit(*period)
+        # the hours, the revenue comes with the ledger entries
+        add_usage(usage, booking.kart_id, booking.start_time, booking.end_time, 0)
+        publish_on_commit(availability_event(booking.kart_id, None, period))
+    write_usage(usage)
+    refresh_next_free(list({booking.kart_id for booking in bookings}))
+
+
+@receiver(pre_save, sender=Booking)
+def booking_id(sender, instance, **kwargs):
+    # with several shards, new bookings get their id from the shared sequence
+    if instance.pk is None and is_sharded():
+        instance.pk = allocate_booking_ids(1)[0]
+
+
+@receiver(post_save, sender=Booking)
+def booking_saved(sender, instance, **kwargs):
+    new = (instance.start_time, instance.end_time)
+    booking_written(getattr(instance, 'loaded_period', None), new, instance.kart_id, instance.pk)
+    instance.loaded_period = new
+
+
+@receiver(post_delete, sender=Booking)
+def booking_deleted(sender, instance, **kwargs):
+    booking_written((instance.start_time, instance.end_time), None, instance.kart_id, instance.pk)
+
+
+@receiver(post_save, sender=Kart)
+@receiver(post_delete, sender=Kart)
+def kart_changed(sender, instance, **kwargs):
+    bump_versions_on_commit('karts')
+
+
+def delete_bookings(using, shards, **filters):
+    # the deletion only collects the bookings of the database it runs on, the other shards are cleared here
+    for alias in shards:
+        if alias != using:
+            bookings_on(alias).filter(**filters).delete()
+
+
+@receiver(pre_delete, sender=Kart)
+def kart_deleted(sender, instance, using, **kwargs):
+    delete_bookings(using, [shard_for_kart(instance.pk)], kart_id=instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, using, **kwargs):
+    delete_bookings(using, booking_shards(), user_id=instance.pk)
+
+
+@receiver(entries_posted)
+def payments_posted(sender, entries, **kwargs):
+    # the revenue rollups follow the payments of the bookings
+    record_payments(entries)
@@ -0,0 +1,171 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from .availability import next_free
+from .cache import EPOCH, get_versions
+from .models import Kart
+from .sharding import bookings_on, scatter
+
+MAGIC = b'KTK1'
+# magic, karts, positions and bookings versions, number of karts, number of busy intervals,
+# covered period (seconds since EPOCH), length of the kart types table
+HEADER = struct.Struct('=4sqqqqqddq')
+VERSIONS = ('karts', 'positions', 'bookings')
+
+
+def snapshot_path():
+    return getattr(settings, 'KTKART_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'ktkart-fleet.snapshot'))
+
+
+def seconds(value):
+    return (value - EPOCH).total_seconds()
+
+
+def publish_snapshot(path=None, horizon=None):
+    """
+    Write a snapshot of the karts and of their bookings from now to `horizon` (a timedelta),
+    and atomically replace the previous one. Only one process should publish.
+    """
+    path = path or snapshot_path()
+    if horizon is None:
+        horizon = timedelta(seconds=getattr(settings, 'KTKART_SNAPSHOT_HORIZON_SECONDS', 7 * 86400))
+    # versions are read before the data: a write in between makes the snapshot look older than it is, never newer
+    versions = get_versions(*VERSIONS)
+    covered_from = datetime.now()
+    covered_until = covered_from + horizon
+
+    ids, costs, types, latitudes, longitudes = array('q'), array('q'), array('q'), array('d'), array('d')
+    type_names = {}
+    for kart_id, kart_type, hourly_cost, latitude, longitude in Kart.objects.order_by('id').values_list(
+            'id', 'type', 'hourly_cost', 'latitude', 'longitude'):
+        ids.append(kart_id)
+        costs.append(hourly_cost)
+        types.append(type_names.setdefault(kart_type, len(type_names)))
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+
+    # busy intervals of each kart, sorted, kart i has the intervals offsets[i] to offsets[i + 1]
+    intervals = {}
+    for rows in scatter(lambda alias: list(bookings_on(alias).filter(
+            end_time__gte=covered_from, start_time__lte=covered_until).values_list('kart_id', 'start_time', 'end_time'))):
+        for kart_id, start_time, end_time in rows:
+            intervals.setdefault(kart_id, []).append((seconds(start_time), seconds(end_time)))
+    offsets, starts, ends = array('q', [0]), array('d'), array('d')
+    for kart_id in ids:
+        for start, end in sorted(intervals.get(kart_id, ())):
+            starts.append(start)
+            ends.append(end)
+        offsets.append(len(starts))
+
+    type_table = json.dumps(sorted(type_names, key=type_names.get)).encode('utf-8')
+    header = HEADER.pack(MAGIC, versions[0], versions[1], versions[2], len(ids), len(starts),
+                         seconds(covered_from), seconds(covered_until), len(type_table))
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ktkart-snapshot-')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(header)
+            for values in (ids, costs, types, latitudes, longitudes, offsets, starts, ends):
+                values.tofile(f)
+            f.write(type_table)
+        # readers keep the mapping of the old file until they see the new one
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(ids), len(starts)
+
+
+class Snapshot:
+    """
+    Read only view of a snapshot file. The arrays are memoryviews of the mapped file:
+    all workers share the same pages and nothing is copied when reading them.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+        magic, karts, positions, bookings, count, interval_count, covered_from, covered_until, types_length = \
+            HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError("Not a kart snapshot: {}".format(path))
+        self.versions = [karts, positions, bookings]
+        self.covered_from = EPOCH + timedelta(seconds=covered_from)
+        self.covered_until = EPOCH + timedelta(seconds=covered_until)
+        offset = HEADER.size
+        arrays = []
+        for code, length in (('q', count), ('q', count), ('q', count), ('d', count), ('d', count),
+                             ('q', count + 1), ('d', interval_count), ('d', interval_count)):
+            arrays.append(view[offset:offset + 8 * length].cast(code))
+            offset += 8 * length
+        self.ids, self.costs, self.types, self.latitudes, self.longitudes, self.offsets, self.starts, self.ends = arrays
+        self.type_names = json.loads(bytes(view[offset:offset + types_length]).decode('utf-8'))
+
+    def is_current(self):
+        return self.versions == get_versions(*VERSIONS)
+
+    def covers(self, start, end):
+        return self.covered_from <= start and end <= self.covered_until
+
+    def is_busy(self, index, start, end):
+        """
+        True if a booking of the kart at `index` overlaps [start, end], in seconds since EPOCH.
+        Intervals of a kart never overlap, so the only candidate is the last one starting before `end`.
+        """
+        low, high = self.offsets[index], self.offsets[index + 1]
+        position = bisect_right(self.starts[low:high], end)
+        return position > 0 and self.ends[low + position - 1] >= start
+
+    def next_free(self, index, now, min_length):
+        """
+        Next free period of the kart at `index`, as next_free() in seconds since EPOCH
+        """
+        low, high = self.offsets[index], self.offsets[index + 1]
+        position = bisect_right(self.ends[low:high], now)
+        return next_free(zip(self.starts[low + position:high], self.ends[low + position:high]), now, min_length)
+
+    def available(self, start, end):
+        """
+        Karts without booking during the period, as (id, type, hourly_cost, latitude, longitude) rows
+        """
+        start, end = seconds(start), seconds(end)
+        return [
+            (self.ids[i], self.type_names[self.types[i]], self.costs[i], self.latitudes[i], self.longitudes[i])
+            for i in range(len(self.ids)) if not self.is_busy(i, start, end)
+        ]
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def get_snapshot(start, end):
+    """
+    Return the published snapshot if it is up to date and covers the period, None otherwise:
+    the caller then reads the database
+    """
+    global _snapshot
+    try:
+        stat = os.stat(snapshot_path())
+    except OSError:
+        return None
+    snapshot = _snapshot
+    if snapshot is None or (snapshot.stat.st_ino, snapshot.stat.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+        with _lock:
+            try:
+                _snapshot = snapshot = Snapshot(snapshot_path())
+            except (OSError, ValueError, struct.error):
+                return None
+    if not snapshot.covers(start, end) or not snapshot.is_current():
+        return None
+    return snapshot
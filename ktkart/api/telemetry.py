@@ -0,0 +1,137 @@
+import atexit
+import threading
+from time import monotonic
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, FloatField
+
+from . import metrics
+from .cache import get_versions, bump_versions
+from .fleet import get_fleet
+from .models import Kart
+from .utils import chunks
+
+POSITIONS_BUMP_KEY = 'ktkart:positions:bumped'
+
+
+def read_reports(reports):
+    """
+    Validate position reports, a list of {"kart_id", "lat", "lng"}.
+    Return the valid ones as (kart_id, lat, lng) and the errors with the index of their report.
+    """
+    valid, errors = [], []
+    for index, report in enumerate(reports):
+        try:
+            kart_id, lat, lng = int(report["kart_id"]), float(report["lat"]), float(report["lng"])
+        except (KeyError, TypeError, ValueError):
+            errors.append({"index": index, "error": "Report must have a kart_id, a lat and a lng."})
+            continue
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            errors.append({"index": index, "error": "Position out of range."})
+            continue
+        valid.append((kart_id, lat, lng))
+    return valid, errors
+
+
+def write_positions(positions, chunk_size=1000):
+    """
+    Write the positions of many karts, a dict kart_id -> (lat, lng), with one UPDATE per chunk.
+    Return the number of karts updated.
+    """
+    written = 0
+    with transaction.atomic():
+        for chunk in chunks(positions.items(), chunk_size):
+            written += Kart.objects.filter(id__in=[kart_id for kart_id, position in chunk]).update(
+                latitude=Case(*[When(id=kart_id, then=Value(lat)) for kart_id, (lat, lng) in chunk], output_field=FloatField()),
+                longitude=Case(*[When(id=kart_id, then=Value(lng)) for kart_id, (lat, lng) in chunk], output_field=FloatField()),
+            )
+    return written
+
+
+def bump_positions_version(interval):
+    """
+    Bump the 'positions' version at most once per interval, in seconds, for all workers.
+    Responses cached or built from the positions (available karts, near karts, snapshot, fleet)
+    are dropped by each bump, doing it on each flush would keep them from ever being used.
+    Return True if the version was bumped.
+    """
+    if not cache.add(POSITIONS_BUMP_KEY, 1, interval):
+        return False
+    bump_versions('positions')
+    return True
+
+
+class TelemetryBuffer:
+    """
+    Positions reported since the last flush, only the last one of each kart is kept.
+    The buffer is flushed by the first report received once the flush interval is over,
+    by a timer when no report comes, and when the worker exits.
+    """
+
+    def __init__(self, flush_interval, version_interval=60):
+        self.flush_interval = flush_interval
+        self.version_interval = version_interval
+        self.pending = {}
+        self.last_flush = monotonic()
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, reports):
+        """
+        Buffer (kart_id, lat, lng) reports, flush if it is time to.
+        Return the number of karts written, 0 if nothing was flushed.
+        """
+        with self.lock:
+            for kart_id, lat, lng in reports:
+                self.pending[kart_id] = (lat, lng)
+            wait = self.flush_interval - (monotonic() - self.last_flush)
+            if wait > 0 and self.pending and self.timer is None:
+                # flush the reports at the end of the interval even if no other report comes
+                self.timer = threading.Timer(wait, self.flush_in_background)
+                self.timer.daemon = True
+                self.timer.start()
+        metrics.incr('telemetry_reports', len(reports))
+        metrics.incr_rate('telemetry_reports', len(reports))
+        if wait <= 0:
+            return self.flush()
+        return 0
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            # the timer thread has its own connection
+            connection.close()
+
+    def flush(self):
+        with self.lock:
+            positions, self.pending = self.pending, {}
+            self.last_flush = monotonic()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not positions:
+            return 0
+        fleet = get_fleet()
+        written = write_positions(positions)
+        bumped = bump_positions_version(self.version_interval)
+        # move the karts of this worker's fleet instead of reloading it,
+        # unless another worker changed the karts in the meantime
+        karts_version, positions_version = fleet.version
+        if bumped:
+            positions_version += 1
+        if get_versions('karts', 'positions') == [karts_version, positions_version]:
+            fleet.move(positions)
+            fleet.version = (karts_version, positions_version)
+        metrics.incr('telemetry_writes', written)
+        return written
+
+
+telemetry_buffer = TelemetryBuffer(
+    getattr(settings, 'KTKART_TELEMETRY_FLUSH_SECONDS', 2),
+    getattr(settings, 'KTKART_POSITIONS_VERSION_SECONDS', 60),
+)
+# the reports still buffered are written when the worker exits
+atexit.register(telemetry_buffer.flush)
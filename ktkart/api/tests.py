@@ -1,11 +1,47 @@
+import io
 import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
 from django.contrib.auth.models import User
 
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APIClient, APIRequestFactory, force_authenticate
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.views import status
-from .models import Booking, Balance, Kart
-from .serializers import BookingSerializer, BalanceSerializer, KartSerializer
+from .models import Booking, BookingId, Balance, Kart, ArchivedBooking, LedgerEntry, KartDailyUsage, StaleVersion
+from .serializers import BookingSerializer, BalanceSerializer, KartSerializer, KartValuesSerializer, BookingValuesSerializer
+from .renderers import FastJSONRenderer, MessagePackRenderer, msgpack
+from .middleware import brotli
+import gzip
+from rest_framework.renderers import JSONRenderer
+from .archive import archive_finished_bookings
+from .metrics import get_metrics
+from .cache import get_versions, release_lock
+from .ledger import booking_payments, post_entries, reconcile
+from .bulk import import_users
+from .telemetry import TelemetryBuffer, telemetry_buffer
+from .events import get_hub, availability_event
+from .idempotency import idempotent
+from .snapshot import publish_snapshot, get_snapshot
+from .rollups import rebuild_rollups
+from .coalesce import SingleFlight, LOCK_KEY, RESULT_KEY
+from .throttles import ScopedBucketThrottle
+from .routers import BookingShardRouter
+from .sharding import ShardNotSelected, allocate_booking_ids, bookings_on, booking_shards, find_booking, group_by_shard, is_sharded, shard_for_kart
+from unittest import mock, skipUnless
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from . import admin as api_admin, sharding, views
 
 from datetime import datetime, timedelta
 
@@ -14,6 +50,14 @@ class BaseViewTest(APITestCase):
     Setup all the tests. Test classes implements BaseViewTest
     """
     client = APIClient()
+    # bookings may be on other databases, see ShardingTest
+    multi_db = True
+
+    def bookings(self, **filters):
+        """
+        The bookings matching the filters on every shard, by id
+        """
+        return sorted((booking for alias in booking_shards() for booking in bookings_on(alias).filter(**filters)), key=lambda booking: booking.id)
 
     def login_user(self, email="", password=""):
         url = reverse("auth-login")
@@ -76,7 +120,7 @@ class BaseViewTest(APITestCase):
             content_type='application/json'
         )
 
-    def get_available_karts(self, start, end):
+    def get_available_karts(self, start, end, **extra):
         return self.client.post(
             reverse("available_karts"),
             data=json.dumps(
@@ -85,16 +129,18 @@ class BaseViewTest(APITestCase):
                     "end": end
                 }
             ),
-            content_type='application/json'
+            content_type='application/json',
+            **extra
         )
 
-    def get_booking(self):
+    def get_booking(self, **extra):
         return self.client.get(
             reverse('booking'),
-            content_type='application/json'
+            content_type='application/json',
+            **extra
         )
 
-    def post_booking(self, start, end, kart_id):
+    def post_booking(self, start, end, kart_id, **extra):
         return self.client.post(
             reverse("booking"),
             data=json.dumps(
@@ -104,7 +150,8 @@ class BaseViewTest(APITestCase):
                     "kart_id": kart_id
                 }
             ),
-            content_type='application/json'
+            content_type='application/json',
+            **extra
         )
 
     def update_booking(self, start, end, booking_id):
@@ -132,6 +179,8 @@ class BaseViewTest(APITestCase):
         )
 
     def setUp(self):
+        # throttle buckets, idempotency keys... of the previous tests
+        cache.clear()
         self.user = User.objects.create_superuser(
             email="test@mail.com",
             password="testing",
@@ -289,7 +338,7 @@ class BookingTest(BaseViewTest):
 
         """ works with nothing in the database """
         response = self.get_booking()
-        expected = BookingSerializer(Booking.objects.filter(user = self.user), many=True)
+        expected = BookingSerializer(self.bookings(user=self.user), many=True)
         self.assertEqual(expected.data, response.data)
 
         """ works after posting a new booking """
@@ -297,7 +346,7 @@ class BookingTest(BaseViewTest):
         end = start + timedelta(seconds=3600)
         self.post_booking(str(start), str(end), valid_kart_ids[0])
         response = self.get_booking()
-        expected = BookingSerializer(Booking.objects.filter(user = self.user), many=True)
+        expected = BookingSerializer(self.bookings(user=self.user), many=True)
         self.assertEqual(expected.data, response.data)
 
     def test_update_booking(self):
@@ -330,3 +379,1178 @@ class BookingTest(BaseViewTest):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         balance_end = Balance.objects.get(user=self.user).get_balance()
         self.assertEqual(balance_init, balance_end)
+
+
+class ArchiveTest(BaseViewTest):
+    """
+    Tests the archiving of finished bookings
+    """
+    def test_archive_bookings(self):
+        karts = Kart.objects.all()
+        self.login_for_auth("test@mail.com", "testing")
+        now = datetime.now()
+        for i in range(3):
+            Booking.objects.create(start_time=now-timedelta(days=i+1), end_time=now-timedelta(days=i+1)+timedelta(seconds=3600), kart=karts[i], user=self.user)
+        start = now + timedelta(seconds=3600)
+        self.post_booking(str(start), str(start+timedelta(seconds=3600)), karts[0].id)
+        history = self.get_booking().data
+
+        """ only finished bookings are moved, in batches """
+        self.assertEqual(archive_finished_bookings(now, batch_size=2), 3)
+        self.assertEqual(len(self.bookings()), 1)
+        self.assertEqual(ArchivedBooking.objects.count(), 3)
+
+        """ history still returns all bookings """
+        self.assertEqual(history, self.get_booking().data)
+
+        """ archived bookings cannot be deleted """
+        response = self.delete_booking(ArchivedBooking.objects.first().booking_id)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ValuesSerializerTest(BaseViewTest):
+    """
+    Tests the values serializers and the JSON renderer give the same output as the default ones
+    """
+    def test_values_serializers(self):
+        now = datetime.now()
+        for i, kart in enumerate(Kart.objects.all()):
+            Booking.objects.create(start_time=now+timedelta(hours=i), end_time=now+timedelta(hours=i+1), kart=kart, user=self.user)
+        renderer, fast_renderer = JSONRenderer(), FastJSONRenderer()
+
+        expected = KartSerializer(Kart.objects.all(), many=True).data
+        data = KartValuesSerializer(Kart.objects.all()).data
+        self.assertEqual(expected, data)
+        self.assertEqual(renderer.render(expected), fast_renderer.render(data))
+
+        bookings = bookings_on(booking_shards()[0]).order_by('id')
+        expected = BookingSerializer(bookings, many=True).data
+        data = BookingValuesSerializer(bookings).data
+        self.assertEqual(expected, data)
+        self.assertEqual(renderer.render(expected), fast_renderer.render(data))
+
+    def test_fast_renderer(self):
+        renderer, fast_renderer = JSONRenderer(), FastJSONRenderer()
+        for data in ["Booking was not found.", {"price": 1e-05, "balance": 1e+16}, ["\u2028 caf\u00e9"], {"start": datetime.now()}, None]:
+            self.assertEqual(renderer.render(data), fast_renderer.render(data))
+
+
+class ConditionalGetTest(BaseViewTest):
+    """
+    Tests ETag and If-None-Match on booking/ and available_karts/
+    """
+    def test_booking_etag(self):
+        kart_id = Kart.objects.first().id
+        self.login_for_auth("test@mail.com", "testing")
+        response = self.get_booking()
+        etag = response['ETag']
+
+        """ same data, not modified """
+        response = self.get_booking(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        """ a new booking changes the etag """
+        start = datetime.now() + timedelta(seconds=3600)
+        self.post_booking(str(start), str(start+timedelta(seconds=3600)), kart_id)
+        response = self.get_booking(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data), 1)
+
+    def test_available_karts_etag(self):
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime.now() + timedelta(seconds=3600)
+        end = start + timedelta(seconds=3600)
+        etag = self.get_available_karts(str(start), str(end))['ETag']
+        response = self.get_available_karts(str(start), str(end), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        """ another window has another etag """
+        response = self.get_available_karts(str(start), str(end+timedelta(seconds=3600)), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        """ a kart change makes the etag obsolete """
+        Kart.objects.create(type="Standard", hourly_cost=10)
+        response = self.get_available_karts(str(start), str(end), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 11)
+
+
+class AvailabilityCacheTest(BaseViewTest):
+    """
+    Tests the cache of available_karts/ results
+    """
+    def test_availability_cache(self):
+        karts = Kart.objects.all()
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime.now().replace(minute=0, second=0, microsecond=1) + timedelta(days=2)
+        end = start + timedelta(seconds=3600)
+        self.get_available_karts(str(start), str(end))
+        hits = get_metrics()['availability_cache_hits']
+
+        """ same window again is served by the cache """
+        response = self.get_available_karts(str(start), str(end))
+        self.assertEqual(len(response.data), 10)
+        self.assertEqual(get_metrics()['availability_cache_hits'], hits + 1)
+
+        """ a booking far from the window keeps the cached result """
+        booking = self.post_booking(str(start+timedelta(days=1)), str(end+timedelta(days=1)), karts[0].id).data["reservation"]
+        self.get_available_karts(str(start), str(end))
+        self.assertEqual(get_metrics()['availability_cache_hits'], hits + 2)
+
+        """ moving it into the window drops the cached result """
+        self.update_booking(str(start+timedelta(seconds=1800)), str(end+timedelta(seconds=1800)), booking["id"])
+        response = self.get_available_karts(str(start), str(end))
+        self.assertEqual(get_metrics()['availability_cache_hits'], hits + 2)
+        self.assertEqual(len(response.data), 9)
+
+        """ and so does deleting it """
+        self.delete_booking(booking["id"])
+        response = self.get_available_karts(str(start), str(end))
+        self.assertEqual(len(response.data), 10)
+
+
+class SingleFlightTest(SimpleTestCase):
+    """
+    Tests the coalescing of identical concurrent computations
+    """
+    def test_single_flight(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return ["result"]
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("key", compute))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        # let every thread reach the computation before it ends
+        sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["result"]] * 5)
+
+        """ once finished, the next call computes again """
+        single_flight.do("key", compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_single_flight(self):
+        single_flight = SingleFlight(shared=True, timeout=1)
+        digest = md5(repr("shared").encode('utf-8')).hexdigest()
+
+        """ another worker holds the computation, we get its result """
+        cache.add(LOCK_KEY.format(digest), 1)
+        cache.set(RESULT_KEY.format(digest), ["from another worker"])
+        self.assertEqual(single_flight.do("shared", lambda: ["computed"]), ["from another worker"])
+
+        """ nobody computes it, we do """
+        cache.delete(LOCK_KEY.format(digest))
+        self.assertEqual(single_flight.do("shared", lambda: ["computed"]), ["computed"])
+
+
+class BulkUpdateBalanceTest(BaseViewTest):
+    """
+    Tests balance/bulk_update/ endpoint
+    """
+    def test_bulk_update_balance(self):
+        self.register_user("first@mail.com", "password")
+        self.register_user("second@mail.com", "password")
+        self.login_for_auth("test@mail.com", "testing")
+
+        """ set balances, failed rows are reported """
+        response = self.client.post(
+            reverse("balance-bulk-update"),
+            data=json.dumps({
+                "mode": "set",
+                "updates": [
+                    {"email": "first@mail.com", "amount": 50},
+                    {"email": "unknown@mail.com", "amount": 50},
+                    {"email": "second@mail.com", "amount": -1},
+                    {"email": "second@mail.com", "amount": 20},
+                    {"email": ["first@mail.com"], "amount": 10},
+                ]
+            }),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["updated"], 2)
+        self.assertEqual([failure["line"] for failure in response.data["failures"]], [2, 3, 5])
+        self.assertEqual(Balance.objects.get(user__email="first@mail.com").get_balance(), 50)
+        self.assertEqual(Balance.objects.get(user__email="second@mail.com").get_balance(), 20)
+
+        """ increment balances from a CSV file """
+        csv_file = SimpleUploadedFile("balances.csv", b"email,amount\nfirst@mail.com,10\nfirst@mail.com,2.5\nsecond@mail.com,abc\n")
+        response = self.client.post(reverse("balance-bulk-update"), data={"mode": "increment", "file": csv_file})
+        self.assertEqual(response.data["updated"], 1)
+        self.assertEqual(len(response.data["failures"]), 1)
+        self.assertEqual(Balance.objects.get(user__email="first@mail.com").get_balance(), 62.5)
+
+        """ infinite amounts and lines which are not UTF-8 are reported """
+        csv_file = SimpleUploadedFile("balances.csv", b"first@mail.com,inf\nsecond@mail.com,1e400\nsecond\xe9@mail.com,1\nsecond@mail.com,3\n")
+        response = self.client.post(reverse("balance-bulk-update"), data={"mode": "increment", "file": csv_file})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["updated"], 1)
+        self.assertEqual([failure["line"] for failure in response.data["failures"]], [1, 2, 3])
+        self.assertEqual(response.data["failures"][2]["error"], "Row is not valid UTF-8.")
+        self.assertEqual(Balance.objects.get(user__email="second@mail.com").get_balance(), 23)
+
+        """ normal user cannot use it """
+        self.login_for_auth("first@mail.com", "password")
+        response = self.client.post(reverse("balance-bulk-update"), data=json.dumps({"updates": []}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class LedgerTest(BaseViewTest):
+    """
+    Tests the balance ledger
+    """
+    def test_ledger(self):
+        kart_ids = list(Kart.objects.values_list('id', flat=True))
+        self.register_user("new_user@mail.com", "password")
+        user = User.objects.get(email="new_user@mail.com")
+        self.login_for_auth("test@mail.com", "testing")
+        self.update_balance("new_user@mail.com", 100)
+        self.login_for_auth("new_user@mail.com", "password")
+
+        """ every booking operation writes an entry """
+        start = datetime.now() + timedelta(seconds=3600)
+        end = start + timedelta(seconds=3600)
+        booking_id = self.post_booking(str(start), str(end), kart_ids[0]).data["reservation"]["id"]
+        self.update_booking(str(start), str(end+timedelta(seconds=3600)), booking_id)
+        self.delete_booking(booking_id)
+        self.client.post(
+            reverse("multiple_booking"),
+            data=json.dumps({"start": str(start), "end": str(end), "kart_ids": kart_ids[:2]}),
+            content_type='application/json'
+        )
+        reasons = list(LedgerEntry.objects.filter(user=user).order_by('id').values_list('reason', flat=True))
+        self.assertEqual(reasons, ['signup', 'admin', 'booking', 'booking_update', 'refund', 'booking', 'booking'])
+        self.assertEqual(Balance.objects.get(user=user).get_balance(), 80)
+
+        """ a booking that cannot be paid leaves nothing behind """
+        self.post_booking(str(start), str(end+timedelta(days=10)), kart_ids[2])
+        self.assertEqual(LedgerEntry.objects.filter(user=user).count(), 7)
+        self.assertEqual(self.bookings(kart_id=kart_ids[2]), [])
+
+        """ balances are the sum of their entries """
+        LedgerEntry.objects.create(user=self.user, amount=100, reason=LedgerEntry.OPENING)
+        self.assertEqual(reconcile(), [])
+        Balance.objects.filter(user=user).update(balance=1000)
+        self.assertEqual(reconcile(fix=True), [(user.id, 1000, 80)])
+        self.assertEqual(Balance.objects.get(user=user).get_balance(), 80)
+
+
+class BatchBookingTest(BaseViewTest):
+    """
+    Tests booking/batch/ endpoint
+    """
+    def batch(self, operations, mode="atomic"):
+        return self.client.post(
+            reverse("booking-batch"),
+            data=json.dumps({"mode": mode, "operations": operations}),
+            content_type='application/json'
+        )
+
+    def test_batch_booking(self):
+        kart_ids = list(Kart.objects.values_list('id', flat=True))
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime.now() + timedelta(seconds=3600)
+        end = start + timedelta(seconds=3600)
+        first = self.post_booking(str(start), str(end), kart_ids[0]).data["reservation"]["id"]
+        second = self.post_booking(str(start), str(end), kart_ids[1]).data["reservation"]["id"]
+
+        """ conflicts inside the batch are detected, nothing is applied in atomic mode """
+        operations = [
+            {"op": "create", "kart_id": kart_ids[2], "start": str(start), "end": str(end)},
+            {"op": "create", "kart_id": kart_ids[2], "start": str(start), "end": str(end)},
+        ]
+        response = self.batch(operations)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual([result and result["status"] for result in response.data["results"]], [None, "error"])
+        self.assertEqual(len(self.bookings()), 2)
+
+        """ in partial mode, valid operations are applied """
+        response = self.batch(operations, mode="partial")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["status"] for result in response.data["results"]], ["ok", "error"])
+        self.assertEqual(len(self.bookings()), 3)
+
+        """ a slot freed by a delete can be booked in the same batch, balance is updated once """
+        response = self.batch([
+            {"op": "delete", "booking_id": first},
+            {"op": "create", "kart_id": kart_ids[0], "start": str(start), "end": str(end)},
+            {"op": "update", "booking_id": second, "start": str(start), "end": str(end+timedelta(seconds=3600))},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["payment"], "$10.0")
+        self.assertEqual(response.data["new_balance"]["balance"], Balance.objects.get(user=self.user).get_balance())
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 100 - 10 - 10 - 10 - 10)
+        self.assertIsNone(find_booking(first))
+        self.assertEqual(find_booking(second).end_time, end+timedelta(seconds=3600))
+
+
+class RecurringBookingTest(BaseViewTest):
+    """
+    Tests booking/recurring/ endpoint
+    """
+    def recurring_booking(self, start, end, kart_ids, every="weekly", occurrences=4):
+        return self.client.post(
+            reverse("booking-recurring"),
+            data=json.dumps({"start": start, "end": end, "kart_ids": kart_ids, "every": every, "occurrences": occurrences}),
+            content_type='application/json'
+        )
+
+    def test_recurring_booking(self):
+        kart_ids = list(Kart.objects.values_list('id', flat=True))
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime.now() + timedelta(seconds=3600)
+        end = start + timedelta(seconds=3600)
+
+        """ one occurrence taken makes the whole series fail """
+        self.post_booking(str(start+timedelta(days=14)), str(end+timedelta(days=14)), kart_ids[1])
+        response = self.recurring_booking(str(start), str(end), kart_ids[:2])
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(list(response.data["not_available_karts"]), [kart_ids[1]])
+        self.assertEqual(len(self.bookings()), 1)
+
+        """ 2 karts x 4 weeks, paid once """
+        response = self.recurring_booking(str(start), str(end), [kart_ids[0], kart_ids[2]])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["reservation"]), 8)
+        self.assertEqual(response.data["price"], "$80.0")
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 100 - 10 - 80)
+        self.assertEqual(LedgerEntry.objects.filter(user=self.user, reason=LedgerEntry.BOOKING).count(), 9)
+
+        """ not enough balance for another series """
+        response = self.recurring_booking(str(start), str(end), [kart_ids[3]], every="daily", occurrences=2)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(len(self.bookings()), 9)
+
+    def test_series_rollups(self):
+        kart = Kart.objects.filter(type="Standard").first()
+        self.login_for_auth("test@mail.com", "testing")
+        start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=1)
+        end = start + timedelta(hours=1)
+
+        """ the rollups and the next free period are written with the bookings """
+        with mock.patch('ktkart.api.signals.refresh_next_free', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.recurring_booking(str(start), str(end), [kart.id], every="daily", occurrences=5)
+        self.assertEqual(self.bookings(), [])
+        self.assertFalse(KartDailyUsage.objects.exists())
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 100)
+
+        response = self.recurring_booking(str(start), str(end), [kart.id], every="daily", occurrences=5)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(KartDailyUsage.objects.values_list('day', 'booked_hours', 'revenue')),
+            [(start.date() + timedelta(days=i), 1, 10) for i in range(5)]
+        )
+        kart.refresh_from_db()
+        self.assertEqual(kart.free_until, start)
+
+
+class AllocateTest(BaseViewTest):
+    """
+    Tests allocate/ endpoint
+    """
+    def allocate(self, **data):
+        return self.client.post(reverse("allocate"), data=json.dumps(data), content_type='application/json')
+
+    def test_allocate(self):
+        self.login_for_auth("test@mail.com", "testing")
+        Balance.objects.filter(user=self.user).update(balance=1000)
+
+        """ nearest karts to a Cat Cruiser location """
+        response = self.allocate(party_size=2, lat=49, lng=3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([kart["type"] for kart in response.data["karts"]], ["Cat Cruiser"] * 2)
+        self.assertEqual(len(response.data["reservation"]), 2)
+
+        """ cheapest karts of a type, within budget """
+        response = self.allocate(party_size=2, lat=49, lng=3, strategy="cheapest", budget=20)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([kart["type"] for kart in response.data["karts"]], ["Standard"] * 2)
+        self.assertEqual(response.data["price"], "$20.0")
+        response = self.allocate(party_size=2, lat=49, lng=3, type="Blue Falcon", budget=20)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        """ booked karts are not picked again """
+        response = self.allocate(party_size=7, lat=49, lng=3)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.allocate(party_size=2, lat=49, lng=3)
+        self.assertEqual([kart["type"] for kart in response.data["karts"]], ["Cat Cruiser", "Blue Falcon"])
+        self.assertEqual(len(self.bookings()), 6)
+
+
+class QuoteTest(BaseViewTest):
+    """
+    Tests quote/ endpoint and the pricing rules
+    """
+    def quote(self, items):
+        return self.client.post(reverse("quote"), data=json.dumps({"items": items}), content_type='application/json')
+
+    def test_quote(self):
+        kart = Kart.objects.get(id=Kart.objects.first().id)
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime(2030, 1, 1, 16, 0, 0, 1)
+        items = [
+            {"kart_id": kart.id, "start": str(start), "end": str(start+timedelta(hours=2))},
+            {"type": "Cat Cruiser", "start": str(start), "end": str(start+timedelta(hours=4))},
+            {"type": "Unknown", "start": str(start), "end": str(start+timedelta(hours=1))},
+            {"kart_id": kart.id, "start": "tomorrow", "end": str(start)},
+        ]
+        self.quote(items)
+
+        """ quotes only need the authenticated user once the fleet is loaded """
+        with self.assertNumQueries(1):
+            response = self.quote(items)
+        self.assertEqual(response.data["quotes"][:2], [{"price": "$20.0"}, {"price": "$100.0"}])
+        self.assertEqual(list(response.data["quotes"][2]), ["error"])
+        self.assertEqual(list(response.data["quotes"][3]), ["error"])
+
+        """ pricing rules change quotes """
+        rules = [
+            ('ktkart.api.pricing.PeakHoursRule', {'hours': [17], 'multiplier': 2}),
+            ('ktkart.api.pricing.DurationDiscountRule', {'min_hours': 4, 'discount': 0.5}),
+        ]
+        with override_settings(KTKART_PRICING_RULES=rules):
+            response = self.quote(items)
+        self.assertEqual(response.data["quotes"][:2], [{"price": "$30.0"}, {"price": "$62.5"}])
+        self.assertEqual(self.quote(items).data["quotes"][:2], [{"price": "$20.0"}, {"price": "$100.0"}])
+
+        """ kart ids and types which are not plain values are reported """
+        response = self.quote([{"kart_id": [kart.id], "start": str(start), "end": str(start+timedelta(hours=1))}, {"type": {}, "start": str(start), "end": str(start+timedelta(hours=1))}])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["quotes"], [{"error": "No such kart id or type"}] * 2)
+
+    def test_update_after_price_change(self):
+        self.login_for_auth("test@mail.com", "testing")
+        kart = Kart.objects.filter(type="Standard").first()
+        start = datetime.now() + timedelta(days=1)
+        booking_id = self.post_booking(str(start), str(start+timedelta(hours=4)), kart.id).data["reservation"]["id"]
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 60)
+
+        """ an update pays the difference with what was paid, at the new prices """
+        with override_settings(KTKART_PRICING_RULES=[('ktkart.api.pricing.PeakHoursRule', {'hours': range(24), 'multiplier': 2})]):
+            response = self.update_booking(str(start), str(start+timedelta(hours=3)), booking_id)
+            self.assertEqual(response.data["payment"], "$20.0")
+            self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 40)
+            self.assertEqual(booking_payments([booking_id]), {booking_id: 60})
+
+            """ the delete refunds all of it """
+            response = self.delete_booking(booking_id)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 100)
+        self.assertEqual(booking_payments([booking_id]), {booking_id: 0})
+
+        """ the same in a batch """
+        booking_id = self.post_booking(str(start), str(start+timedelta(hours=4)), kart.id).data["reservation"]["id"]
+        with override_settings(KTKART_PRICING_RULES=[('ktkart.api.pricing.PeakHoursRule', {'hours': range(24), 'multiplier': 2})]):
+            response = self.client.post(reverse("booking-batch"), data=json.dumps({"operations": [
+                {"op": "update", "booking_id": booking_id, "start": str(start), "end": str(start+timedelta(hours=3))},
+            ]}), content_type='application/json')
+        self.assertEqual(response.data["payment"], "$20.0")
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 40)
+        self.assertEqual(booking_payments([booking_id]), {booking_id: 60})
+
+
+class TelemetryTest(BaseViewTest):
+    """
+    Tests telemetry/ endpoint
+    """
+    def send_reports(self, reports):
+        return self.client.post(reverse("telemetry"), data=json.dumps({"reports": reports}), content_type='application/json')
+
+    def test_telemetry(self):
+        self.login_for_auth("test@mail.com", "testing")
+        karts = list(Kart.objects.order_by('id'))
+        near = lambda: self.client.post(reverse("near_karts"), data=json.dumps({"lat": 40, "lng": -3}), content_type='application/json')
+        self.assertEqual(near().data[0]["id"], karts[0].id)
+
+        """ reports are buffered until the flush interval is over """
+        telemetry_buffer.flush_interval = 3600
+        response = self.send_reports([
+            {"kart_id": karts[9].id, "lat": 45, "lng": 0},
+            {"kart_id": karts[9].id, "lat": 40.1, "lng": -3.1},
+            {"kart_id": karts[8].id, "lat": 40.2, "lng": "east"},
+            {"kart_id": karts[8].id, "lat": 91, "lng": 0},
+        ])
+        self.assertEqual(response.data["accepted"], 2)
+        self.assertEqual([error["index"] for error in response.data["rejected"]], [2, 3])
+        self.assertEqual(response.data["written"], 0)
+        self.assertEqual(Kart.objects.get(id=karts[9].id).latitude, 49)
+
+        """ the last report of each kart is written on flush """
+        telemetry_buffer.flush_interval = 0
+        try:
+            response = self.send_reports([{"kart_id": karts[7].id, "lat": 40.3, "lng": -3.3}])
+        finally:
+            telemetry_buffer.flush_interval = 2
+        self.assertEqual(response.data["written"], 2)
+        self.assertEqual((Kart.objects.get(id=karts[9].id).latitude, Kart.objects.get(id=karts[9].id).longitude), (40.1, -3.1))
+
+        """ near_karts sees the new positions """
+        self.assertEqual([kart["id"] for kart in near().data[:2]], [karts[9].id, karts[7].id])
+        self.assertGreaterEqual(get_metrics()["telemetry_writes"], 2)
+
+        """ the positions version is bumped at most once per interval """
+        versions = get_versions('positions')
+        telemetry_buffer.flush_interval = 0
+        try:
+            response = self.send_reports([{"kart_id": karts[7].id, "lat": 40.4, "lng": -3.4}])
+        finally:
+            telemetry_buffer.flush_interval = 2
+        self.assertEqual(response.data["written"], 1)
+        self.assertEqual(get_versions('positions'), versions)
+        self.assertEqual(Kart.objects.get(id=karts[7].id).latitude, 40.4)
+
+    def test_flush_timer(self):
+        """ buffered reports are flushed even if no other report comes """
+        flushed = threading.Event()
+        buffer = TelemetryBuffer(0.05)
+        with mock.patch.object(buffer, 'flush', side_effect=lambda: flushed.set()):
+            buffer.add([(1, 40, -3)])
+            self.assertTrue(flushed.wait(5))
+
+
+class AvailabilityStreamTest(BaseViewTest):
+    """
+    Tests availability/stream/ endpoint
+    """
+    def test_availability_stream(self):
+        self.login_for_auth("test@mail.com", "testing")
+        standard = Kart.objects.filter(type="Standard").first()
+        cruiser = Kart.objects.filter(type="Cat Cruiser").first()
+        start = datetime(2030, 1, 1, 16, 0, 0, 1)
+
+        """ events of other kart types are filtered out """
+        response = self.client.get(reverse("availability-stream"), {"type": "Cat Cruiser"}, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response["Content-Type"], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), b'retry: 1000\n\n')
+        get_hub().publish(availability_event(standard.id, None, (start, start+timedelta(hours=1))))
+        get_hub().publish(availability_event(cruiser.id, (start, start+timedelta(hours=1)), None))
+        event = next(events).decode('utf-8')
+        response.close()
+        self.assertEqual(event.split("\n")[0], "event: availability")
+        self.assertEqual(json.loads(event.split("\n")[1][len("data: "):]), {
+            "kart": cruiser.id, "free": ["2030-01-01T16:00:00.000001", "2030-01-01T17:00:00.000001"], "busy": None
+        })
+        self.assertEqual(get_hub().subscriptions, set())
+
+        """ a client gone before the first event never subscribes """
+        response = self.client.get(reverse("availability-stream"), HTTP_ACCEPT='text/event-stream')
+        response.close()
+        self.assertEqual(get_hub().subscriptions, set())
+
+        """ bad filters are refused """
+        response = self.client.get(reverse("availability-stream"), {"bbox": "48,2"}, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class IdempotencyTest(BaseViewTest):
+    """
+    Tests Idempotency-Key header on booking/ and multiple_booking/
+    """
+    def test_idempotency_key(self):
+        self.login_for_auth("test@mail.com", "testing")
+        kart = Kart.objects.filter(type="Standard").first()
+        start = datetime.now() + timedelta(days=1)
+        end = start + timedelta(hours=2)
+        key = "booking-{}".format(md5(str(start).encode('utf-8')).hexdigest())
+
+        """ a retry gets the first response back, the user is charged once """
+        first = self.post_booking(str(start), str(end), kart.id, HTTP_IDEMPOTENCY_KEY=key)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        retry = self.post_booking(str(start), str(end), kart.id, HTTP_IDEMPOTENCY_KEY=key)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.bookings()), 1)
+        self.assertEqual(Balance.objects.get(user=self.user).balance, 80)
+
+        """ the key cannot be reused for another request """
+        response = self.post_booking(str(start), str(end + timedelta(hours=1)), kart.id, HTTP_IDEMPOTENCY_KEY=key)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        """ a duplicate waits for the request in flight and gets its response """
+        calls = []
+
+        class SlowView(APIView):
+            permission_classes = ()
+
+            @idempotent
+            def post(self, request):
+                calls.append(request.data)
+                sleep(0.3)
+                return Response({"call": len(calls)})
+
+        def post(responses):
+            request = APIRequestFactory().post("/slow/", {"a": 1}, format='json', HTTP_IDEMPOTENCY_KEY=key + "-slow")
+            force_authenticate(request, user=self.user)
+            responses.append(SlowView.as_view()(request).data)
+
+        responses = []
+        threads = [threading.Thread(target=post, args=(responses,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(responses, [{"call": 1}] * 3)
+
+        """ a request outliving its lock does not release the lock of another one """
+        cache.set("lock", "token of another request")
+        release_lock(cache, "lock", "token")
+        self.assertEqual(cache.get("lock"), "token of another request")
+        release_lock(cache, "lock", "token of another request")
+        self.assertIsNone(cache.get("lock"))
+
+
+class ThrottleTest(BaseViewTest):
+    """
+    Tests the token bucket throttles
+    """
+    def test_throttles(self):
+        rates = {'anon': '100/min', 'user': '100/min', 'login': '2/min', 'near_karts': '2/min', 'multiple_booking': '2/min'}
+        with override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            self.login_for_auth("test@mail.com", "testing")
+            near = lambda: self.client.post(reverse("near_karts"), data=json.dumps({"lat": 48, "lng": 2}), content_type='application/json')
+
+            """ an expensive route has its own budget """
+            self.assertEqual(near().status_code, status.HTTP_200_OK)
+            self.assertEqual(near().status_code, status.HTTP_200_OK)
+            response = near()
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn(int(response["Retry-After"]), (29, 30))
+            self.assertEqual(self.get_balance().status_code, status.HTTP_200_OK)
+
+            """ login is limited by IP address """
+            self.client.credentials()
+            self.client.logout()
+            self.assertEqual(self.login_user("test@mail.com", "testing").status_code, status.HTTP_200_OK)
+            self.assertEqual(self.login_user("test@mail.com", "testing").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+            """ rejections are counted """
+            metrics = get_metrics()
+            self.assertEqual((metrics["throttled_near_karts"], metrics["throttled_login"], metrics["throttled_requests"]), (1, 1, 2))
+
+    def test_concurrent_requests(self):
+        """ concurrent requests of a client cannot take the same token """
+        rates = dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], near_karts='5/min')
+        request = APIRequestFactory().post("/near_karts/")
+        request.user = self.user
+        allowed = []
+
+        def run():
+            allowed.append(ScopedBucketThrottle().allow_request(request, views.GetNearKartsView()))
+        with override_settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            threads = [threading.Thread(target=run) for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(allowed.count(True), 5)
+
+
+class SnapshotTest(BaseViewTest):
+    """
+    Tests the shared memory snapshot read by available_karts/ and near_karts/
+    """
+    def test_snapshot(self):
+        self.login_for_auth("test@mail.com", "testing")
+        karts = list(Kart.objects.order_by('id'))
+        start = datetime.now() + timedelta(days=1)
+        end = start + timedelta(hours=2)
+        Booking.objects.create(start_time=start, end_time=end, user=self.user, kart=karts[0])
+        Booking.objects.create(start_time=end + timedelta(hours=1), end_time=end + timedelta(hours=3), user=self.user, kart=karts[1])
+        with tempfile.TemporaryDirectory() as directory, override_settings(KTKART_SNAPSHOT_PATH=os.path.join(directory, 'snapshot')):
+            self.assertEqual(get_snapshot(start, end), None)
+            self.assertEqual(publish_snapshot(), (10, 2))
+
+            """ available karts are read from the snapshot, not from the database """
+            with self.assertNumQueries(1):
+                response = self.get_available_karts(str(start), str(end + timedelta(hours=1)))
+            self.assertEqual([kart["id"] for kart in response.data], [kart.id for kart in karts[2:]])
+            self.assertEqual(response.data[0], KartValuesSerializer(Kart.objects.filter(id=karts[2].id)).data[0])
+            with self.assertNumQueries(1):
+                response = self.client.post(reverse("near_karts"), data=json.dumps({"lat": 48, "lng": 2}), content_type='application/json')
+            self.assertEqual(len(response.data), 10)
+
+            """ after a booking write the snapshot is not used until it is published again """
+            Booking.objects.create(start_time=start, end_time=end, user=self.user, kart=karts[2])
+            self.assertEqual(get_snapshot(start, end), None)
+            publish_snapshot()
+            snapshot = get_snapshot(start, end)
+            self.assertEqual([kart[0] for kart in snapshot.available(start, end)], [kart.id for kart in karts[1:2] + karts[3:]])
+            self.assertEqual(get_snapshot(start - timedelta(days=2), end), None)
+
+
+class AvailableKartsFiltersTest(BaseViewTest):
+    """
+    Tests available_karts/ filters
+    """
+    def test_filters(self):
+        self.login_for_auth("test@mail.com", "testing")
+        start = datetime(2030, 1, 1, 16, 0, 0, 1)
+        end = start + timedelta(hours=2)
+        falcon = Kart.objects.filter(type="Blue Falcon").order_by('id').first()
+        Booking.objects.create(start_time=start, end_time=end, user=self.user, kart=falcon)
+        available = lambda **params: self.client.post(
+            reverse("available_karts") + "?" + "&".join("{}={}".format(*param) for param in params.items()),
+            data=json.dumps({"start": str(start), "end": str(end)}), content_type='application/json'
+        )
+
+        """ type, cost range, area and field selection """
+        response = available(type="Blue Falcon", fields="id,hourly_cost")
+        self.assertEqual(response.data, [{"id": falcon.id + 1, "hourly_cost": 15}])
+        response = available(min_cost=12, ordering="-hourly_cost", fields="hourly_cost")
+        self.assertEqual(response.data, [{"hourly_cost": 25}] * 3 + [{"hourly_cost": 15}])
+        response = available(bbox="47.9,1.9,48.6,2.6", max_cost=10)
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(response.data[0], KartValuesSerializer(Kart.objects.filter(type="Standard").order_by('id')).data[0])
+
+        """ without filters all available karts are returned """
+        self.assertEqual(len(available().data), 9)
+
+        """ bad filters are refused """
+        for params in ({"bbox": "1,2,3"}, {"ordering": "latitude"}, {"fields": "id,user"}, {"min_cost": "cheap"}):
+            self.assertEqual(available(**params).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class AvailabilityWindowsTest(BaseViewTest):
+    """
+    Tests available_karts/windows/ endpoint
+    """
+    def test_windows(self):
+        self.login_for_auth("test@mail.com", "testing")
+        karts = [kart.id for kart in Kart.objects.order_by('id')]
+        day = datetime(2030, 1, 1, 0, 0, 0, 1)
+        Booking.objects.create(start_time=day + timedelta(hours=16), end_time=day + timedelta(hours=18), user=self.user, kart_id=karts[0])
+        Booking.objects.create(start_time=day + timedelta(days=2), end_time=day + timedelta(days=2, hours=1), user=self.user, kart_id=karts[1])
+        windows = [(day + timedelta(hours=hour), day + timedelta(hours=hour + 1)) for hour in (17, 15, 18, 20)] + \
+            [(day + timedelta(days=2, minutes=30), day + timedelta(days=2, minutes=45))]
+        post = lambda: self.client.post(reverse("available_karts-windows"), data=json.dumps({
+            "windows": [{"start": str(start), "end": str(end)} for start, end in windows]
+        }), content_type='application/json')
+        post()
+
+        """ one query for the bookings of all windows """
+        with self.assertNumQueries(2):
+            response = post()
+        self.assertEqual([window["kart_ids"] for window in response.data["windows"]], [
+            karts[1:], karts[1:], karts[1:], karts, karts[:1] + karts[2:]
+        ])
+
+        """ the result is the same as available_karts/ for each window """
+        for (start, end), window in zip(windows, response.data["windows"]):
+            self.assertEqual([kart["id"] for kart in self.get_available_karts(str(start), str(end)).data], window["kart_ids"])
+
+
+class UsageRollupTest(BaseViewTest):
+    """
+    Tests the usage rollups and analytics/usage/ endpoint
+    """
+    def rollups(self):
+        return sorted(KartDailyUsage.objects.filter(booked_hours__gt=1e-6).values_list('kart_id', 'day', 'booked_hours', 'revenue'))
+
+    def test_usage_rollups(self):
+        self.login_for_auth("test@mail.com", "testing")
+        standard, cruiser = Kart.objects.filter(type="Standard").first(), Kart.objects.filter(type="Cat Cruiser").first()
+        day = (datetime.now() + timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=1)
+
+        """ bookings are split by day """
+        first = self.post_booking(str(day - timedelta(hours=2)), str(day + timedelta(hours=2)), standard.id).data["reservation"]["id"]
+        second = self.post_booking(str(day + timedelta(hours=10)), str(day + timedelta(hours=12)), cruiser.id).data["reservation"]["id"]
+        self.update_booking(str(day + timedelta(hours=1)), str(day + timedelta(hours=3)), first)
+        self.delete_booking(second)
+        self.assertEqual(self.rollups(), [(standard.id, day.date(), 2.0, 20.0)])
+
+        """ the rebuilt rollups are the same as the incremental ones """
+        incremental = self.rollups()
+        self.assertEqual(rebuild_rollups(), 1)
+        self.assertEqual(self.rollups(), incremental)
+
+        """ the revenue is what was paid, not the price at the current rules """
+        with override_settings(KTKART_PRICING_RULES=[('ktkart.api.pricing.DurationDiscountRule', {'min_hours': 1, 'discount': 0.5})]):
+            rebuild_rollups()
+            self.assertEqual(self.rollups(), incremental)
+
+        """ admin reads the usage of a period """
+        response = self.client.get(reverse("analytics-usage"), {"start": str(day.date() - timedelta(days=1)), "end": str(day.date())})
+        self.assertEqual(response.data["usage"], [{"kart": standard.id, "booked_hours": 2.0, "revenue": 20.0, "utilization": 0.0417}])
+        response = self.client.get(reverse("analytics-usage"), {"start": str(day.date()), "end": str(day.date()), "by": "day"})
+        self.assertEqual(response.data["usage"][0]["utilization"], 0.0833)
+        response = self.client.get(reverse("analytics-usage"), {"start": "yesterday", "end": str(day.date())})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class NearKartsTest(BaseViewTest):
+    """
+    Tests near_karts/ ranking by distance and wait time
+    """
+    def near(self):
+        return self.client.post(reverse("near_karts"), data=json.dumps({"lat": 48, "lng": 2}), content_type='application/json')
+
+    def test_near_karts(self):
+        self.login_for_auth("test@mail.com", "testing")
+        karts = [kart.id for kart in Kart.objects.order_by('id')]
+        now = datetime.now()
+        Booking.objects.create(start_time=now - timedelta(hours=1), end_time=now + timedelta(minutes=30), user=self.user, kart_id=karts[0])
+        Booking.objects.create(start_time=now + timedelta(minutes=40), end_time=now + timedelta(hours=2), user=self.user, kart_id=karts[0])
+        Booking.objects.create(start_time=now + timedelta(hours=2), end_time=now + timedelta(hours=3), user=self.user, kart_id=karts[1])
+        Kart.objects.filter(id=karts[2]).update(free_until=now - timedelta(minutes=1))
+
+        """ busy karts are ranked by distance plus wait time, no booking is read """
+        with self.assertNumQueries(2):
+            response = self.near()
+        self.assertEqual([kart["id"] for kart in response.data], karts[1:2] + karts[3:5] + karts[0:1] + karts[5:] + karts[2:3])
+        nearest, busy = response.data[0], response.data[3]
+        self.assertEqual((nearest["wait_minutes"], nearest["free_until"]), (0, now + timedelta(hours=2)))
+        self.assertEqual((busy["wait_minutes"] > 119, busy["next_free_at"]), (True, now + timedelta(hours=2)))
+        self.assertEqual(response.data[-1]["wait_minutes"], None)
+
+        """ the snapshot gives the same ranking """
+        Kart.objects.filter(id=karts[2]).update(free_until=None)
+        with tempfile.TemporaryDirectory() as directory, override_settings(KTKART_SNAPSHOT_PATH=os.path.join(directory, 'snapshot')):
+            expected = [kart["id"] for kart in self.near().data]
+            publish_snapshot()
+            with self.assertNumQueries(1):
+                response = self.near()
+            self.assertEqual([kart["id"] for kart in response.data], expected)
+
+    def test_short_free_window(self):
+        self.login_for_auth("test@mail.com", "testing")
+        kart = Kart.objects.order_by('id').first()
+        now = datetime.now()
+        Booking.objects.create(start_time=now + timedelta(minutes=30), end_time=now + timedelta(hours=2), user=self.user, kart=kart)
+        """ free period computed an hour ago, less than a booking is left of it """
+        Kart.objects.filter(id=kart.id).update(next_free_at=now - timedelta(hours=1), free_until=now + timedelta(minutes=30))
+        response = self.near()
+        self.assertEqual(response.data[-1]["id"], kart.id)
+        self.assertEqual(response.data[-1]["wait_minutes"], None)
+
+        """ the command refreshes it """
+        call_command('refresh_next_free', stdout=io.StringIO())
+        kart.refresh_from_db()
+        self.assertEqual((kart.next_free_at, kart.free_until), (now + timedelta(hours=2), None))
+        wait = {row["id"]: row["wait_minutes"] for row in self.near().data}[kart.id]
+        self.assertGreater(wait, 119)
+
+
+class ShardingTest(BaseViewTest):
+    """
+    Tests the booking shards, run with ktkart.settings_shards to use several databases
+    """
+
+    @override_settings(KTKART_BOOKING_SHARDS=['default', 'bookings_1', 'bookings_2'])
+    def test_router(self):
+        router = BookingShardRouter()
+        kart = Kart.objects.first()
+        self.assertEqual(shard_for_kart(kart.id), ['default', 'bookings_1', 'bookings_2'][kart.id % 3])
+        self.assertEqual(group_by_shard([3, 4, 6]), {'default': [3, 6], 'bookings_1': [4]})
+        """ bookings go to the shard of their kart, the other models to the default database """
+        booking = Booking(start_time=datetime.now(), end_time=datetime.now(), kart=kart, user=self.user)
+        self.assertEqual(router.db_for_write(Booking, instance=booking), shard_for_kart(kart.id))
+        self.assertEqual(router.db_for_read(Kart, instance=booking), 'default')
+        """ with several shards a booking query has to pick one """
+        with self.assertRaises(ShardNotSelected):
+            router.db_for_read(Booking)
+        with self.assertRaises(ShardNotSelected):
+            list(Booking.objects.all())
+        with override_settings(KTKART_BOOKING_SHARDS=['default']):
+            self.assertEqual(router.db_for_read(Booking), None)
+        self.assertEqual(router.allow_migrate('bookings_1', 'api', 'booking'), True)
+        self.assertEqual(router.allow_migrate('bookings_1', 'api', 'kart'), False)
+        self.assertEqual(router.allow_migrate('default', 'api', 'kart'), True)
+
+    def test_allocate_booking_ids(self):
+        """ ids are reserved in one insert, the old rows are pruned """
+        with self.assertNumQueries(2):
+            ids = allocate_booking_ids(5)
+        self.assertEqual(ids, sorted(set(ids)))
+        with mock.patch.object(sharding, 'BOOKING_IDS_KEPT', 4):
+            more = allocate_booking_ids(4)
+        self.assertGreater(more[0], ids[-1])
+        self.assertEqual(list(BookingId.objects.order_by('id').values_list('id', flat=True)), [i for i in ids + more if i > more[0] - 4])
+
+    @skipUnless(is_sharded(), "bookings are not sharded")
+    def test_sharded_bookings(self):
+        self.login_for_auth("test@mail.com", "testing")
+        karts = list(Kart.objects.order_by('id')[:len(booking_shards())])
+        start = datetime.now() + timedelta(hours=1)
+        end = start + timedelta(hours=1)
+        ids = []
+        for kart in karts:
+            response = self.post_booking(str(start), str(end), kart.id)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.append(response.data["reservation"]["id"])
+
+        """ each booking is on the shard of its kart, ids are unique over the shards """
+        self.assertEqual(len(set(ids)), len(karts))
+        for kart in karts:
+            self.assertEqual(bookings_on(shard_for_kart(kart.id)).filter(kart=kart).count(), 1)
+        self.assertEqual(sorted(booking["id"] for booking in self.get_booking().data), sorted(ids))
+        response = self.get_available_karts(str(start), str(end))
+        self.assertEqual({kart["id"] for kart in response.data} & {kart.id for kart in karts}, set())
+        response = self.post_booking(str(start), str(end), karts[-1].id)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        """ bookings are found, updated and deleted on their shard """
+        response = self.update_booking(str(start), str(end + timedelta(hours=1)), ids[-1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.delete_booking(ids[-1])
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(bookings_on(shard_for_kart(karts[-1].id)).count(), 0)
+
+        """ deleting a kart or a user deletes their bookings on every shard """
+        karts[1].delete()
+        self.assertEqual(self.bookings(kart_id=karts[1].id), [])
+        self.assertEqual(len(self.bookings()), 1)
+        self.user.delete()
+        self.assertEqual(self.bookings(), [])
+
+
+class OptimisticConcurrencyTest(BaseViewTest):
+    """
+    Tests the compare and swap saves of bookings and balances
+    """
+    def test_stale_save(self):
+        kart = Kart.objects.first()
+        start = datetime.now() + timedelta(hours=1)
+        booking = Booking.objects.create(start_time=start, end_time=start + timedelta(hours=1), user=self.user, kart=kart)
+        first, second = find_booking(booking.id), find_booking(booking.id)
+        first.end_time = start + timedelta(hours=2)
+        first.save()
+        self.assertEqual(first.version, 1)
+        """ the second writer read version 0, its save is refused (and rolls back its transaction) """
+        second.end_time = start + timedelta(hours=3)
+        with self.assertRaises(StaleVersion), transaction.atomic(using=second._state.db):
+            second.save(update_fields=['end_time'])
+        self.assertEqual(find_booking(booking.id).end_time, start + timedelta(hours=2))
+        with self.assertRaises(StaleVersion), transaction.atomic(using=second._state.db):
+            second.claim()
+
+        """ balance increments move the version, a read-modify-write of the balance is refused """
+        balance = Balance.objects.get(user=self.user)
+        self.client.force_authenticate(self.user)
+        self.post_booking(str(start + timedelta(hours=4)), str(start + timedelta(hours=5)), kart.id)
+        balance.balance = 500
+        with self.assertRaises(StaleVersion), transaction.atomic():
+            balance.save()
+        self.assertEqual(Balance.objects.get(user=self.user).balance, 90)
+
+    def test_conflict_response(self):
+        self.login_for_auth("test@mail.com", "testing")
+        kart = Kart.objects.first()
+        start = datetime.now() + timedelta(hours=1)
+        booking_id = self.post_booking(str(start), str(start + timedelta(hours=1)), kart.id).data["reservation"]["id"]
+
+        def changed_meanwhile(booking_id, user):
+            booking = get_user_booking(booking_id, user)
+            bookings_on(booking._state.db).filter(id=booking.id).update(version=F('version') + 1)
+            return booking
+        get_user_booking = views.get_user_booking
+
+        """ a booking changed between the read and the save gets a retryable 409, nothing is charged """
+        with mock.patch.object(views, 'get_user_booking', changed_meanwhile):
+            response = self.update_booking(str(start), str(start + timedelta(hours=2)), booking_id)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+            response = self.delete_booking(booking_id)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Balance.objects.get(user=self.user).balance, 90)
+        self.assertEqual(find_booking(booking_id).end_time, start + timedelta(hours=1))
+
+        """ the retry succeeds """
+        response = self.update_booking(str(start), str(start + timedelta(hours=2)), booking_id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Balance.objects.get(user=self.user).balance, 80)
+
+
+class AdminTest(BaseViewTest):
+    """
+    Tests the admin changelists and the cancel and refund action
+    """
+    def test_estimated_count(self):
+        paginator = api_admin.EstimatedCountPaginator(bookings_on(booking_shards()[0]).order_by('id'), 50)
+        """ SQLite has no estimate, the rows are counted """
+        self.assertEqual(paginator.count, 0)
+        with mock.patch.object(api_admin, 'estimated_count', return_value=2000000):
+            paginator = api_admin.EstimatedCountPaginator(bookings_on(booking_shards()[0]).order_by('id'), 50)
+            with self.assertNumQueries(0):
+                self.assertEqual(paginator.num_pages, 40000)
+            """ filtered lists are counted """
+            paginator = api_admin.EstimatedCountPaginator(bookings_on(booking_shards()[0]).filter(kart_id=1).order_by('id'), 50)
+            self.assertEqual(paginator.count, 0)
+            """ an estimate too high is corrected by the short last page, pages past it show the last one """
+            paginator = api_admin.EstimatedCountPaginator(bookings_on(booking_shards()[0]).order_by('id'), 50)
+            self.assertEqual(paginator.page(3).number, 1)
+            self.assertEqual((paginator.count, paginator.num_pages), (0, 1))
+
+        """ pages past an estimate too low are counted """
+        kart, now = Kart.objects.first(), datetime.now()
+        for i in range(3):
+            Booking.objects.create(start_time=now + timedelta(hours=i + 1), end_time=now + timedelta(hours=i + 2), user=self.user, kart=kart)
+        with mock.patch.object(api_admin, 'estimated_count', return_value=1):
+            paginator = api_admin.EstimatedCountPaginator(bookings_on(shard_for_kart(kart.id)).order_by('id'), 1)
+            paginator.exact_below = 1
+            self.assertEqual(paginator.num_pages, 1)
+            self.assertEqual(len(paginator.page(3)), 1)
+            self.assertEqual(paginator.num_pages, 3)
+
+    def test_cancel_and_refund(self):
+        self.client.login(username="test@mail.com", password="testing")
+        karts = list(Kart.objects.order_by('id'))
+        now = datetime.now()
+        upcoming = [
+            Booking.objects.create(start_time=now + timedelta(hours=i + 1), end_time=now + timedelta(hours=i + 2), user=self.user, kart=kart)
+            for i, kart in enumerate(karts[:3])
+        ]
+        started = Booking.objects.create(start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1), user=self.user, kart=karts[3])
+        # paid at former prices
+        post_entries(self.user, [(-12, LedgerEntry.BOOKING, booking.id) for booking in upcoming])
+        response = self.client.get(reverse("admin:api_booking_changelist"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        """ the shards are listed one at a time, bookings are opened on their shard """
+        if is_sharded():
+            for alias in booking_shards():
+                response = self.client.get(reverse("admin:api_booking_changelist"), {"shard": alias})
+                self.assertEqual(len(response.context["cl"].result_list), len(bookings_on(alias).all()))
+        for booking in upcoming:
+            response = self.client.get(reverse("admin:api_booking_change", args=[booking.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(reverse("admin:api_booking_delete", args=[booking.id]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.post(reverse("admin:api_booking_changelist"), {
+            "action": "cancel_and_refund",
+            "_selected_action": [booking.id for booking in upcoming] + [started.id]
+        })
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual([booking.id for booking in self.bookings()], [started.id])
+        """ one refund entry per booking, of the amount paid, the balance is updated once """
+        self.assertEqual(Balance.objects.get(user=self.user).balance, 100)
+        self.assertEqual(LedgerEntry.objects.filter(reason=LedgerEntry.REFUND).count(), 3)
+
+    def test_balance_read_only(self):
+        self.client.login(username="test@mail.com", password="testing")
+        balance = Balance.objects.get(user=self.user)
+        url = reverse("admin:api_balance_change", args=[balance.id])
+        self.assertNotIn("balance", self.client.get(url).context["adminform"].form.fields)
+        """ a balance posted from the form is ignored, it would have no ledger entry """
+        response = self.client.post(url, {"user": self.user.id, "balance": 1000})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(Balance.objects.get(user=self.user).get_balance(), 100)
+        self.assertFalse(LedgerEntry.objects.filter(user=self.user).exists())
+
+
+class ImportUsersTest(BaseViewTest):
+    """
+    Tests users/import/ endpoint and the bulk import of users
+    """
+    def test_import_users(self):
+        self.login_for_auth("test@mail.com", "testing")
+        csv_file = SimpleUploadedFile("users.csv", (
+            b"email,password,balance\n"
+            b"first@mail.com,password,20\n"
+            b"test@mail.com,password\n"
+            b"not an email,password\n"
+            b"first@mail.com,other\n"
+            b"second@mail.com,password\n"
+            b"third@mail.com,,-1\n"
+            b"fourth@mail.com,password,inf\n"
+        ))
+        response = self.client.post(reverse("users-import"), data={"file": csv_file})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual([failure["line"] for failure in response.data["failures"]], [2, 3, 4, 6, 7])
+        self.assertEqual(Balance.objects.get(user__email="first@mail.com").get_balance(), 20)
+        self.assertEqual(Balance.objects.get(user__email="second@mail.com").get_balance(), 5)
+        """ balances of the imported users match the ledger, they can log in """
+        self.assertEqual([user_id for user_id, balance, total in reconcile()], [self.user.id])
+        self.assertEqual(self.login_user("second@mail.com", "password").status_code, status.HTTP_200_OK)
+
+        """ from a JSON list, without password the user has to reset it """
+        response = self.client.post(reverse("users-import"), data=json.dumps({
+            "users": [{"email": "third@mail.com"}, "first@mail.com"]
+        }), content_type='application/json')
+        self.assertEqual(response.data["created"], 1)
+        self.assertEqual(len(response.data["failures"]), 1)
+        self.assertFalse(User.objects.get(email="third@mail.com").has_usable_password())
+
+    def test_password_processes(self):
+        with ProcessPoolExecutor(2) as executor:
+            created, failures = import_users([("first@mail.com", "password"), ("second@mail.com", "secret", "10")], executor=executor)
+        self.assertEqual((created, failures), (2, []))
+        self.assertTrue(User.objects.get(email="second@mail.com").check_password("secret"))
+
+    def test_registered_during_import(self):
+        """ emails registered between the query and the insert twice in a row are reported """
+        with mock.patch.object(User.objects, 'bulk_create', side_effect=IntegrityError):
+            created, failures = import_users([("first@mail.com", "password")])
+        self.assertEqual(created, 0)
+        self.assertEqual([failure["line"] for failure in failures], [1])
+        self.assertFalse(User.objects.filter(email="first@mail.com").exists())
+
+
+class ResponseFormatTest(BaseViewTest):
+    """
+    Tests the columnar JSON and MessagePack formats and the response compression
+    """
+    def setUp(self):
+        super().setUp()
+        self.login_for_auth("test@mail.com", "testing")
+        self.start = str(datetime.now() + timedelta(hours=1))
+        self.end = str(datetime.now() + timedelta(hours=2))
+
+    def test_columns(self):
+        response = self.get_available_karts(self.start, self.end)
+        rows, etag = response.data, response['ETag']
+        self.assertEqual(len(rows), 10)
+        """ the same data, one list per field, with its own etag """
+        response = self.get_available_karts(self.start, self.end, HTTP_ACCEPT='application/json; format=columns', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/json; format=columns')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Accept', response['Vary'])
+        columns = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(columns["id"], [row["id"] for row in rows])
+        self.assertEqual(columns["type"], [row["type"] for row in rows])
+        response = self.client.post(reverse("available_karts") + "?format=columns", data=json.dumps({"start": self.start, "end": self.end}), content_type='application/json')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), columns)
+        """ plain JSON is still the default """
+        response = self.get_available_karts(self.start, self.end, HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), json.loads(json.dumps(rows)))
+
+    def test_msgpack(self):
+        with mock.patch.object(MessagePackRenderer, 'available', False):
+            response = self.get_booking(HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        if msgpack is None:
+            return
+        self.post_booking(self.start, self.end, Kart.objects.first().id)
+        response = self.get_booking(HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), json.loads(self.get_booking().content.decode('utf-8')))
+
+    @override_settings(KTKART_COMPRESSION_MIN_BYTES=200)
+    def test_compression(self):
+        plain = self.get_available_karts(self.start, self.end).content
+        response = self.get_available_karts(self.start, self.end, HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        self.assertEqual(gzip.decompress(response.content), plain)
+        if brotli is not None:
+            response = self.get_available_karts(self.start, self.end, HTTP_ACCEPT_ENCODING='gzip, br')
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.content), plain)
+        """ small responses are sent as they are """
+        response = self.get_balance()
+        self.assertFalse(response.has_header('Content-Encoding'))
@@ -0,0 +1,103 @@
+from math import ceil
+from time import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .cache import acquire_lock, release_lock
+
+BUCKET_KEY = 'ktkart:throttle:{}:{}'
+LOCK_KEY = 'ktkart:throttle:lock:{}:{}'
+# seconds a bucket stays locked at most, and a request waits at most for it
+LOCK_TIMEOUT = 1
+LOCK_WAIT = 0.1
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """
+    '60/min' -> (60, 1.0): a bucket of 60 tokens refilled with one token per second
+    """
+    num, period = rate.split('/')
+    capacity = int(num)
+    return capacity, capacity / PERIODS[period[0]]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Token bucket throttle: each client has a bucket of `capacity` tokens (the number of
+    the rate) refilled continuously over the period, each request takes one token.
+    Buckets live in the KTKART_THROTTLE_CACHE cache, use a cache shared by all workers in production,
+    each one is updated under a lock taken with an atomic add.
+    Subclasses tell the scope and the client of a request.
+    """
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def get_scope(self, request, view):
+        raise NotImplementedError('.get_scope() must be overridden')
+
+    def get_client(self, request):
+        if request.user and request.user.is_authenticated:
+            return request.user.pk
+        return self.get_ident(request)
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+        capacity, per_second = parse_rate(rate)
+        backend = caches[getattr(settings, 'KTKART_THROTTLE_CACHE', 'default')]
+        client = self.get_client(request)
+        key, lock_key = BUCKET_KEY.format(scope, client), LOCK_KEY.format(scope, client)
+        # the bucket is read and written under a lock, concurrent requests cannot take the same token
+        token = uuid4().hex
+        if not acquire_lock(backend, lock_key, token, LOCK_TIMEOUT, LOCK_WAIT):
+            # too many requests of the client at once
+            return self.throttle(scope, 1 / per_second)
+        try:
+            now = time()
+            tokens, updated_at = backend.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * per_second)
+            # an untouched bucket is full again once it expires
+            timeout = ceil(capacity / per_second)
+            if tokens < 1:
+                backend.set(key, (tokens, now), timeout)
+                return self.throttle(scope, (1 - tokens) / per_second)
+            backend.set(key, (tokens - 1, now), timeout)
+        finally:
+            release_lock(backend, lock_key, token)
+        return True
+
+    def throttle(self, scope, wait_seconds):
+        self.wait_seconds = wait_seconds
+        metrics.incr('throttled_requests')
+        metrics.incr('throttled_{}'.format(scope))
+        return False
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UserBucketThrottle(TokenBucketThrottle):
+    """
+    Budget of each user over all routes, the 'user' rate, or the 'anon' rate by IP address
+    """
+
+    def get_scope(self, request, view):
+        return 'user' if request.user and request.user.is_authenticated else 'anon'
+
+
+class ScopedBucketThrottle(TokenBucketThrottle):
+    """
+    Separate budget of each user on the expensive routes, the rate of the view `throttle_scope`
+    """
+
+    def get_scope(self, request, view):
+        return getattr(view, 'throttle_scope', None)
@@ -1,15 +1,28 @@
 from django.urls import path
 from ktkart.api.views import RegisterView, LoginView, GetBalanceView, UpdateBalanceView
 from ktkart.api.views import GetAvailableKartsView, BookingView, GetNearKartsView, PopulateView, MultipleBookingView
+from ktkart.api.views import MetricsView, BulkUpdateBalanceView, BatchBookingView, RecurringBookingView, AllocateView, QuoteView, TelemetryView
+from ktkart.api.views import AvailabilityStreamView, AvailabilityWindowsView, UsageAnalyticsView, ImportUsersView
 
 urlpatterns = [
     path('auth/register/', RegisterView.as_view(), name="auth-register"),
     path('auth/login/', LoginView.as_view(), name="auth-login"),
     path('balance/get/', GetBalanceView.as_view(), name="balance-get"),
     path('balance/update/', UpdateBalanceView.as_view(), name="balance-update"),
+    path('balance/bulk_update/', BulkUpdateBalanceView.as_view(), name="balance-bulk-update"),
+    path('users/import/', ImportUsersView.as_view(), name="users-import"),
     path('available_karts/', GetAvailableKartsView.as_view(), name="available_karts"),
     path('booking/', BookingView.as_view(), name="booking"),
+    path('booking/batch/', BatchBookingView.as_view(), name="booking-batch"),
+    path('booking/recurring/', RecurringBookingView.as_view(), name="booking-recurring"),
     path('near_karts/', GetNearKartsView.as_view(), name="near_karts"),
     path('multiple_booking/', MultipleBookingView.as_view(), name="multiple_booking"),
-    path('populate/', PopulateView.as_view(), name="populate")
+    path('allocate/', AllocateView.as_view(), name="allocate"),
+    path('quote/', QuoteView.as_view(), name="quote"),
+    path('telemetry/', TelemetryView.as_view(), name="telemetry"),
+    path('available_karts/windows/', AvailabilityWindowsView.as_view(), name="available_karts-windows"),
+    path('availability/stream/', AvailabilityStreamView.as_view(), name="availability-stream"),
+    path('populate/', PopulateView.as_view(), name="populate"),
+    path('analytics/usage/', UsageAnalyticsView.as_view(), name="analytics-usage"),
+    path('metrics/', MetricsView.as_view(), name="metrics"),
 ]
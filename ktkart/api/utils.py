@@ -1,5 +1,19 @@
+from datetime import datetime
+from itertools import islice
 from math import radians, cos, sin, asin, sqrt
 
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def parse_datetime(value):
+    """
+    Parse a datetime sent by a client, raise ValueError if it is not formatted as DATETIME_FORMAT
+    """
+    if not isinstance(value, str):
+        raise ValueError()
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
 def distance(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance between two points
@@ -15,3 +29,15 @@ def distance(lon1, lat1, lon2, lat2):
     # Radius of earth in kilometers is 6371
     km = 6371* c
     return km
+
+
+def chunks(iterable, size):
+    """
+    Split an iterable in lists of `size` items, the last one may be shorter
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
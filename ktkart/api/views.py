@@ -10,16 +10,62 @@ from validate_email import validate_email
 from datetime import datetime, timedelta
 from random import random
 from .utils import distance
-
-from django.db.models import Q, Sum
-from .models import Kart, Balance, Booking
+from .cache import EPOCH, get_versions, make_etag, etag_matches, availability_generations, cached_availability
+from .metrics import get_metrics
+from .coalesce import single_flight
+from .bulk import BALANCE_UPDATE_MODES, SIGNUP_BALANCE, import_users, read_csv, update_balances
+from .ledger import InsufficientBalance, booking_payments, open_balance, post_entry, post_entries, set_balance
+from .batch import BATCH_MODES, Batch
+from .availability import MIN_BOOKING, busy_periods, sweep_conflicts, free_karts_by_window
+from .signals import bookings_created
+from .bookings import KartsNotAvailable, book_karts, kart_price, lock_karts
+from .pricing import booking_price, booking_prices
+from .fleet import get_fleet
+from .telemetry import read_reports, telemetry_buffer
+from .events import get_hub, stream
+from .idempotency import idempotent
+from .snapshot import get_snapshot, seconds
+from .filters import KART_FILTERS, InvalidFilter, kart_filters
+from .rollups import usage_report
+from . import sharding
+from .sharding import bookings_on, bulk_create_bookings, busy_kart_ids, find_booking, group_by_shard, scatter
+from .renderers import EventStreamRenderer, FastJSONRenderer
+from .utils import parse_datetime
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.db.models import Q
+from .models import Kart, Balance, Booking, ArchivedBooking, LedgerEntry, StaleVersion
 from .serializers import KartSerializer, BalanceSerializer, BookingSerializer, TokenSerializer
+from .serializers import KartValuesSerializer, BookingValuesSerializer, ArchivedBookingValuesSerializer
 
 # Get the JWT settings
 jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
 jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
 
 
+def get_user_booking(booking_id, user):
+    """
+    The booking of the user with this id, on any shard, raise Booking.DoesNotExist if there is none
+    """
+    booking = find_booking(booking_id, user=user)
+    if booking is None:
+        raise Booking.DoesNotExist()
+    return booking
+
+
+def etag_headers(etag):
+    # the etags depend on the format negotiated from the Accept header (rows, columns or msgpack)
+    return {'ETag': etag, 'Vary': 'Accept'}
+
+
+def not_modified(etag):
+    """
+    Response to a conditional request when the client already has the latest data
+    """
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+
+
 class RegisterView(APIView):
     """
     POST auth/register/
@@ -39,7 +85,7 @@ class RegisterView(APIView):
             return Response(data="This email is already used by someone.", status=status.HTTP_401_UNAUTHORIZED)
         else:
             new_user = User.objects.create_user(email=email, password=password, username=email)
-            Balance.objects.create(balance=5, user=new_user)
+            open_balance(new_user, SIGNUP_BALANCE)
             return Response(data="Your account was successfully created.", status=status.HTTP_201_CREATED)
 
 
@@ -50,6 +96,7 @@ class LoginView(APIView):
     """
 
     permission_classes = (permissions.AllowAny,)
+    throttle_scope = 'login'
     queryset = User.objects.all()
 
     def post(self, request):
@@ -98,14 +145,65 @@ class UpdateBalanceView(APIView):
             new_balance = request.data.get("new_balance", "")
             if new_balance >= 0:
                 user = User.objects.get(email=email)
-                updated_balance = Balance.objects.get(user=user)
-                updated_balance.balance = new_balance
-                updated_balance.save()
+                updated_balance = set_balance(user, new_balance)
                 return Response(BalanceSerializer(updated_balance).data)
             return Response(data="Balance must be positive.", status=status.HTTP_401_UNAUTHORIZED)
         except User.DoesNotExist:
             return Response(data="User with provided email not found.", status=status.HTTP_404_NOT_FOUND)
+        except StaleVersion:
+            return Response(data="The balance was changed by another request, please retry.", status=status.HTTP_409_CONFLICT)
+
+
+
+class BulkUpdateBalanceView(APIView):
+    """
+    POST balance/bulk_update/
+    Admin user can set or increment the balance of many users in one request,
+    from a list of email/amount pairs or from an uploaded CSV file
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
 
+    def post(self, request):
+        mode = request.data.get("mode", "set")
+        if mode not in BALANCE_UPDATE_MODES:
+            return Response(data="Mode must be set or increment.", status=status.HTTP_401_UNAUTHORIZED)
+        if "file" in request.FILES:
+            rows = read_csv(request.FILES["file"], ("email", "amount"))
+        else:
+            updates = request.data.get("updates", [])
+            if not isinstance(updates, list):
+                return Response(data="Updates must be a list of email and amount.", status=status.HTTP_401_UNAUTHORIZED)
+            rows = [(update.get("email"), update.get("amount")) if isinstance(update, dict) else None for update in updates]
+        updated, failures = update_balances(rows, mode)
+        return Response({
+            "updated": updated,
+            "failures": failures
+        })
+
+
+class ImportUsersView(APIView):
+    """
+    POST users/import/
+    Admin user can create many users with their balance in one request,
+    from a list of email/password/balance objects or from an uploaded CSV file
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def post(self, request):
+        if "file" in request.FILES:
+            rows = read_csv(request.FILES["file"], ("email", "password", "balance"))
+        else:
+            users = request.data.get("users", [])
+            if not isinstance(users, list):
+                return Response(data="Users must be a list of email, password and balance.", status=status.HTTP_401_UNAUTHORIZED)
+            rows = [(user.get("email"), user.get("password", ""), user.get("balance", "")) if isinstance(user, dict) else None for user in users]
+        created, failures = import_users(rows)
+        return Response({
+            "created": created,
+            "failures": failures
+        })
 
 
 class GetAvailableKartsView(APIView):
@@ -121,11 +219,63 @@ class GetAvailableKartsView(APIView):
         try:
             start = datetime.strptime(request.data.get("start", ""), '%Y-%m-%d %H:%M:%S.%f')
             end = datetime.strptime(request.data.get("end", ""), '%Y-%m-%d %H:%M:%S.%f')
-            overlaping_bookings = Booking.objects.filter(Q(end_time__gte=start) & Q(start_time__lte=end)).values('kart').distinct()
-            available_karts = Kart.objects.exclude(id__in=overlaping_bookings)
-            return Response(KartSerializer(available_karts, many=True).data)
         except ValueError:
             return Response("Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f")
+        # filters come from the query string or the body
+        params = {name: request.query_params.get(name, request.data.get(name)) for name in KART_FILTERS}
+        try:
+            filters, ordering, fields = kart_filters(params)
+        except InvalidFilter as error:
+            return Response(data=str(error), status=status.HTTP_401_UNAUTHORIZED)
+        variant = (sorted(filters.items()), ordering, fields)
+        versions = get_versions('bookings', 'karts', 'positions')
+        etag = make_etag('available_karts', start, end, variant, versions, request.accepted_renderer.format)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        # identical concurrent requests share one query, a request made after a write does not get
+        # the result of a query started before it
+        generations = availability_generations(start, end)
+        available_karts = cached_availability(start, end, lambda: single_flight.do(
+            ('available_karts', start, end, repr(variant), tuple(versions), tuple(generations)),
+            lambda: self.get_available_karts(start, end, filters, ordering, fields)
+        ), variant, generations)
+        return Response(available_karts, headers=etag_headers(etag))
+
+    def get_available_karts(self, start, end, filters=None, ordering='id', fields=KartValuesSerializer.fields):
+        if not filters and ordering == 'id' and fields == KartValuesSerializer.fields:
+            snapshot = get_snapshot(start, end)
+            if snapshot is not None:
+                return KartValuesSerializer(snapshot.available(start, end)).data
+        # filters, ordering and field selection are done by the database
+        available_karts = Kart.objects.filter(**(filters or {})).exclude(id__in=busy_kart_ids(start, end)).order_by(ordering)
+        return KartValuesSerializer(available_karts, fields).data
+
+
+class AvailabilityWindowsView(APIView):
+    """
+    POST available_karts/windows/
+    Given many periods, returns the ids of the available karts during each of them
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    max_windows = 500
+
+    def post(self, request):
+        windows = request.data.get("windows", [])
+        if not isinstance(windows, list) or not 0 < len(windows) <= self.max_windows:
+            return Response(data="Windows must be a list of 1 to {} windows.".format(self.max_windows), status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            windows = [(parse_datetime(window.get("start")), parse_datetime(window.get("end"))) for window in windows]
+        except (AttributeError, ValueError):
+            return Response(data="Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f", status=status.HTTP_401_UNAUTHORIZED)
+        if any(end < start for start, end in windows):
+            return Response(data="End must be after start.", status=status.HTTP_401_UNAUTHORIZED)
+        # one query for all the windows, the karts come from the in memory fleet
+        kart_ids = sorted(get_fleet().karts)
+        return Response({"windows": [
+            {"start": start, "end": end, "kart_ids": free_karts}
+            for (start, end), free_karts in zip(windows, free_karts_by_window(kart_ids, windows))
+        ]})
 
 
 class BookingView(APIView):
@@ -142,9 +292,16 @@ class BookingView(APIView):
 
     def get(self, request):
         user = request.user
-        bookings = Booking.objects.filter(user=user)
-        return Response(BookingSerializer(bookings, many=True).data)
-
+        etag = make_etag('booking', user.id, get_versions('bookings'), request.accepted_renderer.format)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        # finished bookings may have been moved to the archive table
+        archived_bookings = ArchivedBooking.objects.filter(user=user).order_by('booking_id')
+        # current bookings are read from all shards at once
+        bookings = sorted(sum(scatter(lambda alias: BookingValuesSerializer(bookings_on(alias).filter(user=user)).data), []), key=lambda booking: booking["id"])
+        return Response(ArchivedBookingValuesSerializer(archived_bookings).data + bookings, headers=etag_headers(etag))
+
+    @idempotent
     def post(self, request):
         try:
             start = datetime.strptime(request.data.get("start", ""), '%Y-%m-%d %H:%M:%S.%f')
@@ -161,33 +318,18 @@ class BookingView(APIView):
             elif booking_hour_length < 1:
                 return Response(data="Booking must be 1hr minimum.", status=status.HTTP_401_UNAUTHORIZED)
 
-            # check if kart is available
-            kart_overlaping_bookings = Booking.objects.filter(Q(end_time__gte=start) & Q(start_time__lte=end) & Q(kart__id=kart_id))
-            if kart_overlaping_bookings:
-                return Response(data="This kart is not available during this period.", status=status.HTTP_401_UNAUTHORIZED)
-
-            # check if user's balance is enough
-            balance = Balance.objects.get(user=user)
             kart = Kart.objects.get(id=kart_id)
-            user_balance = balance.get_balance()
-            to_pay = booking_hour_length * kart.get_cost()
-            to_pay = round(to_pay, 2)
-            if user_balance < to_pay:
-                return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
-            # proceed booking
-            balance.balance -= to_pay
-            balance.save()
-            new_booking = Booking.objects.create(
-                start_time = start,
-                end_time = end,
-                kart = kart,
-                user = user
-            )
+            # proceed booking if the kart is available, the user's balance is only debited if it is enough
+            (new_booking,), to_pay, balance = book_karts(user, [kart], start, end)
             return Response({
                 "reservation": BookingSerializer(new_booking).data,
                 "price": '$'+str(to_pay),
                 "new_balance": BalanceSerializer(balance).data
             })
+        except KartsNotAvailable:
+            return Response(data="This kart is not available during this period.", status=status.HTTP_401_UNAUTHORIZED)
+        except InsufficientBalance:
+            return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
         except Kart.DoesNotExist:
             return Response("No such kart id", status.HTTP_404_NOT_FOUND)
         except ValueError:
@@ -202,7 +344,7 @@ class BookingView(APIView):
             new_end = datetime.strptime(request.data.get("end", ""), '%Y-%m-%d %H:%M:%S.%f')
             new_length = (new_end - new_start).total_seconds()/3600
             user = request.user
-            booking = Booking.objects.get(id=booking_id, user=user)
+            booking = get_user_booking(booking_id, user)
             now = datetime.now()
 
             # booking is passed
@@ -216,28 +358,26 @@ class BookingView(APIView):
                 elif new_length < 1:
                     return Response(data="Booking must be at least 1hr.", status=status.HTTP_401_UNAUTHORIZED)
 
-                # check if kart is available during new period
-                kart_id = booking.kart.id
-                kart_overlaping_bookings = Booking.objects.filter(
-                        Q(end_time__gte=new_start) & Q(start_time__lte=new_end) & Q(kart__id=kart_id)
-                                                            ).exclude(id=booking_id)
-                if kart_overlaping_bookings:
-                    return Response(data="The kart is not available during this new period.", status=status.HTTP_401_UNAUTHORIZED)
-
-                # check if user balance is sufficient
-                balance = Balance.objects.get(user=user)
                 hour_cost = booking.kart.get_cost()
-                to_pay = (new_length - booking.get_lenght()) * hour_cost # can be negative if new period shorter, user is refunded
+                # can be negative if new period shorter, user is refunded.
+                # The difference is with what was paid, the prices may have changed since
+                to_pay = booking_price(hour_cost, new_start, new_end) - booking_payments([booking.id]).get(booking.id, 0)
                 to_pay = round(to_pay, 2)
-                if balance.get_balance() < to_pay:
-                    return Response(data="Balance is not sufficient for this new booking.", status=status.HTTP_401_UNAUTHORIZED)
-
-                # else, we can update the booking along with the user's balance
-                booking.start_time = new_start
-                booking.end_time = new_end
-                balance.balance -= to_pay
-                booking.save()
-                balance.save()
+
+                # update the booking along with the user's balance, if it is sufficient
+                with sharding.atomic(booking._state.db):
+                    # check if kart is available during new period, with the kart locked as on booking creation
+                    kart_id = booking.kart.id
+                    lock_karts([kart_id])
+                    kart_overlaping_bookings = bookings_on(booking._state.db).filter(
+                            Q(end_time__gte=new_start) & Q(start_time__lte=new_end) & Q(kart__id=kart_id)
+                                                                ).exclude(id=booking_id)
+                    if kart_overlaping_bookings:
+                        return Response(data="The kart is not available during this new period.", status=status.HTTP_401_UNAUTHORIZED)
+                    booking.start_time = new_start
+                    booking.end_time = new_end
+                    booking.save()
+                    balance = post_entry(user, -to_pay, LedgerEntry.BOOKING_UPDATE, booking.id, check_balance=True)
                 return Response({
                     "reservation": BookingSerializer(booking).data,
                     "payment": '$'+str(to_pay),
@@ -252,25 +392,35 @@ class BookingView(APIView):
 
                 # else, we take from balance if new period is longer, of refund if shorter
                 # if new period is shorter than 1hr, do not refund the hour
-                balance = Balance.objects.get(user=user)
                 hour_cost = booking.kart.get_cost()
-                new_length = max(1, (new_end - booking.start_time).total_seconds/3600) # do not refund the first hour
-                to_pay = (new_length - booking.get_lenght()) * hour_cost
+                charged_end = max(new_end, booking.start_time + timedelta(seconds=3600)) # do not refund the first hour
+                to_pay = booking_price(hour_cost, booking.start_time, charged_end) - booking_payments([booking.id]).get(booking.id, 0)
                 to_pay = round(to_pay, 2)
-                if balance.get_balance() < to_pay:
-                    return Response(data="Balance is not sufficient for this new booking.", status=status.HTTP_401_UNAUTHORIZED)
-
-                # else, we can update the booking along with the user's balance
-                booking.end_time = new_end
-                balance.balance -= to_pay
-                booking.save()
-                balance.save()
+
+                # update the booking along with the user's balance, if it is sufficient
+                with sharding.atomic(booking._state.db):
+                    # a longer booking must not overlap the next one of the kart
+                    lock_karts([booking.kart_id])
+                    kart_overlaping_bookings = bookings_on(booking._state.db).filter(
+                        Q(end_time__gte=booking.end_time) & Q(start_time__lte=new_end) & Q(kart__id=booking.kart_id)
+                    ).exclude(id=booking_id)
+                    if kart_overlaping_bookings:
+                        return Response(data="The kart is not available during this new period.", status=status.HTTP_401_UNAUTHORIZED)
+                    booking.end_time = new_end
+                    booking.save()
+                    balance = post_entry(user, -to_pay, LedgerEntry.BOOKING_UPDATE, booking.id, check_balance=True)
                 return Response({
                     "reservation": BookingSerializer(booking).data,
                     "payment": '$'+str(to_pay),
                     "new_balance": BalanceSerializer(balance).data
                 })
+        except InsufficientBalance:
+            return Response(data="Balance is not sufficient for this new booking.", status=status.HTTP_401_UNAUTHORIZED)
+        except StaleVersion:
+            return Response(data="This booking was changed by another request, please retry.", status=status.HTTP_409_CONFLICT)
         except Booking.DoesNotExist:
+            if ArchivedBooking.objects.filter(booking_id=booking_id, user=request.user).exists():
+                return Response(data="Cannot update a booking from the past.", status=status.HTTP_401_UNAUTHORIZED)
             return Response(data="Booking was not found.", status=status.HTTP_404_NOT_FOUND)
         except ValueError:
             return Response("Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f")
@@ -280,38 +430,229 @@ class BookingView(APIView):
             booking_id = request.data.get("booking_id", "")
             print(booking_id)
             user = request.user
-            booking = Booking.objects.get(id=booking_id, user=user)
+            booking = get_user_booking(booking_id, user)
             if datetime.now() > booking.start_time:
                 return Response(data="Can only delete upcoming bookings.", status=status.HTTP_401_UNAUTHORIZED)
-            duration = booking.get_lenght()
-            hour_price = booking.kart.get_cost()
-            refund = round(duration * hour_price, 2)
-            balance = Balance.objects.get(user=user)
-            balance.balance += refund
-            balance.save()
-            booking.delete()
+            with sharding.atomic(booking._state.db):
+                # the refund is what was paid for the booking as read
+                booking.claim()
+                refund = booking_payments([booking.id]).get(booking.id, 0)
+                post_entry(user, refund, LedgerEntry.REFUND, booking.id)
+                booking.delete()
             return Response(data="Booking deleted, accout was refunded by $+{}.".format(refund), status=status.HTTP_204_NO_CONTENT)
+        except StaleVersion:
+            return Response(data="This booking was changed by another request, please retry.", status=status.HTTP_409_CONFLICT)
         except Booking.DoesNotExist:
+            if ArchivedBooking.objects.filter(booking_id=booking_id, user=request.user).exists():
+                return Response(data="Can only delete upcoming bookings.", status=status.HTTP_401_UNAUTHORIZED)
             return Response(data="Booking was not found.", status=status.HTTP_404_NOT_FOUND)
 
 
+class BatchBookingView(APIView):
+    """
+    POST booking/batch/
+    Create, update and delete many bookings in one request
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        operations = request.data.get("operations", [])
+        mode = request.data.get("mode", "atomic")
+        if not isinstance(operations, list) or mode not in BATCH_MODES:
+            return Response(data="Operations must be a list and mode atomic or partial.", status=status.HTTP_401_UNAUTHORIZED)
+        batch = Batch(request.user, operations, mode)
+        try:
+            if not batch.run():
+                return Response(data={
+                    "message": "Some operations are not valid, none was applied.",
+                    "results": batch.results
+                }, status=status.HTTP_401_UNAUTHORIZED)
+        except InsufficientBalance:
+            return Response(data="Not enough balance for these operations.", status=status.HTTP_401_UNAUTHORIZED)
+        except StaleVersion:
+            return Response(data="Some bookings were changed by another request, please retry.", status=status.HTTP_409_CONFLICT)
+        return Response({
+            "results": batch.results,
+            "payment": '$'+str(batch.payment),
+            "new_balance": {"balance": batch.balance}
+        })
+
+
+class RecurringBookingView(APIView):
+    """
+    POST booking/recurring/
+    Book one or several karts for a series of daily or weekly occurrences
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    intervals = {"daily": timedelta(days=1), "weekly": timedelta(days=7)}
+    max_occurrences = 52
+
+    def post(self, request):
+        try:
+            start = datetime.strptime(request.data.get("start", ""), '%Y-%m-%d %H:%M:%S.%f')
+            end = datetime.strptime(request.data.get("end", ""), '%Y-%m-%d %H:%M:%S.%f')
+            booking_hour_length = (end-start).total_seconds()/3600
+            kart_ids = request.data.get("kart_ids", [])
+            interval = self.intervals.get(request.data.get("every", ""))
+            occurrences = request.data.get("occurrences", "")
+            user = request.user
+
+            if not isinstance(occurrences, int) or not 0 < occurrences <= self.max_occurrences:
+                return Response(data="Occurrences must be between 1 and {}.".format(self.max_occurrences), status=status.HTTP_401_UNAUTHORIZED)
+            elif interval is None:
+                return Response(data="Every must be daily or weekly.", status=status.HTTP_401_UNAUTHORIZED)
+            elif start < datetime.now():
+                return Response(data="Booking before present time is not possible.", status=status.HTTP_401_UNAUTHORIZED)
+            elif booking_hour_length < 1:
+                return Response(data="Booking must be 1hr minimum.", status=status.HTTP_401_UNAUTHORIZED)
+            elif end - start >= interval:
+                return Response(data="Occurrences must not overlap.", status=status.HTTP_401_UNAUTHORIZED)
+
+            karts = Kart.objects.in_bulk(kart_ids)
+            if not kart_ids or len(karts) < len(set(kart_ids)):
+                return Response("Provided ids are not correct")
+
+            periods = [(start + i * interval, end + i * interval) for i in range(occurrences)]
+            shards = group_by_shard(karts)
+            with sharding.atomic(*shards):
+                # check all occurrences with one range query and a sweep per kart, with the karts locked
+                lock_karts(karts)
+                busy = busy_periods(list(karts), start, periods[-1][1])
+                not_available = {
+                    kart_id: [str(period_start) for period_start, period_end in sweep_conflicts(busy.get(kart_id, []), periods)]
+                    for kart_id in karts
+                }
+                not_available = {kart_id: starts for kart_id, starts in not_available.items() if starts}
+                if not_available:
+                    return Response(data={
+                        "message": "Some karts are not available for some occurrences",
+                        "not_available_karts": not_available
+                    }, status=status.HTTP_401_UNAUTHORIZED)
+
+                # proceed booking, the user's balance is debited once for the whole series, if it is enough
+                bulk_create_bookings([
+                    Booking(start_time=period_start, end_time=period_end, kart=kart, user=user)
+                    for kart in karts.values() for period_start, period_end in periods
+                ])
+                # bulk_create does not give the ids back on every database
+                bookings = sorted(sum(scatter(lambda alias: list(bookings_on(alias).filter(
+                    user=user, kart_id__in=shards[alias], start_time__in=[period_start for period_start, period_end in periods]
+                )), shards), []), key=lambda booking: (booking.kart_id, booking.start_time))
+                entries = [(-kart_price(karts[booking.kart_id], booking.start_time, booking.end_time), LedgerEntry.BOOKING, booking.id) for booking in bookings]
+                balance = post_entries(user, entries, check_balance=True)
+                # bulk_create does not send the signals
+                bookings_created(bookings)
+            to_pay = round(-sum(amount for amount, reason, booking_ref in entries), 2)
+            return Response({
+                "reservation": BookingSerializer(bookings, many=True).data,
+                "price": '$'+str(to_pay),
+                "new_balance": BalanceSerializer(balance).data
+            })
+        except InsufficientBalance:
+            return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
+        except (TypeError, ValueError):
+            return Response("Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f")
+
+
 class GetNearKartsView(APIView):
     """
     POST near_karts/
-    Will return the list of karts that are available for the next hour, ordered by distance
+    Will return the list of karts, ranked by distance and by the time to wait until they are free
     """
 
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_scope = 'near_karts'
 
     def post(self, request):
         user_lat = request.data.get("lat", "")
         user_lng = request.data.get("lng", "")
-        start = datetime.now()
-        end = start + timedelta(seconds=3600)
-        overlaping_bookings = Booking.objects.filter(Q(end_time__gte=start) & Q(start_time__lte=end)).values('kart').distinct()
-        available_karts = Kart.objects.exclude(id__in=overlaping_bookings)
-        sorted_available_karts = sorted(available_karts, key=lambda x:distance(user_lng, user_lat, x.longitude, x.latitude))
-        return Response(KartSerializer(sorted_available_karts, many=True).data)
+        now = datetime.now()
+        # wait times change with time, the etag is kept for the current minute
+        minute = now.replace(second=0, microsecond=0)
+        versions = get_versions('bookings', 'karts', 'positions')
+        etag = make_etag('near_karts', user_lat, user_lng, minute, versions, request.accepted_renderer.format)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        # identical concurrent requests share one query, for the same versions
+        sorted_karts = single_flight.do(('near_karts', repr((user_lat, user_lng)), minute, tuple(versions)), lambda: self.get_near_karts(user_lat, user_lng, now))
+        return Response(sorted_karts, headers=etag_headers(etag))
+
+    def get_near_karts(self, user_lat, user_lng, now):
+        snapshot = get_snapshot(now, now)
+        if snapshot is not None:
+            now_seconds = seconds(now)
+            karts = []
+            for i in range(len(snapshot.ids)):
+                free_at, free_until = snapshot.next_free(i, now_seconds, MIN_BOOKING.total_seconds())
+                karts.append((
+                    snapshot.ids[i], snapshot.type_names[snapshot.types[i]], snapshot.costs[i], snapshot.latitudes[i], snapshot.longitudes[i],
+                    EPOCH + timedelta(seconds=free_at), EPOCH + timedelta(seconds=free_until) if free_until is not None else None
+                ))
+        else:
+            # next free periods are kept up to date on booking writes, no booking is read here
+            karts = Kart.objects.order_by('id').values_list('id', 'type', 'hourly_cost', 'latitude', 'longitude', 'next_free_at', 'free_until')
+        km_per_minute = getattr(settings, 'KTKART_NEAR_KARTS_KM_PER_WAIT_MINUTE', 0.1)
+        ranked = []
+        for kart_id, kart_type, hourly_cost, latitude, longitude, free_at, free_until in karts:
+            kart_distance = distance(user_lng, user_lat, longitude, latitude)
+            if free_until is not None and free_until - max(free_at or now, now) < MIN_BOOKING:
+                # what is left of the free period is too short to book, or a booking started
+                # since it was computed, the end of the next booking is not known yet
+                wait, free_at, free_until = None, None, None
+            else:
+                free_at = max(free_at or now, now)
+                wait = (free_at - now).total_seconds()/60
+            ranked.append((
+                kart_distance + wait * km_per_minute if wait is not None else float('inf'),
+                {
+                    "id": kart_id, "type": kart_type, "hourly_cost": hourly_cost, "latitude": latitude, "longitude": longitude,
+                    "distance": round(kart_distance, 3),
+                    "wait_minutes": round(wait, 1) if wait is not None else None,
+                    "next_free_at": free_at, "free_until": free_until
+                }
+            ))
+        ranked.sort(key=lambda item: item[0])
+        return [kart for score, kart in ranked]
+
+
+class AvailabilityStreamView(APIView):
+    """
+    GET availability/stream/
+    Server-sent events of the karts becoming free or busy, optionally filtered by kart type or area
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    renderer_classes = (EventStreamRenderer, FastJSONRenderer)
+
+    def get(self, request):
+        kart_type = request.query_params.get("type")
+        try:
+            bbox = [float(value) for value in request.query_params["bbox"].split(",")] if "bbox" in request.query_params else None
+        except ValueError:
+            bbox = []
+        if bbox is not None and len(bbox) != 4:
+            return Response(data="Bbox must be min_lat,min_lng,max_lat,max_lng.", status=status.HTTP_401_UNAUTHORIZED)
+
+        def matches(event):
+            if kart_type is None and bbox is None:
+                return True
+            kart = get_fleet().karts.get(event["kart"])
+            if kart is None or kart_type is not None and kart[1] != kart_type:
+                return False
+            return bbox is None or bbox[0] <= kart[3] <= bbox[2] and bbox[1] <= kart[4] <= bbox[3]
+
+        events = stream(
+            get_hub(), matches,
+            keepalive=getattr(settings, 'KTKART_STREAM_KEEPALIVE_SECONDS', 15),
+            max_duration=getattr(settings, 'KTKART_STREAM_MAX_SECONDS', 300)
+        )
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # tell nginx not to buffer the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 class MultipleBookingView(APIView):
@@ -321,7 +662,9 @@ class MultipleBookingView(APIView):
     """
 
     permission_classes = (permissions.IsAuthenticated,)
+    throttle_scope = 'multiple_booking'
 
+    @idempotent
     def post(self, request):
         try:
             start = datetime.strptime(request.data.get("start", ""), '%Y-%m-%d %H:%M:%S.%f')
@@ -338,48 +681,102 @@ class MultipleBookingView(APIView):
             elif booking_hour_length < 1:
                 return Response(data="Booking must be 1hr minimum.", status=status.HTTP_401_UNAUTHORIZED)
 
-            # check if kart is available
-            kart_overlaping_bookings = Booking.objects.filter(Q(end_time__gte=start) & Q(start_time__lte=end) & Q(kart__id__in=kart_ids))
-            if kart_overlaping_bookings:
-                return Response(data={
-                    "message": "Some karts are not available during period",
-                    "not_available_karts": list(map(lambda x:x.kart.id, kart_overlaping_bookings))
-                }, status=status.HTTP_401_UNAUTHORIZED)
-
-            # check if user's balance is enough
-            balance = Balance.objects.get(user=user)
             karts = Kart.objects.filter(id__in=kart_ids)
             # check if all ids given correspond to a kart
             if karts.count() < len(kart_ids):
                 return Response("Provided ids are not correct")
 
-            user_balance = balance.get_balance()
-            print(karts.aggregate(Sum('hourly_cost')))
-            to_pay = booking_hour_length * karts.aggregate(Sum('hourly_cost'))['hourly_cost__sum']
-            to_pay = round(to_pay, 2)
-            if user_balance < to_pay:
-                return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
-            # proceed booking
-            balance.balance -= to_pay
-            balance.save()
-            bookings = []
-            for kart in karts:
-                new_booking = Booking.objects.create(
-                    start_time = start,
-                    end_time = end,
-                    kart = kart,
-                    user = user
-                )
-                bookings.append(BookingSerializer(new_booking).data)
+            # proceed booking if the karts are available, the user's balance is debited once for all karts, if it is enough
+            bookings, to_pay, balance = book_karts(user, karts, start, end)
             return Response({
-                "reservation": bookings,
+                "reservation": BookingSerializer(bookings, many=True).data,
                 "price": '$'+str(to_pay),
                 "new_balance": BalanceSerializer(balance).data
             })
+        except KartsNotAvailable as error:
+            return Response(data={
+                "message": "Some karts are not available during period",
+                "not_available_karts": sorted(error.kart_ids)
+            }, status=status.HTTP_401_UNAUTHORIZED)
+        except InsufficientBalance:
+            return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
         except ValueError:
             return Response("Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f")
 
-            
+
+class AllocateView(APIView):
+    """
+    POST allocate/
+    Pick and book a group of karts free for the next hour (or a given period), nearest or cheapest first
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    strategies = ("nearest", "cheapest")
+    attempts = 3
+
+    def post(self, request):
+        try:
+            party_size = request.data.get("party_size", "")
+            kart_type = request.data.get("type", None)
+            budget = request.data.get("budget", None)
+            budget = None if budget is None else float(budget)
+            strategy = request.data.get("strategy", "nearest")
+            user_lat = float(request.data.get("lat", ""))
+            user_lng = float(request.data.get("lng", ""))
+            if "start" in request.data:
+                start = datetime.strptime(request.data.get("start", ""), '%Y-%m-%d %H:%M:%S.%f')
+                end = datetime.strptime(request.data.get("end", ""), '%Y-%m-%d %H:%M:%S.%f')
+            else:
+                start = datetime.now()
+                end = start + timedelta(seconds=3600)
+        except (TypeError, ValueError):
+            return Response("Position must be numbers and datetimes formatted %Y-%m-%d %H:%M:%S.%f")
+        if not isinstance(party_size, int) or party_size < 1:
+            return Response(data="Party size must be a positive integer.", status=status.HTTP_401_UNAUTHORIZED)
+        elif strategy not in self.strategies:
+            return Response(data="Strategy must be nearest or cheapest.", status=status.HTTP_401_UNAUTHORIZED)
+        elif "start" in request.data and start < datetime.now():
+            return Response(data="Booking before present time is not possible.", status=status.HTTP_401_UNAUTHORIZED)
+        elif (end-start).total_seconds()/3600 < 1:
+            return Response(data="Booking must be 1hr minimum.", status=status.HTTP_401_UNAUTHORIZED)
+
+        excluded = set()
+        for attempt in range(self.attempts):
+            karts = self.pick_karts(party_size, kart_type, strategy, user_lat, user_lng, start, end, excluded)
+            if karts is None:
+                return Response(data="Not enough karts available.", status=status.HTTP_401_UNAUTHORIZED)
+            to_pay = sum(kart_price(kart, start, end) for kart in karts)
+            if budget is not None and to_pay > budget:
+                return Response(data="No group of karts within budget, price is ${}.".format(round(to_pay, 2)), status=status.HTTP_401_UNAUTHORIZED)
+            try:
+                # the picked karts are locked and checked again, nobody may have booked them in the meantime
+                bookings, to_pay, balance = book_karts(request.user, karts, start, end)
+                return Response({
+                    "reservation": BookingSerializer(bookings, many=True).data,
+                    "karts": [dict(KartSerializer(kart).data, distance=round(distance(user_lng, user_lat, kart.longitude, kart.latitude), 3)) for kart in karts],
+                    "price": '$'+str(to_pay),
+                    "new_balance": BalanceSerializer(balance).data
+                })
+            except KartsNotAvailable as error:
+                # lost the race for some karts, pick again without them
+                excluded |= error.kart_ids
+            except InsufficientBalance:
+                return Response(data="Not enough balance to book.", status=status.HTTP_401_UNAUTHORIZED)
+        return Response(data="Karts were booked by someone else, please retry.", status=status.HTTP_401_UNAUTHORIZED)
+
+    def pick_karts(self, party_size, kart_type, strategy, user_lat, user_lng, start, end, excluded):
+        available_karts = Kart.objects.exclude(id__in=busy_kart_ids(start, end)).exclude(id__in=excluded)
+        if kart_type:
+            available_karts = available_karts.filter(type=kart_type)
+        by_distance = lambda kart: distance(user_lng, user_lat, kart.longitude, kart.latitude)
+        if strategy == "cheapest":
+            ranking = lambda kart: (kart.get_cost(), by_distance(kart))
+        else:
+            ranking = by_distance
+        karts = sorted(available_karts, key=ranking)[:party_size]
+        return karts if len(karts) == party_size else None
+
+
 class PopulateView(APIView):
     """
     GET populate/
@@ -399,3 +796,99 @@ class PopulateView(APIView):
                 Kart.objects.create(type="Blue Falcon", hourly_cost=25, latitude=48+random(), longitude=2+random())
             return Response('Populated')
         return Response('Was already populated')
+
+
+class QuoteView(APIView):
+    """
+    POST quote/
+    Return the price of many (kart or kart type, period) pairs without booking them
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+    max_items = 1000
+
+    def post(self, request):
+        items = request.data.get("items", [])
+        if not isinstance(items, list) or len(items) > self.max_items:
+            return Response(data="Items must be a list of at most {} items.".format(self.max_items), status=status.HTTP_401_UNAUTHORIZED)
+        # costs come from the in memory fleet, the booking table is never read
+        fleet = get_fleet()
+        quotes = [None] * len(items)
+        indexes, costs, starts, ends = [], [], [], []
+        for index, item in enumerate(items):
+            try:
+                start, end = parse_datetime(item.get("start")), parse_datetime(item.get("end"))
+            except (AttributeError, ValueError):
+                quotes[index] = {"error": "Datetime format not respected. Must be %Y-%m-%d %H:%M:%S.%f"}
+                continue
+            if "kart_id" in item:
+                kart_id = item["kart_id"]
+                cost = fleet.cost(kart_id) if isinstance(kart_id, int) and kart_id in fleet.karts else None
+            else:
+                kart_type = item.get("type")
+                cost = fleet.type_costs.get(kart_type) if isinstance(kart_type, str) else None
+            if cost is None:
+                quotes[index] = {"error": "No such kart id or type"}
+            elif end <= start:
+                quotes[index] = {"error": "End must be after start."}
+            else:
+                indexes.append(index)
+                costs.append(cost)
+                starts.append(start)
+                ends.append(end)
+        # all prices computed at once
+        for index, price in zip(indexes, booking_prices(costs, starts, ends)):
+            quotes[index] = {"price": '$'+str(round(price, 2))}
+        return Response({"quotes": quotes})
+
+
+class TelemetryView(APIView):
+    """
+    POST telemetry/
+    Karts report their positions, in batches
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+    max_reports = 10000
+
+    def post(self, request):
+        reports = request.data.get("reports", [])
+        if not isinstance(reports, list) or len(reports) > self.max_reports:
+            return Response(data="Reports must be a list of at most {} reports.".format(self.max_reports), status=status.HTTP_401_UNAUTHORIZED)
+        positions, errors = read_reports(reports)
+        # positions are buffered and written at most once per flush interval
+        written = telemetry_buffer.add(positions)
+        return Response({"accepted": len(positions), "rejected": errors, "written": written})
+
+
+class UsageAnalyticsView(APIView):
+    """
+    GET analytics/usage/
+    Admin user can read the hours booked and the revenue of the karts between two days
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        try:
+            start = datetime.strptime(request.query_params.get("start", ""), '%Y-%m-%d').date()
+            end = datetime.strptime(request.query_params.get("end", ""), '%Y-%m-%d').date()
+            kart_id = int(request.query_params["kart_id"]) if request.query_params.get("kart_id") else None
+        except ValueError:
+            return Response(data="Days must be formatted %Y-%m-%d and kart_id must be a number.", status=status.HTTP_401_UNAUTHORIZED)
+        if end < start:
+            return Response(data="End must be after start.", status=status.HTTP_401_UNAUTHORIZED)
+        by_day = request.query_params.get("by") == "day"
+        return Response({"start": start, "end": end, "usage": usage_report(start, end, kart_id, by_day)})
+
+
+class MetricsView(APIView):
+    """
+    GET metrics/
+    Admin user can read the API counters (cache hit ratios...)
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return Response(get_metrics())
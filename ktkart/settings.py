@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 import datetime
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -44,6 +45,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # gzip or brotli above KTKART_COMPRESSION_MIN_BYTES, before the middlewares reading the content
+    'ktkart.api.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -97,6 +100,85 @@ DATABASES = {
     # }
 }
 
+# Bookings can be split by kart over several databases of DATABASES, for instance
+# KTKART_BOOKING_SHARDS = ['default', 'bookings_1', 'bookings_2']
+# The other tables stay on the default database.
+KTKART_BOOKING_SHARDS = ['default']
+DATABASE_ROUTERS = ['ktkart.api.routers.BookingShardRouter']
+# Threads reading the shards in parallel
+KTKART_SHARD_THREADS = 8
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.1/topics/cache/
+# Booking and kart version counters (ETags) are stored in the default cache,
+# use a cache shared by all workers in production (memcached for instance)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # results of available_karts/, by window
+    'availability': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'availability',
+    },
+}
+
+# Cache alias used for the available_karts/ results
+KTKART_AVAILABILITY_CACHE = 'availability'
+# Windows are split in buckets, a booking write drops the cached windows sharing a bucket with it
+KTKART_AVAILABILITY_BUCKET_SECONDS = 3600
+# Windows spanning more buckets are not cached
+KTKART_AVAILABILITY_MAX_BUCKETS = 48
+KTKART_AVAILABILITY_TIMEOUT = 300
+
+# Identical concurrent available_karts/ and near_karts/ queries run once per worker,
+# set to True to also share them between workers through the cache below
+KTKART_SINGLE_FLIGHT_SHARED = False
+KTKART_SINGLE_FLIGHT_CACHE = 'default'
+
+# Pricing rules applied in order to every booking price, as (class path, arguments) pairs, for instance
+# ('ktkart.api.pricing.PeakHoursRule', {'hours': [18, 19, 20, 21], 'multiplier': 1.5})
+KTKART_PRICING_RULES = []
+
+# Kart positions reported to telemetry/ are written at most once per interval, in seconds
+KTKART_TELEMETRY_FLUSH_SECONDS = 2
+
+# The cached availabilities, the snapshot and the ETags of the routes returning kart positions are
+# renewed after written positions at most once per interval, in seconds: the positions they give can be that old
+KTKART_POSITIONS_VERSION_SECONDS = 60
+
+# Hub fanning out the availability events to the availability/stream/ clients, as (class path, arguments).
+# LocalHub only reaches the clients of the same worker, with several workers use
+# ('ktkart.api.events.CacheHub', {'cache_alias': 'default'}) with a shared cache, or a message broker backed hub
+KTKART_EVENT_HUB = ('ktkart.api.events.LocalHub', {})
+# Streams send a comment when idle and are closed after a while, clients reconnect
+KTKART_STREAM_KEEPALIVE_SECONDS = 15
+KTKART_STREAM_MAX_SECONDS = 300
+
+# Responses to requests with an Idempotency-Key header are kept in this cache, in seconds,
+# and retries wait up to the lock timeout for the first request to finish
+KTKART_IDEMPOTENCY_CACHE = 'default'
+KTKART_IDEMPOTENCY_TTL = 86400
+KTKART_IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+# Responses larger than this are compressed, with brotli (when it is installed) or gzip as the client accepts,
+# brotli quality goes from 0 to 11, higher is smaller and slower
+KTKART_COMPRESSION_MIN_BYTES = 1024
+KTKART_BROTLI_QUALITY = 5
+
+# Cache holding the throttle buckets
+KTKART_THROTTLE_CACHE = 'default'
+
+# Snapshot of the karts and of their bookings shared by the workers through a memory mapped file,
+# published by the publish_snapshot command, covering the bookings of the next days
+KTKART_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), 'ktkart-fleet.snapshot')
+KTKART_SNAPSHOT_HORIZON_SECONDS = 7 * 86400
+
+# near_karts/ ranks karts by distance plus wait time, a minute of wait counts as this many kilometers
+KTKART_NEAR_KARTS_KM_PER_WAIT_MINUTE = 0.1
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -129,6 +211,28 @@ REST_FRAMEWORK = {
         'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ],
+    # Renderer settings, FastJSONRenderer uses orjson when it is installed.
+    # JSON stays the default, clients can ask for columnar JSON or MessagePack (when msgpack is installed)
+    'DEFAULT_RENDERER_CLASSES': [
+        'ktkart.api.renderers.FastJSONRenderer',
+        'ktkart.api.renderers.ColumnarJSONRenderer',
+        'ktkart.api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'ktkart.api.renderers.InstalledRenderersNegotiation',
+    # Throttling settings, token buckets: a rate of 60/min allows bursts of 60 requests
+    # and one more request per second. Expensive routes have their own budget on top of the user one.
+    'DEFAULT_THROTTLE_CLASSES': [
+        'ktkart.api.throttles.UserBucketThrottle',
+        'ktkart.api.throttles.ScopedBucketThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'anon': '100/min',
+        'user': '600/min',
+        'login': '10/min',
+        'near_karts': '60/min',
+        'multiple_booking': '20/min',
+    },
 }
 
 # JWT settings
@@ -0,0 +1,13 @@
+"""
+Settings with the bookings split over three local SQLite databases, to run the sharding tests:
+DJANGO_SETTINGS_MODULE=ktkart.settings_shards python manage.py test ktkart.api.tests.ShardingTest
+"""
+from ktkart.settings import *
+
+DATABASES = {
+    alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(BASE_DIR, '{}.sqlite3'.format(alias))}
+    for alias in ('default', 'bookings_1', 'bookings_2')
+}
+KTKART_BOOKING_SHARDS = ['default', 'bookings_1', 'bookings_2']
+# the migrations are written for MySQL, the SQLite tables are created from the models
+MIGRATION_MODULES = {'api': None}